@@ -243,7 +243,8 @@ def non_linear_register_ants2(
     downsample =None,
     start      =None,
     level      =32.0,
-    verbose    =0
+    verbose    =0,
+    pyramid    =None
     ):
     """perform non-linear registration using ANTs, WARNING: will create inverted xfm  will be named output_invert.xfm"""
     if start is None:
@@ -315,7 +316,7 @@ def non_linear_register_ants2(
         cmd=['antsRegistration','--minc','1','-a','--dimensionality','3']
 
 
-        (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources,targets,source_mask,target_mask, downsample)
+        (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources,targets,source_mask,target_mask, downsample, pyramid=pyramid)
 
         # generate modalities
         for _s in range(modalities):
@@ -379,7 +380,8 @@ def linear_register_ants2(
     parameters = None,
     downsample = None,
     close      = False,
-    verbose=0
+    verbose=0,
+    pyramid    = None
     ):
     """perform linear registration using ANTs"""
     #TODO:implement close
@@ -456,7 +458,7 @@ def linear_register_ants2(
         
         cmd=['antsRegistration','--collapse-output-transforms', '0', '--minc','1','-a','--dimensionality','3']
 
-        (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources,targets,source_mask,target_mask, downsample)
+        (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources,targets,source_mask,target_mask, downsample, pyramid=pyramid)
         
         # generate modalities
         for _s in range(modalities):
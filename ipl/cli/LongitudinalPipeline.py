@@ -20,6 +20,7 @@ from ipl.longitudinal.patient            import *  # class to store all the data
 
 
 from   ipl.minc_tools import mincTools,mincError
+from   ipl.workflow   import Workflow
 
 # files storing all processing
 from ipl.longitudinal.t1_preprocessing   import pipeline_t1preprocessing
@@ -541,10 +542,109 @@ def runTimePoint_FourthStage(tp, patient, vbm_options):
         traceback.print_exc(file=sys.stdout)
         raise
 
-def runPipeline(pickle, workdir=None):
+# patient options affecting results of each stage
+_first_stage_options = ['denoise', 'fast', 'geo_corr', 'linreg', 'mask_n3',
+                        'modeldir', 'modelname', 'mri3T', 'n4',
+                        'beastdir', 'beastresolution']
+_second_stage_options = ['modeldir', 'modelname', 'beastdir', 'beastresolution',
+                         'fast', 'onlyt1', 'dolngcls', 'add', 'vbm_options']
+_linear_template_options = ['dobiascorr', 'fast', 'geo_corr', 'large_atrophy',
+                            'linreg', 'modeldir', 'modelname', 'mri3T',
+                            'rigid', 'symmetric']
+_skull_stripping_options = ['beastdir', 'beastresolution']
+_template_options = ['fast', 'modeldir', 'modelname']
+_add_options = ['add', 'modeldir', 'modelname']
+_third_stage_options = ['modeldir', 'modelname', 'onlyt1']
+_fourth_stage_options = ['dodbm', 'dolngcls', 'modeldir', 'modelname',
+                         'vbm_options', 'add']
+
+
+def stage_options(patient, names):
+    return {i: getattr(patient, i, None) for i in names}
+
+
+# outputs of each stage, the same files that the stage functions check
+# to decide if processing was already done
+def first_stage_outputs(patient, tp):
+    t = patient[tp]
+    outputs = [t.clp['t1'], t.stx_xfm['t1'], t.stx_mnc['t1'],
+               t.stx_ns_xfm['t1'], t.stx_ns_mnc['t1'], t.qc_jpg['stx_t1'],
+               t.stx_mnc['mask'], t.stx_ns_mnc['mask'], t.qc_jpg['stx_mask']]
+    for s in t.native.keys():
+        if s not in ('t1', 't2les'):
+            outputs.extend([t.clp[s], t.stx_xfm[s], t.stx_mnc[s]])
+    return outputs
+
+
+def skull_stripping_outputs(patient, tp):
+    t = patient[tp]
+    outputs = [t.stx2_mnc['mask'], t.qc_jpg['stx2_mask']]
+    if 't2les' in t.native:
+        outputs.append(t.stx2_mnc['masknoles'])
+    return outputs
+
+
+def classification_outputs(patient, tp):
+    t = patient[tp]
+    return [t.stx2_mnc['classification'], t.qc_jpg['classification']]
+
+
+def lobes_outputs(patient, tp):
+    t = patient[tp]
+    return [t.stx2_mnc['lobes'], t.vol['lobes'], t.qc_jpg['lobes']]
+
+
+def second_stage_outputs(patient, tp):
+    t = patient[tp]
+    return [t.stx2_xfm['t1'], t.stx2_mnc['t1'], patient.nl_xfm] + \
+        skull_stripping_outputs(patient, tp) + \
+        classification_outputs(patient, tp) + \
+        lobes_outputs(patient, tp)
+
+
+def linear_template_outputs(patient):
+    outputs = [patient.template['linear_template'],
+               patient.template['linear_template_mask'],
+               patient.template['stx2_xfm'],
+               patient.qc_jpg['linear_template']]
+    for (i, tp) in patient.items():
+        outputs.extend([tp.stx2_xfm['t1'], tp.stx2_mnc['t1'], tp.qc_jpg['stx2_t1']])
+    return outputs
+
+
+def nonlinear_template_outputs(patient):
+    outputs = [patient.template['nl_template'],
+               patient.template['nl_template_mask']]
+    for (i, tp) in patient.items():
+        outputs.extend([tp.lng_xfm['t1'], tp.lng_ixfm['t1']])
+    return outputs
+
+
+def lng_classification_outputs(patient):
+    outputs = []
+    for (i, tp) in patient.items():
+        outputs.extend([tp.stx2_mnc['lng_classification'], tp.qc_jpg['lngclassification']])
+    return outputs
+
+
+def third_stage_outputs(patient, tp):
+    t = patient[tp]
+    return [t.nl_xfm, t.qc_jpg['nl_t1']] + classification_outputs(patient, tp)
+
+
+def fourth_stage_outputs(patient, tp):
+    outputs = lobes_outputs(patient, tp)
+    if patient.dodbm:
+        outputs.extend([patient[tp].lng_det['t1'], patient[tp].qc_jpg['lng_det']])
+    return outputs
+
+
+def runPipeline(pickle, workdir=None, dry_run=False):
     '''
     RUN PIPELINE
     Process selected pickle file
+    Stages are executed again only if input scans or relevant
+    options changed since the last successful run
     '''
     # TODO: make VBM options part of initialization parameters
 
@@ -569,68 +669,103 @@ def runPipeline(pickle, workdir=None):
           patient.workdir=workdir
         # prepare qc folder
 
-        tps = sorted(patient.keys())
-        jobs=[]
-        for tp in tps:
-            jobs.append(futures.submit(runTimePoint_FirstStage,tp, patient))
+        wf = Workflow(patient.patientdir+os.sep+'workflow_'+str(patient.id)+'.json',
+                      dry_run=dry_run, submit=futures.submit)
 
-        futures.wait(jobs, return_when=futures.ALL_COMPLETED)
+        tps = sorted(patient.keys())
+        first=[]
+        with wf.parallel():
+            for tp in tps:
+                first.append(wf.stage(tp+'/first', runTimePoint_FirstStage, args=(tp, patient),
+                                      inputs=list(patient[tp].native.values()),
+                                      outputs=first_stage_outputs(patient, tp),
+                                      params=stage_options(patient, _first_stage_options)).name)
 
         print('First stage finished!')
 
-        patient.write(patient.pickle)  # copy new images in the pickle
-
-        jobs=[]
+        if not dry_run:
+            patient.write(patient.pickle)  # copy new images in the pickle
 
         if len(tps) == 1:
             for tp in tps:
-                runTimePoint_SecondStage( tp, patient, patient.vbm_options  )
+                wf.stage(tp+'/second', runTimePoint_SecondStage, args=(tp, patient, patient.vbm_options),
+                         outputs=second_stage_outputs(patient, tp),
+                         params=stage_options(patient, _second_stage_options),
+                         deps=first)
         else:
             # create longitudinal template
             # ############################
             # it creates a new stx space (stx2) registering the linear template to the atlas
             # all images are aligned using this new template and the bias correction used in the template creation
 
-            pipeline_linearlngtemplate(patient)
+            wf.stage('linear_template', pipeline_linearlngtemplate, args=(patient,),
+                     outputs=linear_template_outputs(patient),
+                     params=stage_options(patient, _linear_template_options),
+                     deps=first)
 
-            for tp in tps:
-                jobs.append(futures.submit(runSkullStripping, tp , patient))
-            # wait for all jobs to finish
-            futures.wait(jobs, return_when=futures.ALL_COMPLETED)
+            skull=[]
+            with wf.parallel():
+                for tp in tps:
+                    skull.append(wf.stage(tp+'/skull', runSkullStripping, args=(tp , patient),
+                                          outputs=skull_stripping_outputs(patient, tp),
+                                          params=stage_options(patient, _skull_stripping_options),
+                                          deps=['linear_template']).name)
 
             # using the stx2 space, we do the non-linear template
             # ################################################
-            pipeline_lngtemplate(patient)
+            wf.stage('nonlinear_template', pipeline_lngtemplate, args=(patient,),
+                     outputs=nonlinear_template_outputs(patient),
+                     params=stage_options(patient, _template_options),
+                     deps=skull)
 
             # non-linear registration of the template to the atlas
             # ##########################
-            pipeline_atlasregistration(patient)
+            wf.stage('atlas_registration', pipeline_atlasregistration, args=(patient,),
+                     outputs=[patient.nl_xfm],
+                     params=stage_options(patient, _template_options),
+                     deps=['nonlinear_template'])
+            upstream=['atlas_registration']
 
             if len(patient.add)>0:
-                pipeline_run_add(patient)
+                # outputs depend on the configuration of additional steps,
+                # the stage is executed every time
+                wf.stage('add', pipeline_run_add, args=(patient,),
+                         params=stage_options(patient, _add_options),
+                         deps=upstream)
+                upstream=['add']
 
             # Concatenate xfm files for each timepoint.
             # run per tp tissue classification
-            jobs=[]
-            for tp in tps:
-                jobs.append(futures.submit(
-                    runTimePoint_ThirdStage, tp, patient
-                    ))
-            futures.wait(jobs, return_when=futures.ALL_COMPLETED)
+            third=[]
+            with wf.parallel():
+                for tp in tps:
+                    third.append(wf.stage(tp+'/third', runTimePoint_ThirdStage, args=(tp, patient),
+                                          outputs=third_stage_outputs(patient, tp),
+                                          params=stage_options(patient, _third_stage_options),
+                                          deps=upstream).name)
 
             # longitudinal classification
             # ############################
             if patient.dolngcls:
-                pipeline_lng_classification(patient)
+                wf.stage('lng_classification', pipeline_lng_classification, args=(patient,),
+                         outputs=lng_classification_outputs(patient),
+                         params=stage_options(patient, _third_stage_options),
+                         deps=third)
+                third=third+['lng_classification']
             else:
                 print(' -- Skipping Lng classification')
 
-            jobs=[]
-            for tp in tps:
-                jobs.append(futures.submit(runTimePoint_FourthStage, tp, patient, patient.vbm_options))
-            futures.wait(jobs, return_when=futures.ALL_COMPLETED)
+            with wf.parallel():
+                for tp in tps:
+                    wf.stage(tp+'/fourth', runTimePoint_FourthStage, args=(tp, patient, patient.vbm_options),
+                             outputs=fourth_stage_outputs(patient, tp),
+                             params=stage_options(patient, _fourth_stage_options),
+                             deps=third)
 
-        patient.write(patient.pickle)  # copy new images in the pickle
+        if dry_run:
+            print(wf.format_plan())
+        else:
+            patient.write(patient.pickle)  # copy new images in the pickle
 
         return patient.id
     except mincError as e:
@@ -924,6 +1059,14 @@ def parse_options():
         default=False,
         )
 
+    group.add_argument(
+        '--dry-run',
+        dest='dry_run',
+        help=' Only show which stages would be executed and the critical path estimate',
+        action='store_true',
+        default=False,
+        )
+
     group.add_argument(
         '-c',
         '--clean',
@@ -979,7 +1122,7 @@ def main():
             sys.exit(1)
         launchPipeline(opts)
     elif opts.pickle is not None:
-        runPipeline(opts.pickle,workdir=opts.workdir)
+        runPipeline(opts.pickle,workdir=opts.workdir,dry_run=opts.dry_run)
     else:
         print("missing something...")
         sys.exit(1)
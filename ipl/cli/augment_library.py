@@ -28,6 +28,8 @@ from ipl.minc_tools import mincTools,mincError
 from ipl.segment import *
 from ipl.segment.resample import *
 from ipl.segment.structures import *
+from ipl.segment.library_index import update_library_index
+from ipl import numpy_backend
 
 
 # scoop parallel execution
@@ -447,6 +449,12 @@ def main():
         #save_library_info(augmented_library, options.output)
         print("Saving to {}".format(options.output))
         augmented_library.save(options.output)
+        
+        # add new samples to the embedding index
+        try:
+            update_library_index(SegLibrary(options.output))
+        except numpy_backend.Unsupported as e:
+            print("Library index is not updated:{}".format(str(e)))
     else:
         print("Run with --help")
         
@@ -28,6 +28,7 @@ from ipl.minc_tools import mincTools,mincError
 
 # internal funcions
 from ipl.segment import *
+from ipl.segment.service import segment_remote
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -66,6 +67,21 @@ def parse_options():
                     help="Input mask",
                     dest='mask')
     
+    parser.add_argument('--batch',
+                    action="store_true",
+                    dest="batch",
+                    default=False,
+                    help="Segment a cohort: input is a csv file with id,scan[,mask[,add...]], output is a directory" )
+    
+    parser.add_argument('--server',
+                    help="Submit job to the segmentation service (Unix socket or [host:]port), instead of running locally",
+                    dest='server')
+    
+    parser.add_argument('--token',
+                    help="Token of the segmentation service, default is taken from IPL_SEGMENTATION_TOKEN",
+                    dest='token',
+                    default=os.environ.get('IPL_SEGMENTATION_TOKEN', None))
+    
     parser.add_argument('--debug', 
                     action="store_true",
                     dest="debug",
@@ -108,8 +124,28 @@ def parse_options():
 def main():
     options = parse_options()
     
+    if options.server is not None:
+        segmentation_parameters = None
+        if options.options is not None:
+            with open(options.options,'r') as f:
+                segmentation_parameters = yaml.safe_load(f)
+        info = segment_remote(options.server,
+                              token=options.token,
+                              input=os.path.abspath(options.input),
+                              output=os.path.abspath(options.output),
+                              mask=os.path.abspath(options.mask) if options.mask is not None else None,
+                              options=segmentation_parameters,
+                              presegment=os.path.abspath(options.presegment) if options.presegment is not None else None,
+                              work=os.path.abspath(options.work) if options.work is not None else None,
+                              variant_fuse=options.variant_fuse,
+                              variant_ec=options.variant_ec,
+                              variant_reg=options.variant_reg,
+                              cleanup=options.cleanup)
+        if info['status'] != 'done':
+            print("Segmentation {}:{}".format(info['status'], info.get('error')), file=sys.stderr)
+            exit(1)
         
-    if     options.library is not None \
+    elif   options.library is not None \
        and options.input is not None \
        and options.output is not None:
 
@@ -124,6 +160,16 @@ def main():
                 print("Error loading configuration:{}\n{}".format(options.options,sys.exc_info()[0]),file=sys.stderr)
                 traceback.print_exc(file=sys.stderr)
                 exit(1)
+        if options.batch:
+            fusion_segment_batch(load_subjects_csv(options.input), library,
+                       options.output,
+                       parameters=segmentation_parameters,
+                       debug=options.debug,
+                       fuse_variant=options.variant_fuse,
+                       ec_variant=options.variant_ec,
+                       regularize_variant=options.variant_reg,
+                       cleanup=options.cleanup)
+            return
         # 
         fusion_segment(options.input, library,
                        options.output,
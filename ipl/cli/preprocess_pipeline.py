@@ -90,6 +90,12 @@ def parse_options():
     parser.add_argument("--corr",
                         help="Distortion correct",
                         nargs="*")
+
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        dest="dry_run",
+                        default=False,
+                        help="Only show which stages would be executed and the critical path estimate")
     
     options = parser.parse_args()
 
@@ -199,7 +205,8 @@ def main():
                         output_dir, 
                         options=pipeline_parameters ,
                         work_dir=output_dir,
-                        manual_dir=manual_dir
+                        manual_dir=manual_dir,
+                        dry_run=options.dry_run
                     ))
             #
             # wait for all to finish
@@ -209,7 +216,8 @@ def main():
             for j,i in enumerate(run_pipeline):
                 inputs[j]['output']=i.result()
 
-            save_pipeline_output(inputs,options.output+os.sep+'summary.json')
+            if not options.dry_run:
+                save_pipeline_output(inputs,options.output+os.sep+'summary.json')
 
         elif options.scans   is not None and \
              options.subject is not None and \
@@ -255,7 +263,8 @@ def main():
                                output_dir, 
                                options=pipeline_parameters, 
                                work_dir=output_dir,
-                               manual_dir=manual_dir
+                               manual_dir=manual_dir,
+                               dry_run=options.dry_run
                              )
             # TODO: make a check if there is a summary file there already?
             #save_pipeline_output([info],options.output+os.sep+'summary.json')
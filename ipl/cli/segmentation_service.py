@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# @date 18/10/2026
+#
+# Run resident segmentation service
+
+from __future__ import print_function
+
+import os
+import sys
+import traceback
+import argparse
+
+import yaml
+
+# internal funcions
+from ipl.segment.service import run_service
+
+# scoop parallel execution
+from scoop import futures, shared
+
+def parse_options():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                 description='Run fusion segmentation service, keeping library loaded')
+    
+    parser.add_argument('--library',
+                    help="Segmentation library",
+                    dest='library',
+                    required=True)
+    
+    parser.add_argument('--options',
+                    help="Default segmentation options in yaml format, jobs can override them",
+                    dest='options')
+    
+    parser.add_argument('--listen',
+                    help="Unix socket path or [host:]port for HTTP requests, default is a private Unix socket",
+                    dest='listen',
+                    default=None)
+    
+    parser.add_argument('--token',
+                    help="Token clients have to present, required for TCP, default is taken from IPL_SEGMENTATION_TOKEN",
+                    dest='token',
+                    default=os.environ.get('IPL_SEGMENTATION_TOKEN', None))
+    
+    parser.add_argument('--allow_dir',
+                    help="Directory where jobs can write outputs, can be repeated, default is the current directory",
+                    dest='allow_dir',
+                    action='append',
+                    default=None)
+    
+    parser.add_argument('--debug', 
+                    action="store_true",
+                    dest="debug",
+                    default=False,
+                    help='Print debugging information' )
+    
+    options = parser.parse_args()
+    
+    if options.debug:
+        print(repr(options))
+    
+    return options
+
+
+def main():
+    options = parse_options()
+    segmentation_parameters = {}
+
+    if options.options is not None:
+        try:
+            with open(options.options,'r') as f:
+                segmentation_parameters = yaml.safe_load(f)
+        except :
+            print("Error loading configuration:{}\n{}".format(options.options,sys.exc_info()[0]),file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            exit(1)
+    
+    run_service(options.library, options.listen, parameters=segmentation_parameters,
+                token=options.token, allowed_dirs=options.allow_dir)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
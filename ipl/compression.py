@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Compression policy for MINC files written by external commands
+#
+# Temporary and cache files are written with a fast (or no) compression,
+# final outputs with the normal one. The level is passed to each command
+# through MINC_COMPRESS environment variable, depending on where its outputs
+# go: a file inside a directory managed by temp_files or cache_files is
+# temporary, anything else is final. Such directories are marked with a
+# file (.ipl_temp), so that other processes, i.e scoop workers writing into
+# temporary directory of the parent job, recognize them. Defaults are taken from environment:
+#
+#   IPL_COMPRESS_TEMP   level for temporary files, default 0
+#   IPL_COMPRESS_FINAL  level for final outputs, default is MINC_COMPRESS
+#                       or library default if it is not set
+#   IPL_COMPRESS_STAGES per-stage overrides: <stage pattern>=<temp>:<final>
+#                       separated by commas, i.e
+#                       'ipl.model.*=0:1,*nonlinear_template*=:2'
+#                       empty level keeps the default, stage is the label
+#                       used for tracing (see ipl.profile)
+#
+# Run
+#    python -m ipl.compression <file.mnc> ...
+# to measure write and read throughput of each compression level
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import fnmatch
+import tempfile
+import threading
+import subprocess
+import argparse
+import contextlib
+
+from . import profile
+
+_local = threading.local()
+_temp_dirs = set()
+_policy = None
+
+# extensions of outputs which are (or refer to) MINC volumes
+_minc_ext = ('.mnc', '.xfm')
+
+# marker of temporary directories, visible to other processes
+_marker = '.ipl_temp'
+
+
+def _level(v):
+    if v is None or str(v).strip() == '':
+        return None
+    v = int(v)
+    if v < 0 or v > 9:
+        raise ValueError('Compression level should be between 0 and 9:{}'.format(v))
+    return v
+
+
+def parse_stages(spec):
+    """parse per-stage overrides, returns list of (pattern,temp,final)"""
+    stages = []
+    if not spec:
+        return stages
+    for i in spec.split(','):
+        i = i.strip()
+        if not i:
+            continue
+        (pattern, levels) = i.rsplit('=', 1)
+        (temp, final) = (levels.split(':', 1) + [''])[0:2]
+        stages.append((pattern.strip(), _level(temp), _level(final)))
+    return stages
+
+
+def configure(temp=None, final=None, stages=None):
+    """set compression policy for this process, arguments not given
+    are taken from environment"""
+    global _policy
+    _policy = {
+        'temp':   _level(temp) if temp is not None else
+                  _level(os.environ.get('IPL_COMPRESS_TEMP', '0')),
+        'final':  _level(final) if final is not None else
+                  _level(os.environ.get('IPL_COMPRESS_FINAL',
+                                        os.environ.get('MINC_COMPRESS', None))),
+        'stages': list(stages) if stages is not None else
+                  parse_stages(os.environ.get('IPL_COMPRESS_STAGES', None)),
+    }
+
+
+def _get_policy():
+    if _policy is None:
+        configure()
+    return _policy
+
+
+@contextlib.contextmanager
+def policy(temp=None, final=None):
+    """override compression levels for commands executed inside the context
+    (in this thread)"""
+    prev = getattr(_local, 'override', None)
+    _local.override = (_level(temp), _level(final))
+    try:
+        yield
+    finally:
+        _local.override = prev
+
+
+def register_temp_dir(path):
+    """files written inside path are considered temporary, by all
+    processes"""
+    _temp_dirs.add(os.path.abspath(path) + os.sep)
+    try:
+        open(os.path.join(path, _marker), 'a').close()
+    except (IOError, OSError):
+        # read-only directory, known to this process only
+        pass
+
+
+def unregister_temp_dir(path):
+    _temp_dirs.discard(os.path.abspath(path) + os.sep)
+    try:
+        os.unlink(os.path.join(path, _marker))
+    except OSError:
+        # directory is already removed
+        pass
+
+
+def is_temp(path):
+    """check if file is in one of the temporary directories, registered
+    in this process or marked by another one"""
+    p = os.path.abspath(path)
+    if any(p.startswith(d) for d in list(_temp_dirs)):
+        return True
+    d = os.path.dirname(p)
+    while True:
+        if os.path.exists(os.path.join(d, _marker)):
+            return True
+        parent = os.path.dirname(d)
+        if parent == d:
+            return False
+        d = parent
+
+
+def level(outputs, stage=None):
+    """compression level for a command writing outputs, None if
+    there is no MINC output or the level is not defined"""
+    if outputs is None:
+        return None
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    outputs = [str(i) for i in outputs if str(i).endswith(_minc_ext)]
+    if not outputs:
+        return None
+    kind = 'temp' if all(is_temp(i) for i in outputs) else 'final'
+    p = _get_policy()
+    v = p[kind]
+    if p['stages']:
+        if stage is None:
+            stage = profile.current_stage()
+        for (pattern, temp, final) in p['stages']:
+            if fnmatch.fnmatch(stage, pattern):
+                _v = temp if kind == 'temp' else final
+                if _v is not None:
+                    v = _v
+                break
+    override = getattr(_local, 'override', None)
+    if override is not None:
+        _v = override[0] if kind == 'temp' else override[1]
+        if _v is not None:
+            v = _v
+    return v
+
+
+def env(outputs, stage=None):
+    """environment for a command writing outputs, None if it doesn't
+    have to be changed"""
+    v = level(outputs, stage=stage)
+    if v is None or os.environ.get('MINC_COMPRESS', None) == str(v):
+        return None
+    _env = os.environ.copy()
+    _env['MINC_COMPRESS'] = str(v)
+    return _env
+
+
+def command_env(cmds, outputs=None):
+    """environment of a child process running cmds, see env. If outputs
+    are not known, MINC files in the command line which don't exist yet
+    are assumed to be outputs"""
+    if outputs is None and isinstance(cmds, list):
+        outputs = [i for i in cmds[1:] if isinstance(i, str)
+                   and i.endswith(_minc_ext) and not os.path.exists(i)]
+    return env(outputs)
+
+
+def _timed(cmds, env=None):
+    t0 = time.time()
+    with open(os.devnull, "w") as fnull:
+        subprocess.check_call(cmds, stdout=fnull, env=env)
+    return time.time() - t0
+
+
+def benchmark(volumes, levels=(0, 1, 2, 4, 9), repeat=3, tmpdir=None):
+    """measure write and read throughput of compression levels
+
+    returns list of dicts with level, size (bytes), ratio (relative to
+    uncompressed size), write and read throughput (MB of uncompressed data
+    per second, best of repeat runs)
+    """
+    work = tempfile.mkdtemp(prefix='iplCompress', dir=tmpdir)
+    results = []
+    try:
+        for v in volumes:
+            sizes = {}
+            for l in levels:
+                out = os.path.join(work, 'bench_{}.mnc'.format(l))
+                _env = os.environ.copy()
+                _env['MINC_COMPRESS'] = str(l)
+                write = min(_timed(['mincconvert', '-2', '-clobber', '-compress', str(l), v, out],
+                                   env=_env) for r in range(repeat))
+                read = min(_timed(['minctoraw', '-nonormalize', out])
+                           for r in range(repeat))
+                sizes[l] = os.path.getsize(out)
+                results.append({'volume': v, 'level': l, 'size': sizes[l],
+                                'write': write, 'read': read})
+                os.unlink(out)
+            # uncompressed size is the reference
+            ref = sizes.get(0, max(sizes.values()))
+            for r in results:
+                if r['volume'] == v:
+                    r['ratio'] = float(ref) / r['size']
+                    r['write_mbs'] = ref / 1048576.0 / max(r['write'], 1e-6)
+                    r['read_mbs'] = ref / 1048576.0 / max(r['read'], 1e-6)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def format_benchmark(results):
+    out = ["{:<40} {:>5} {:>10} {:>6} {:>10} {:>10}".format(
+        'volume', 'level', 'size,MB', 'ratio', 'write,MB/s', 'read,MB/s')]
+    for r in results:
+        out.append("{:<40} {:>5} {:>10.1f} {:>6.2f} {:>10.1f} {:>10.1f}".format(
+            os.path.basename(r['volume'])[-40:], r['level'], r['size'] / 1048576.0,
+            r['ratio'], r['write_mbs'], r['read_mbs']))
+    return "\n".join(out)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Measure throughput of MINC compression levels')
+
+    parser.add_argument('volumes',
+                        nargs='+',
+                        help="Sample minc volumes")
+
+    parser.add_argument('--levels',
+                        type=int,
+                        nargs='+',
+                        default=[0, 1, 2, 4, 9],
+                        help="Compression levels to test")
+
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=3,
+                        help="Number of runs, the best time is reported")
+
+    parser.add_argument('--tmpdir',
+                        default=None,
+                        help="Directory for test files, i.e on the file system used for processing")
+
+    return parser.parse_args()
+
+
+def main():
+    options = parse_options()
+    print(format_benchmark(benchmark(options.volumes, levels=options.levels,
+                                     repeat=options.repeat, tmpdir=options.tmpdir)))
+
+
+if __name__ == '__main__':
+    main()
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
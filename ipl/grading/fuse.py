@@ -14,6 +14,7 @@ import json
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl.workflow import run_forced, rerun_forced
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -574,7 +575,7 @@ def fusion_grading( input_scan,
         for (i,j) in enumerate(selected_library):
             # TODO: make clever usage of precomputed transform if available
             if pairwise_register_type=='elx' or pairwise_register_type=='elastix' :
-                results.append( futures.submit(
+                results.append( futures.submit(run_forced, rerun_forced(),
                     elastix_registration, 
                     bbox_sample,
                     selected_library_scan[i],
@@ -589,7 +590,7 @@ def fusion_grading( input_scan,
                     resample_baa=resample_baa
                     ) )
             elif pairwise_register_type=='ants' or do_pairwise_ants:
-                results.append( futures.submit(
+                results.append( futures.submit(run_forced, rerun_forced(),
                     non_linear_registration, 
                     bbox_sample,
                     selected_library_scan[i],
@@ -604,7 +605,7 @@ def fusion_grading( input_scan,
                     resample_baa=resample_baa
                     ) )
             else:
-                results.append( futures.submit(
+                results.append( futures.submit(run_forced, rerun_forced(),
                     non_linear_registration, 
                     bbox_sample,
                     selected_library_scan[i],
@@ -623,7 +624,7 @@ def fusion_grading( input_scan,
             for (i,j) in enumerate(selected_library_f):
                 # TODO: make clever usage of precomputed transform if available
                 if pairwise_register_type=='elx' or pairwise_register_type=='elastix' :
-                    results.append( futures.submit(
+                    results.append( futures.submit(run_forced, rerun_forced(),
                         elastix_registration, 
                         bbox_sample,
                         selected_library_scan_f[i],
@@ -639,7 +640,7 @@ def fusion_grading( input_scan,
                         resample_baa=resample_baa
                         ) )
                 elif pairwise_register_type=='ants' or do_pairwise_ants:
-                    results.append( futures.submit(
+                    results.append( futures.submit(run_forced, rerun_forced(),
                         non_linear_registration, 
                         bbox_sample,
                         selected_library_scan_f[i],
@@ -655,7 +656,7 @@ def fusion_grading( input_scan,
                         resample_baa=resample_baa
                         ) )
                 else:
-                    results.append( futures.submit(
+                    results.append( futures.submit(run_forced, rerun_forced(),
                         non_linear_registration, 
                         bbox_sample,
                         selected_library_scan_f[i],
@@ -682,7 +683,7 @@ def fusion_grading( input_scan,
             if library_nl_samples_avail:
                 lib_xfm=selected_library_xfm[i]
                 
-            results.append( futures.submit( 
+            results.append( futures.submit(run_forced, rerun_forced(),
                 concat_resample,
                  selected_library_scan[i],
                  lib_xfm ,
@@ -699,7 +700,7 @@ def fusion_grading( input_scan,
                 if library_nl_samples_avail:
                     lib_xfm=selected_library_xfm_f[i]
 
-                results.append( futures.submit(
+                results.append( futures.submit(run_forced, rerun_forced(),
                     concat_resample,
                     selected_library_scan_f[i],
                     lib_xfm,
@@ -718,7 +719,7 @@ def fusion_grading( input_scan,
     sample_seg=MriDataset(name='bbox_seg_' + sample.name+out_variant, prefix=work_dir )
     sample_grad=MriDataset(name='bbox_grad_' + sample.name+out_variant, prefix=work_dir )
     
-    results.append( futures.submit(
+    results.append( futures.submit(run_forced, rerun_forced(),
         fuse_grading,
         bbox_sample,
         sample_seg,
@@ -733,7 +734,7 @@ def fusion_grading( input_scan,
         ))
 
     if segment_symmetric:
-        results.append( futures.submit(
+        results.append( futures.submit(run_forced, rerun_forced(),
             fuse_grading,
             bbox_sample,
             sample_seg,
@@ -14,6 +14,7 @@ import json
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl.workflow import run_forced, rerun_forced
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -45,7 +46,7 @@ def preselect(sample,
         column=6+lib_add_n
         
     for (i,j) in enumerate(library):
-        results.append( futures.submit(
+        results.append( futures.submit(run_forced, rerun_forced(),
             calculate_similarity, sample, MriDataset(scan=j[column]), method=method, mask=mask, flip=flip, step=step
             ) )
     futures.wait(results, return_when=futures.ALL_COMPLETED)
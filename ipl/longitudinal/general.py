@@ -14,6 +14,8 @@ import subprocess
 from shutil import rmtree
 import tempfile
 
+from ipl.workflow import rerun_forced
+
 
 # hack to make it work on Python 3
 try:
@@ -208,6 +210,10 @@ def checkfiles(
                     if timer < itime or itime < 0:
                         itime = timer
 
+  # stage is out of date, existing outputs are stale
+    if rerun_forced():
+        return True
+
   # Check if outputs exist AND is newer than inputs
 
     outExists = False
@@ -15,6 +15,7 @@ import traceback
 
 from ipl.model.generate_linear             import generate_linear_model
 from ipl.minc_tools import mincTools,mincError
+from ipl.workflow   import run_forced, rerun_forced
 
 import ipl.registration
 #import ipl.ants_registration
@@ -302,7 +303,7 @@ def linearlngtemplate_v11(patient):
             if patient.dobiascorr:
                 biascorr=output['biascorr'][k]
             # Here we are relying on the time point order (1) - see above
-            jobs.append(futures.submit(post_process, patient, i, tp, output['xfm'][k], biascorr, rigid=patient.rigid))
+            jobs.append(futures.submit(run_forced, rerun_forced(), post_process, patient, i, tp, output['xfm'][k], biascorr, rigid=patient.rigid))
 
             k+=1
         # wait for all substeps to finish
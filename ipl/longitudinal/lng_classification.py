@@ -62,11 +62,11 @@ def create_prior(priors,masks,outs,fwhm=8.0):
             bkg = minc.tmp("bkg_{}.mnc".format(i))
         
             if len(outs)==4:
-                minc.calc([priors[i],masks[i]],'if(A[0]<0.5 && A[1]>0.5){1}else{0}', bkg)
+                minc.submit(minc.calc,[priors[i],masks[i]],'if(A[0]<0.5 && A[1]>0.5){1}else{0}', bkg)
             
-            minc.calc([priors[i]],'A[0]>0.5&&A[0]<1.5?1:0',csf,labels=True)
-            minc.calc([priors[i]],'A[0]>1.5&&A[0]<2.5?1:0',gm ,labels=True)
-            minc.calc([priors[i]],'A[0]>2.5&&A[0]<3.5?1:0',wm ,labels=True)
+            minc.submit(minc.calc,[priors[i]],'A[0]>0.5&&A[0]<1.5?1:0',csf,labels=True)
+            minc.submit(minc.calc,[priors[i]],'A[0]>1.5&&A[0]<2.5?1:0',gm ,labels=True)
+            minc.submit(minc.calc,[priors[i]],'A[0]>2.5&&A[0]<3.5?1:0',wm ,labels=True)
             
             wms.append(wm)
             gms.append(gm)
@@ -80,22 +80,24 @@ def create_prior(priors,masks,outs,fwhm=8.0):
         ave_csf=minc.tmp("average_csf.mnc")
         ave_bkg=minc.tmp("average_bkg.mnc")
         
-        minc.average(wms, ave_wm, datatype='-float')
-        minc.average(gms, ave_gm, datatype='-float')
-        minc.average(csfs,ave_csf,datatype='-float')
+        # averages wait for the splits they depend on
+        minc.submit(minc.average,wms, ave_wm, datatype='-float')
+        minc.submit(minc.average,gms, ave_gm, datatype='-float')
+        minc.submit(minc.average,csfs,ave_csf,datatype='-float')
         
         if len(outs)==4:
-            minc.average(bkgs,ave_bkg,datatype='-float')
+            minc.submit(minc.average,bkgs,ave_bkg,datatype='-float')
 
         ## Option A: Use directly the blurring
         usebkg=0
         if len(outs)==4:
-            minc.blur(ave_bkg,outs[0],fwhm=fwhm)
+            minc.submit(minc.blur,ave_bkg,outs[0],fwhm=fwhm)
             usebkg=1
 
-        minc.blur(ave_wm, outs[2+usebkg],fwhm=fwhm)
-        minc.blur(ave_gm, outs[1+usebkg],fwhm=fwhm)
-        minc.blur(ave_csf,outs[0+usebkg],fwhm=fwhm)
+        minc.submit(minc.blur,ave_wm, outs[2+usebkg],fwhm=fwhm)
+        minc.submit(minc.blur,ave_gm, outs[1+usebkg],fwhm=fwhm)
+        minc.submit(minc.blur,ave_csf,outs[0+usebkg],fwhm=fwhm)
+        minc.gather()
         print("created {}".format(repr(outs)))
 
 # pipeline_classify_prior.pl --mask /export01/data/vfonov/src1/nihpd_pipeline/validation_dataset/test_n4//subject04/1/stx2/stx2_subject04_1_mask.mnc \
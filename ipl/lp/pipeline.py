@@ -13,6 +13,7 @@ import traceback
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError,temp_files
+from ipl.workflow   import Workflow
 
 #Hippocampus segmentation
 from ..segment.fuse import fusion_segment
@@ -446,11 +447,74 @@ default_pipeline_options = {
                 'ibis_output': False # export files for IBIS
             }
 
+def warp_nu_correct(sample, reference, output_scan, output_field,
+                    transform=None, corr_xfm=None, parameters={},
+                    nuc_parameters={}, apply_parameters={},
+                    clp_parameters={}, clp_model=None):
+    """warp scan into stereotaxic space, then correct non-uniformity and
+    normalize intensity there"""
+    with temp_files() as tmp:
+        tmp_=MriScan(prefix=tmp.tempdir, name=output_scan.name, modality=output_scan.modality, mask=None)
+        tmp_n4=MriScan(prefix=tmp.tempdir, name=output_scan.name+'_n4', modality=output_scan.modality, mask=None)
+
+        warp_scan(sample, reference, tmp_,
+                  transform=transform,
+                  corr_xfm=corr_xfm,
+                  parameters=parameters)
+
+        estimate_nu(tmp_, output_field, parameters=nuc_parameters)
+
+        apply_nu(tmp_, output_field, tmp_n4, parameters=apply_parameters)
+
+        #TODO: maybe apply region-based intensity normalization here?
+        normalize_intensity(tmp_n4, output_scan,
+                            parameters=clp_parameters,
+                            model=clp_model)
+
+
+def extract_cortex_surface(scan, masked, surface):
+    with mincTools(verbose=2) as minc:
+        #start with t1w_tal_noscale
+        #mincmask t1w_tal_noscale.mnc t1w_tal_noscale_mask.mnc t1w_tal_noscale_masked.mnc
+        minc.command(['mincmask','-clobber',scan.scan,scan.mask,masked.scan])
+        #marching_cubes t1w_tal_noscale_masked.mnc cortex.obj 45
+        minc.command(['marching_cubes',masked.scan,surface.fname,'45'])
+        #ascii_binary cortex.obj
+        minc.command(['ascii_binary', surface.fname])
+
+
+def extract_skin_surface(scan, surface):
+    with mincTools(verbose=2) as minc:
+        #start with t1w_tal_noscale, then blur it.
+        tmpname = minc.tmp('tmp_t1_noscaled')
+        minc.command(['mincblur','-clobber','-fwhm','2', scan.scan,tmpname])
+        #marching_cubes t1w_tal_noscale_masked.mnc skin.obj 30
+        minc.command(['marching_cubes',tmpname+'_blur.mnc',surface.fname,'30'])
+        #ascii_binary cortex.obj
+        minc.command(['ascii_binary', surface.fname])
+
+
+def extract_hippocampus_surface(scan, surface):
+    with mincTools(verbose=2) as minc:
+        #start with t1w_tal_noscale and then segment hippocampus
+        tmp_work = minc.tmp('tmp_work')
+        tmp_output = minc.tmp('tmp_output')
+        fusion_segment(input_scan= scan.scan,
+                    library_description='/data/ipl/scratch08/vfonov/adni_jens/jens_hc_lib_20170621/library.json',
+                    output_segment=tmp_output,
+                    parameters='/data/ipl/scratch08/vfonov/adni_jens/jens_hc_segment_20170621.json',
+                    work_dir=tmp_work,
+                    cleanup = True)
+        minc.command(['marching_cubes',tmp_output+'_seg.mnc',surface.fname,'0'])
+        minc.command(['ascii_binary', surface.fname])
+
+
 def standard_pipeline(info,
                       output_dir,
                       options =None,
                       work_dir=None,
-                      manual_dir=None):
+                      manual_dir=None,
+                      dry_run=False):
     """
     drop-in replacement for the standard pipeline
 
@@ -459,6 +523,8 @@ def standard_pipeline(info,
 
     Kyword arguments:
             work_dir string pointing to work directory , default None - use output_dir
+            dry_run only print which stages would be executed and the
+                    estimate of the critical path, based on previous runs
     """
     try:
         with temp_files() as tmp:
@@ -653,9 +719,16 @@ def standard_pipeline(info,
                         }
 
             # actual processing steps
+            # each step is a stage of the workflow, it is executed again
+            # only if its inputs or parameters were changed
+            wf=Workflow(work_dir+os.sep+'workflow_'+dataset_id+'.json', dry_run=dry_run)
+
             # 1. preprocessing
             if denoise_parameters is not None:
-                denoise(t1w_scan, t1w_den, parameters=denoise_parameters)
+                wf.stage('denoise', denoise, args=(t1w_scan, t1w_den),
+                         kwargs={'parameters':denoise_parameters},
+                         inputs=[t1w_scan.scan, t1w_scan.mask],
+                         outputs=[t1w_den.scan])
                 t1w_den.mask=t1w_scan.mask
             else:
                 t1w_den=t1w_scan
@@ -666,19 +739,26 @@ def standard_pipeline(info,
                 # non-uniformity correction
                 print("Running N4")
 
-                estimate_nu(t1w_den, t1w_field,
-                            parameters=nuc_parameters,
-                            model=model_t1w)
+                wf.stage('nuc', estimate_nu, args=(t1w_den, t1w_field),
+                         kwargs={'parameters':nuc_parameters, 'model':model_t1w},
+                         inputs=[t1w_den.scan, t1w_den.mask, model_t1w.scan, model_t1w.mask],
+                         outputs=[t1w_field.scan])
                 if run_qc is not None and run_qc.get('nu',False):
-                    draw_qc_nu(t1w_field,qc_nu,options=run_qc)
+                    wf.stage('qc_nu', draw_qc_nu, args=(t1w_field,qc_nu),
+                             kwargs={'options':run_qc},
+                             inputs=[t1w_field.scan], outputs=[qc_nu.fname])
                     iter_summary["qc_nu"]=qc_nu
                 if run_aqc is not None and run_aqc.get('nu',False):
-                    make_aqc_nu(t1w_field,aqc_nu,options=run_aqc)
+                    wf.stage('aqc_nu', make_aqc_nu, args=(t1w_field,aqc_nu),
+                             kwargs={'options':run_aqc},
+                             inputs=[t1w_field.scan])
                     iter_summary["aqc_nu"]=aqc_nu
 
                 # apply field
-                apply_nu(t1w_den, t1w_field, t1w_nuc,
-                        parameters=nuc_parameters)
+                wf.stage('apply_nu', apply_nu, args=(t1w_den, t1w_field, t1w_nuc),
+                         kwargs={'parameters':nuc_parameters},
+                         inputs=[t1w_den.scan, t1w_field.scan],
+                         outputs=[t1w_nuc.scan])
                 t1w_nuc.mask=t1w_den.mask
             else:
                 t1w_nuc=t1w_den
@@ -691,9 +771,10 @@ def standard_pipeline(info,
             # normalize intensity
 
             if clp_parameters is not None:
-                normalize_intensity(t1w_nuc, t1w_clp,
-                                    parameters=options.get('t1w_clp',{}),
-                                    model=model_t1w)
+                wf.stage('clp', normalize_intensity, args=(t1w_nuc, t1w_clp),
+                         kwargs={'parameters':options.get('t1w_clp',{}), 'model':model_t1w},
+                         inputs=[t1w_nuc.scan, t1w_nuc.mask, model_t1w.scan, model_t1w.mask],
+                         outputs=[t1w_clp.scan])
                 t1w_clp.mask=t1w_nuc.mask
             else:
                 t1w_clp=t1w_nuc
@@ -757,7 +838,10 @@ def standard_pipeline(info,
 
                     # denoising
                     if add_denoise_parameters is not None:
-                        denoise(c, den, parameters=add_denoise_parameters)
+                        wf.stage(c.modality+'_denoise', denoise, args=(c, den),
+                                 kwargs={'parameters':add_denoise_parameters},
+                                 inputs=[c.scan, c.mask],
+                                 outputs=[den.scan])
                         iter_summary["add_den"].append(den)
                         den.mask=c.mask # maybe transfer mask from t1w ?
                     else:
@@ -765,15 +849,25 @@ def standard_pipeline(info,
 
                     # non-uniformity correction
                     if add_nuc_parameters is not None:
-                        estimate_nu(den, field, parameters=add_nuc_parameters,model=add_model)
+                        wf.stage(c.modality+'_nuc', estimate_nu, args=(den, field),
+                                 kwargs={'parameters':add_nuc_parameters, 'model':add_model},
+                                 inputs=[den.scan, den.mask, add_model.scan, add_model.mask],
+                                 outputs=[field.scan])
                         if run_qc is not None and run_qc.get('nu',False):
-                            draw_qc_nu(field,add_qc_nu,options=run_qc)
+                            wf.stage(c.modality+'_qc_nu', draw_qc_nu, args=(field,add_qc_nu),
+                                     kwargs={'options':run_qc},
+                                     inputs=[field.scan], outputs=[add_qc_nu.fname])
                             iter_summary["qc_nu_"+c.modality]=add_qc_nu
                         if run_aqc is not None and run_aqc.get('nu',False):
-                            make_aqc_nu(field,add_aqc_nu,options=run_aqc)
+                            wf.stage(c.modality+'_aqc_nu', make_aqc_nu, args=(field,add_aqc_nu),
+                                     kwargs={'options':run_aqc},
+                                     inputs=[field.scan])
                             iter_summary["aqc_nu_"+c.modality]=add_aqc_nu
                         # apply field
-                        apply_nu(den, field, nuc, parameters=add_nuc_parameters)
+                        wf.stage(c.modality+'_apply_nu', apply_nu, args=(den, field, nuc),
+                                 kwargs={'parameters':add_nuc_parameters},
+                                 inputs=[den.scan, field.scan],
+                                 outputs=[nuc.scan])
                         nuc.mask=den.mask
                     else:
                         nuc=den
@@ -783,9 +877,10 @@ def standard_pipeline(info,
                     iter_summary["add_nuc"].append(nuc)
 
                     if add_clp_parameters is not None:
-                        normalize_intensity(nuc, clp,
-                                    parameters=add_clp_parameters,
-                                    model=add_model)
+                        wf.stage(c.modality+'_clp', normalize_intensity, args=(nuc, clp),
+                                 kwargs={'parameters':add_clp_parameters, 'model':add_model},
+                                 inputs=[nuc.scan, nuc.mask, add_model.scan, add_model.mask],
+                                 outputs=[clp.scan])
                         clp.mask=nuc.mask
                     else:
                         clp=nuc
@@ -795,13 +890,19 @@ def standard_pipeline(info,
                     # co-registering to T1w
                     if add_stx_parameters.get('independent',True) or (prev_co_xfm is None):
                         # run co-registration unless another one can be used
-                        intermodality_co_registration(clp, t1w_clp, co_xfm,
-                                        parameters=add_stx_parameters,
-                                        corr_xfm=corr_xfm,
-                                        corr_ref=corr_t1w,
-                                        par=co_par,
-                                        log=co_log,
-                                        init_xfm=manual_co_xfm )
+                        wf.stage(c.modality+'_co', intermodality_co_registration,
+                                 args=(clp, t1w_clp, co_xfm),
+                                 kwargs={'parameters':add_stx_parameters,
+                                         'corr_xfm':corr_xfm,
+                                         'corr_ref':corr_t1w,
+                                         'par':co_par,
+                                         'log':co_log,
+                                         'init_xfm':manual_co_xfm},
+                                 inputs=[clp.scan, clp.mask, t1w_clp.scan, t1w_clp.mask,
+                                         corr_xfm.xfm if corr_xfm is not None else None,
+                                         corr_t1w.xfm if corr_t1w is not None else None,
+                                         manual_co_xfm.xfm if manual_co_xfm is not None else None],
+                                 outputs=[co_xfm.xfm])
                         prev_co_xfm=co_xfm
                     else:
                         co_xfm=prev_co_xfm
@@ -810,45 +911,43 @@ def standard_pipeline(info,
 
             if not stx_disable:
                 # register to STX space
-                lin_registration(t1w_clp, model_t1w, t1w_tal_xfm,
-                                parameters=stx_parameters,
-                                corr_xfm=corr_t1w,
-                                par=t1w_tal_par,
-                                log=t1w_tal_log,
-                                init_xfm=init_t1w_lin_xfm)
+                wf.stage('stx', lin_registration, args=(t1w_clp, model_t1w, t1w_tal_xfm),
+                         kwargs={'parameters':stx_parameters,
+                                 'corr_xfm':corr_t1w,
+                                 'par':t1w_tal_par,
+                                 'log':t1w_tal_log,
+                                 'init_xfm':init_t1w_lin_xfm},
+                         inputs=[t1w_clp.scan, t1w_clp.mask, model_t1w.scan, model_t1w.mask,
+                                 corr_t1w.xfm if corr_t1w is not None else None,
+                                 init_t1w_lin_xfm.xfm if init_t1w_lin_xfm is not None else None],
+                         outputs=[t1w_tal_xfm.xfm])
 
                 stx_nuc = stx_parameters.get('nuc',None)
                 stx_clp = stx_parameters.get('clp',None)
 
                 if stx_nuc is not None:
-                    tmp_t1w=MriScan(prefix=tmp.tempdir,    name='tal_'+dataset_id, modality='t1w')
-                    tmp_t1w_n4=MriScan(prefix=tmp.tempdir, name='tal_n4_'+dataset_id, modality='t1w')
-
-                    warp_scan(t1w_clp ,model_t1w, tmp_t1w,
-                            transform=t1w_tal_xfm,
-                            corr_xfm=corr_t1w,
-                            parameters=stx_parameters)
-                    tmp_t1w.mask=None
-                    tmp_t1w_n4.mask=None
-
-                    estimate_nu(tmp_t1w, t1w_tal_fld,
-                                parameters=stx_nuc)
-
-                    apply_nu(tmp_t1w, t1w_tal_fld, tmp_t1w_n4,
-                            parameters=stx_nuc)
-
-                    #TODO: maybe apply region-based intensity normalization here?
-                    normalize_intensity(tmp_t1w_n4, t1w_tal,
-                                    parameters=stx_clp,
-                                    model=model_t1w)
+                    wf.stage('stx_warp', warp_nu_correct, args=(t1w_clp, model_t1w, t1w_tal, t1w_tal_fld),
+                             kwargs={'transform':t1w_tal_xfm,
+                                     'corr_xfm':corr_t1w,
+                                     'parameters':stx_parameters,
+                                     'nuc_parameters':stx_nuc,
+                                     'apply_parameters':stx_nuc,
+                                     'clp_parameters':stx_clp,
+                                     'clp_model':model_t1w},
+                             inputs=[t1w_clp.scan, model_t1w.scan, t1w_tal_xfm.xfm,
+                                     corr_t1w.xfm if corr_t1w is not None else None],
+                             outputs=[t1w_tal.scan, t1w_tal_fld.scan])
 
                     iter_summary['t1w_tal_fld']=t1w_tal_fld
 
                 else:
-                    warp_scan(t1w_clp,model_t1w, t1w_tal,
-                            transform=t1w_tal_xfm,
-                            corr_xfm=corr_t1w,
-                            parameters=options.get('t1w_stx',{}))
+                    wf.stage('stx_warp', warp_scan, args=(t1w_clp, model_t1w, t1w_tal),
+                             kwargs={'transform':t1w_tal_xfm,
+                                     'corr_xfm':corr_t1w,
+                                     'parameters':options.get('t1w_stx',{})},
+                             inputs=[t1w_clp.scan, model_t1w.scan, t1w_tal_xfm.xfm,
+                                     corr_t1w.xfm if corr_t1w is not None else None],
+                             outputs=[t1w_tal.scan])
 
 
                 if add_scans is not None:
@@ -879,7 +978,9 @@ def standard_pipeline(info,
                         tal_fld=MriScan(prefix=tal_dir, name='tal_fld_'+dataset_id, modality=c.modality)
                         tal=MriScan(prefix=tal_dir, name='tal_'+dataset_id, modality=c.modality)
 
-                        xfm_concat( [xfm,t1w_tal_xfm], stx_xfm )
+                        wf.stage(c.modality+'_stx', xfm_concat, args=([xfm,t1w_tal_xfm], stx_xfm),
+                                 inputs=[xfm.xfm, t1w_tal_xfm.xfm],
+                                 outputs=[stx_xfm.xfm])
                         iter_summary["add_stx_xfm"].append(stx_xfm)
 
                         corr_xfm=None
@@ -887,39 +988,35 @@ def standard_pipeline(info,
                             corr_xfm=corr_add[i]
 
                         if add_stx_nuc is not None:
-                            tmp_=MriScan(prefix=tmp.tempdir,   name='tal_'+dataset_id, modality=c.modality)
-                            tmp_n4=MriScan(prefix=tmp.tempdir, name='tal_n4_'+dataset_id, modality=c.modality)
-
-                            warp_scan(clp ,model_t1w, tmp_,
-                                    transform=stx_xfm,
-                                    corr_xfm=corr_xfm,
-                                    parameters=add_stx_parameters)
-
-                            tmp_.mask=None
-                            tmp_n4.mask=None
-
-                            estimate_nu(tmp_, tal_fld,
-                                        parameters=add_stx_nuc)
-
-                            apply_nu(tmp_, tal_fld, tmp_n4, parameters=add_nuc_parameters)
-
-                            #TODO: maybe apply region-based intensity normalization here?
-                            normalize_intensity(tmp_n4, tal,
-                                            parameters=add_stx_clp,
-                                            model=add_model)
+                            wf.stage(c.modality+'_stx_warp', warp_nu_correct, args=(clp, model_t1w, tal, tal_fld),
+                                     kwargs={'transform':stx_xfm,
+                                             'corr_xfm':corr_xfm,
+                                             'parameters':add_stx_parameters,
+                                             'nuc_parameters':add_stx_nuc,
+                                             'apply_parameters':add_nuc_parameters,
+                                             'clp_parameters':add_stx_clp,
+                                             'clp_model':add_model},
+                                     inputs=[clp.scan, model_t1w.scan, stx_xfm.xfm, add_model.scan,
+                                             corr_xfm.xfm if corr_xfm is not None else None],
+                                     outputs=[tal.scan, tal_fld.scan])
 
                             iter_summary["add_tal_fld"].append(tal_fld)
 
                         else:
-                            warp_scan(clp,model_t1w, tal,
-                                    transform=stx_xfm,
-                                    corr_xfm=corr_xfm,
-                                    parameters=add_stx_parameters)
+                            wf.stage(c.modality+'_stx_warp', warp_scan, args=(clp, model_t1w, tal),
+                                     kwargs={'transform':stx_xfm,
+                                             'corr_xfm':corr_xfm,
+                                             'parameters':add_stx_parameters},
+                                     inputs=[clp.scan, model_t1w.scan, stx_xfm.xfm,
+                                             corr_xfm.xfm if corr_xfm is not None else None],
+                                     outputs=[tal.scan])
 
                         iter_summary["add_tal"].append(tal)
 
                 if run_qc is not None and run_qc.get('t1w_stx',True):
-                    draw_qc_stx(t1w_tal,model_outline,qc_tal,options=run_qc)
+                    wf.stage('qc_tal', draw_qc_stx, args=(t1w_tal,model_outline,qc_tal),
+                             kwargs={'options':run_qc},
+                             inputs=[t1w_tal.scan, model_outline.scan], outputs=[qc_tal.fname])
                     iter_summary["qc_tal"]=qc_tal
 
                     if add_scans is not None:
@@ -927,11 +1024,17 @@ def standard_pipeline(info,
                         for i,c in enumerate(add_scans):
                             qc=MriQCImage(prefix=qc_dir,name='tal_'+c.modality+'_'+dataset_id)
                             if run_qc is not None and run_qc.get('add_stx',True):
-                                draw_qc_add(t1w_tal,iter_summary["add_tal"][i],qc,options=run_qc)
+                                wf.stage(c.modality+'_qc_tal', draw_qc_add,
+                                         args=(t1w_tal,iter_summary["add_tal"][i],qc),
+                                         kwargs={'options':run_qc},
+                                         inputs=[t1w_tal.scan, iter_summary["add_tal"][i].scan],
+                                         outputs=[qc.fname])
                                 iter_summary["qc_add"].append(qc)
 
                 if run_aqc is not None and run_aqc.get('t1w_stx',True):
-                    make_aqc_stx(t1w_tal,model_outline,aqc_tal,options=run_aqc)
+                    wf.stage('aqc_tal', make_aqc_stx, args=(t1w_tal,model_outline,aqc_tal),
+                             kwargs={'options':run_aqc},
+                             inputs=[t1w_tal.scan])
                     iter_summary["aqc_tal"]=aqc_tal
 
                     if add_scans is not None:
@@ -939,39 +1042,62 @@ def standard_pipeline(info,
                         for i,c in enumerate(add_scans):
                             aqc=MriQCImage(prefix=aqc_dir,name='tal_'+c.modality+'_'+dataset_id)
                             if run_aqc is not None and run_aqc.get('add_stx',True):
-                                make_aqc_add(t1w_tal,iter_summary["add_tal"][i],aqc,options=run_aqc)
+                                wf.stage(c.modality+'_aqc_tal', make_aqc_add,
+                                         args=(t1w_tal,iter_summary["add_tal"][i],aqc),
+                                         kwargs={'options':run_aqc},
+                                         inputs=[t1w_tal.scan, iter_summary["add_tal"][i].scan])
                                 iter_summary["aqc_add"].append(aqc)
 
                 # run beast to create brain mask
                 beast_parameters=options.get('beast',None)
                 if beast_parameters is not None:
-                    extract_brain_beast(t1w_tal,parameters=beast_parameters,model=model_t1w)
+                    wf.stage('beast', extract_brain_beast, args=(t1w_tal,),
+                             kwargs={'parameters':beast_parameters,'model':model_t1w},
+                             inputs=[t1w_tal.scan, model_t1w.scan],
+                             outputs=[t1w_tal.mask])
                     if run_qc is not None and run_qc.get('beast',True):
-                        draw_qc_mask(t1w_tal,qc_mask,options=run_qc)
+                        wf.stage('qc_mask', draw_qc_mask, args=(t1w_tal,qc_mask),
+                                 kwargs={'options':run_qc},
+                                 inputs=[t1w_tal.scan, t1w_tal.mask], outputs=[qc_mask.fname])
                         iter_summary["qc_mask"]=qc_mask
                     if run_aqc is not None and run_aqc.get('beast',True):
-                        make_aqc_mask(t1w_tal,aqc_mask,options=run_aqc)
+                        wf.stage('aqc_mask', make_aqc_mask, args=(t1w_tal,aqc_mask),
+                                 kwargs={'options':run_aqc},
+                                 inputs=[t1w_tal.scan, t1w_tal.mask])
                         iter_summary["aqc_mask"]=aqc_mask
 
                 else:
                     #extract_brain_nlreg(t1w_tal,parameters=options.get('brain_nl_seg',{}),model=model_t1w)
                     # if we have initial mask, keep using that!
                     if t1w_clp.mask is not None:
-                        warp_mask(t1w_clp,model_t1w, t1w_tal,
-                            transform=t1w_tal_xfm,
-                            corr_xfm=corr_t1w,
-                            parameters=options.get('t1w_stx',{}))
+                        wf.stage('stx_mask', warp_mask, args=(t1w_clp,model_t1w, t1w_tal),
+                                 kwargs={'transform':t1w_tal_xfm,
+                                         'corr_xfm':corr_t1w,
+                                         'parameters':options.get('t1w_stx',{})},
+                                 inputs=[t1w_clp.mask, model_t1w.scan, t1w_tal_xfm.xfm,
+                                         corr_t1w.xfm if corr_t1w is not None else None],
+                                 outputs=[t1w_tal.mask])
                     t1w_tal.mask=None
                     pass
 
                 # create unscaled version
                 if create_unscaled:
-                    xfm_remove_scale(t1w_tal_xfm, t1w_tal_noscale_xfm, unscale=unscale_xfm)
+                    wf.stage('stx_noscale', xfm_remove_scale, args=(t1w_tal_xfm, t1w_tal_noscale_xfm),
+                             kwargs={'unscale':unscale_xfm},
+                             inputs=[t1w_tal_xfm.xfm],
+                             outputs=[t1w_tal_noscale_xfm.xfm, unscale_xfm.xfm])
                     iter_summary["t1w_tal_noscale_xfm"]=t1w_tal_noscale_xfm
                     #warp scan to create unscaled version
-                    warp_scan(t1w_clp, model_t1w, t1w_tal_noscale, transform=t1w_tal_noscale_xfm, corr_xfm=corr_t1w)
+                    wf.stage('stx_noscale_warp', warp_scan, args=(t1w_clp, model_t1w, t1w_tal_noscale),
+                             kwargs={'transform':t1w_tal_noscale_xfm, 'corr_xfm':corr_t1w},
+                             inputs=[t1w_clp.scan, model_t1w.scan, t1w_tal_noscale_xfm.xfm,
+                                     corr_t1w.xfm if corr_t1w is not None else None],
+                             outputs=[t1w_tal_noscale.scan])
                     # warping mask from tal space to unscaled tal space
-                    warp_mask(t1w_tal, model_t1w, t1w_tal_noscale, transform=unscale_xfm)
+                    wf.stage('stx_noscale_mask', warp_mask, args=(t1w_tal, model_t1w, t1w_tal_noscale),
+                             kwargs={'transform':unscale_xfm},
+                             inputs=[t1w_tal.mask, model_t1w.scan, unscale_xfm.xfm],
+                             outputs=[t1w_tal_noscale.mask])
                     iter_summary["t1w_tal_noscale"]=t1w_tal_noscale
 
                     if surfaces_parameters.get('skin',False) \
@@ -980,96 +1106,120 @@ def standard_pipeline(info,
                         # do skin, cortex, and hippocampus processing here
 
                         if surfaces_parameters.get('cortex',False) :
-                            with mincTools(verbose=2) as minc:
-                                #start with t1w_tal_noscale
-                                #mincmask t1w_tal_noscale.mnc t1w_tal_noscale_mask.mnc t1w_tal_noscale_masked.mnc
-                                minc.command(['mincmask','-clobber',t1w_tal_noscale.scan,t1w_tal_noscale.mask,t1w_tal_noscale_masked.scan])
-                                #marching_cubes t1w_tal_noscale_masked.mnc cortex.obj 45
-                                minc.command(['marching_cubes',t1w_tal_noscale_masked.scan,t1w_tal_noscale_cortex.fname,'45'])
-                                #ascii_binary cortex.obj
-                                minc.command(['ascii_binary', t1w_tal_noscale_cortex.fname])
+                            wf.stage('cortex_surface', extract_cortex_surface,
+                                     args=(t1w_tal_noscale, t1w_tal_noscale_masked, t1w_tal_noscale_cortex),
+                                     inputs=[t1w_tal_noscale.scan, t1w_tal_noscale.mask],
+                                     outputs=[t1w_tal_noscale_masked.scan, t1w_tal_noscale_cortex.fname])
                             iter_summary['cortex_surface'] = t1w_tal_noscale_cortex
                             iter_summary['t1w_tal_noscale_mask'] = t1w_tal_noscale_masked
 
                         if surfaces_parameters.get('skin',False) :
-                            with mincTools(verbose=2) as minc:
-                                #start with t1w_tal_noscale, then blur it.
-                                tmpname = minc.tmp('tmp_t1_noscaled')
-                                minc.command(['mincblur','-clobber','-fwhm','2', t1w_tal_noscale.scan,tmpname])
-                                #marching_cubes t1w_tal_noscale_masked.mnc skin.obj 30
-                                minc.command(['marching_cubes',tmpname+'_blur.mnc',t1w_tal_noscale_skin.fname,'30'])
-                                #ascii_binary cortex.obj
-                                minc.command(['ascii_binary', t1w_tal_noscale_skin.fname])
+                            wf.stage('skin_surface', extract_skin_surface,
+                                     args=(t1w_tal_noscale, t1w_tal_noscale_skin),
+                                     inputs=[t1w_tal_noscale.scan],
+                                     outputs=[t1w_tal_noscale_skin.fname])
                             iter_summary['skin_surface'] = t1w_tal_noscale_skin
 
                         if surfaces_parameters.get('hippocampus',False) :
-                            with mincTools(verbose=2) as minc:
-                                #start with t1w_tal_noscale and then segment hippocampus
-                                tmp_work = minc.tmp('tmp_work')
-                                tmp_output = minc.tmp('tmp_output')
-                                fusion_segment(input_scan= t1w_tal_noscale.scan, 
-                                            library_description='/data/ipl/scratch08/vfonov/adni_jens/jens_hc_lib_20170621/library.json',
-                                            output_segment=tmp_output,
-                                            parameters='/data/ipl/scratch08/vfonov/adni_jens/jens_hc_segment_20170621.json',
-                                            work_dir=tmp_work,
-                                            cleanup = True)
-                                minc.command(['marching_cubes',tmp_output+'_seg.mnc',t1w_tal_noscale_hippocampus.fname,'0'])
-                                minc.command(['ascii_binary', t1w_tal_noscale_hippocampus.fname])
+                            wf.stage('hippocampus_surface', extract_hippocampus_surface,
+                                     args=(t1w_tal_noscale, t1w_tal_noscale_hippocampus),
+                                     inputs=[t1w_tal_noscale.scan],
+                                     outputs=[t1w_tal_noscale_hippocampus.fname])
                             iter_summary['hippocampus_surface'] = t1w_tal_noscale_hippocampus
 
                     # perform non-linear registration
                 if run_nl:
-                    nl_registration(t1w_tal, model_t1w, nl_xfm,
-                                parameters=options.get('nl_reg',{}))
+                    wf.stage('nl', nl_registration, args=(t1w_tal, model_t1w, nl_xfm),
+                             kwargs={'parameters':options.get('nl_reg',{})},
+                             inputs=[t1w_tal.scan, t1w_tal.mask, model_t1w.scan, model_t1w.mask],
+                             outputs=[nl_xfm.xfm])
                     iter_summary["nl_xfm"]=nl_xfm
 
                 # run tissue classification
                 if run_nl and run_cls:
-                    classify_tissue(t1w_tal, tal_cls, model_name=model_name,
-                                model_dir=model_dir, xfm=nl_xfm,
-                                parameters=options.get('tissue_classify',{}))
-
-                    warp_cls_back (t1w_tal, tal_cls, t1w_tal_xfm, t1w_nuc, native_t1w_cls,corr_xfm=corr_t1w)
-                    warp_mask_back(t1w_tal, t1w_tal_xfm, t1w_nuc, native_t1w_cls,corr_xfm=corr_t1w)
+                    wf.stage('cls', classify_tissue, args=(t1w_tal, tal_cls),
+                             kwargs={'model_name':model_name,
+                                     'model_dir':model_dir, 'xfm':nl_xfm,
+                                     'parameters':options.get('tissue_classify',{})},
+                             inputs=[t1w_tal.scan, t1w_tal.mask, nl_xfm.xfm],
+                             outputs=[tal_cls.scan])
+
+                    wf.stage('cls_native', warp_cls_back,
+                             args=(t1w_tal, tal_cls, t1w_tal_xfm, t1w_nuc, native_t1w_cls),
+                             kwargs={'corr_xfm':corr_t1w},
+                             inputs=[tal_cls.scan, t1w_tal_xfm.xfm, t1w_nuc.scan,
+                                     corr_t1w.xfm if corr_t1w is not None else None],
+                             outputs=[native_t1w_cls.scan])
+                    wf.stage('mask_native', warp_mask_back,
+                             args=(t1w_tal, t1w_tal_xfm, t1w_nuc, native_t1w_cls),
+                             kwargs={'corr_xfm':corr_t1w},
+                             inputs=[t1w_tal.mask, t1w_tal_xfm.xfm, t1w_nuc.scan,
+                                     corr_t1w.xfm if corr_t1w is not None else None],
+                             outputs=[native_t1w_cls.mask])
                     iter_summary["native_t1w_cls"]=native_t1w_cls
                     iter_summary["tal_cls"]=tal_cls
                     if run_qc is not None  and run_qc.get('cls',True):
-                        draw_qc_cls(t1w_tal,tal_cls,qc_cls,options=run_qc)
+                        wf.stage('qc_cls', draw_qc_cls, args=(t1w_tal,tal_cls,qc_cls),
+                                 kwargs={'options':run_qc},
+                                 inputs=[t1w_tal.scan, tal_cls.scan], outputs=[qc_cls.fname])
                     if run_aqc is not None  and run_aqc.get('cls',True):
-                        make_aqc_cls(t1w_tal,tal_cls,aqc_cls,options=run_aqc)
+                        wf.stage('aqc_cls', make_aqc_cls, args=(t1w_tal,tal_cls,aqc_cls),
+                                 kwargs={'options':run_aqc},
+                                 inputs=[t1w_tal.scan, tal_cls.scan])
                 else:
                     # just warp mask back
                     if beast_parameters is not None:
-                        warp_mask_back(t1w_tal, t1w_tal_xfm, t1w_nuc, native_t1w_cls,corr_xfm=corr_t1w)
+                        wf.stage('mask_native', warp_mask_back,
+                                 args=(t1w_tal, t1w_tal_xfm, t1w_nuc, native_t1w_cls),
+                                 kwargs={'corr_xfm':corr_t1w},
+                                 inputs=[t1w_tal.mask, t1w_tal_xfm.xfm, t1w_nuc.scan,
+                                         corr_t1w.xfm if corr_t1w is not None else None],
+                                 outputs=[native_t1w_cls.mask])
                         native_t1w_cls.scan=None
                         iter_summary["tal_cls"]=tal_cls
 
 
                 # run lobe segmentation
                 if run_nl and run_cls and run_lobes:
-                    segment_lobes( tal_cls, nl_xfm, tal_lob,
-                            model=model_t1w,
-                            lobe_atlas_dir=lobe_atlas_dir,
-                            parameters=options.get('lobe_segment',{}))
+                    wf.stage('lobes', segment_lobes, args=(tal_cls, nl_xfm, tal_lob),
+                             kwargs={'model':model_t1w,
+                                     'lobe_atlas_dir':lobe_atlas_dir,
+                                     'parameters':options.get('lobe_segment',{})},
+                             inputs=[tal_cls.scan, nl_xfm.xfm, model_t1w.scan],
+                             outputs=[tal_lob.scan])
                     iter_summary["tal_lob"]=tal_lob
 
                     if run_qc is not None  and run_qc.get('lob',True):
-                        draw_qc_lobes( t1w_tal, tal_lob,qc_lob,options=run_qc)
+                        wf.stage('qc_lob', draw_qc_lobes, args=(t1w_tal, tal_lob,qc_lob),
+                                 kwargs={'options':run_qc},
+                                 inputs=[t1w_tal.scan, tal_lob.scan], outputs=[qc_lob.fname])
                         iter_summary["qc_lob"]=qc_lob
                     if run_aqc is not None  and run_aqc.get('lob',True):
-                        make_aqc_lobes( t1w_tal, tal_lob,aqc_lob,options=run_aqc)
+                        wf.stage('aqc_lob', make_aqc_lobes, args=(t1w_tal, tal_lob,aqc_lob),
+                                 kwargs={'options':run_aqc},
+                                 inputs=[t1w_tal.scan, tal_lob.scan])
                         iter_summary["aqc_lob"]=aqc_lob
 
                     # calculate volumes
-                    extract_volumes(tal_lob, tal_cls, t1w_tal_xfm, lob_volumes,
-                                    subject_id=subject_id, timepoint_id=timepoint_id , lobedefs=lobe_atlas_defs)
-
-                    extract_volumes(tal_lob, tal_cls, t1w_tal_xfm, lob_volumes_json,
-                                    produce_json=True,subject_id=subject_id, timepoint_id=timepoint_id,lobedefs=lobe_atlas_defs)
+                    wf.stage('volumes', extract_volumes, args=(tal_lob, tal_cls, t1w_tal_xfm, lob_volumes),
+                             kwargs={'subject_id':subject_id, 'timepoint_id':timepoint_id,
+                                     'lobedefs':lobe_atlas_defs},
+                             inputs=[tal_lob.scan, tal_cls.scan, t1w_tal_xfm.xfm, lobe_atlas_defs],
+                             outputs=[lob_volumes.fname])
+
+                    wf.stage('volumes_json', extract_volumes, args=(tal_lob, tal_cls, t1w_tal_xfm, lob_volumes_json),
+                             kwargs={'produce_json':True, 'subject_id':subject_id,
+                                     'timepoint_id':timepoint_id, 'lobedefs':lobe_atlas_defs},
+                             inputs=[tal_lob.scan, tal_cls.scan, t1w_tal_xfm.xfm, lobe_atlas_defs],
+                             outputs=[lob_volumes_json.fname])
 
                     iter_summary["lob_volumes"]=     lob_volumes
                     iter_summary["lob_volumes_json"]=lob_volumes_json
 
+            if dry_run:
+                print(wf.format_plan())
+                return iter_summary
+
             # TODO: figure out when this is needed
             if ibis_output:
               save_ibis_summary(iter_summary, ibis_summary_file.fname) # use this 
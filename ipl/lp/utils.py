@@ -14,6 +14,7 @@ import json
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl.numpy_backend import label_names
 
 
 def create_dirs(dirs):
@@ -52,13 +53,15 @@ def extract_volumes(in_lob, in_cls, tal_xfm, out,
     
     """
     with mincTools() as minc:
-        vol_lobes= minc.label_stats( in_lob.scan, label_defs=lobedefs )
-        vol_cls  = minc.label_stats( in_cls.scan )
+        # both label volumes in one pass
+        stats    = minc.label_table( [in_lob.scan, in_cls.scan] )
+        lobe_names = label_names( lobedefs )
         params=minc.xfm2param(tal_xfm.xfm)
         vol_scale=params['scale'][0]*params['scale'][1]*params['scale'][2]
         
-        volumes={ k[0]:k[1]*vol_scale for k in vol_lobes }
-        _vol_cls  = { k[0]: k[1]*vol_scale for k in vol_cls }
+        volumes={ (lobe_names[k['label']] if lobe_names is not None else k['label']):k['volume']*vol_scale 
+                  for k in stats if k['input']==0 and (lobe_names is None or k['label'] in lobe_names) }
+        _vol_cls  = { k['label']: k['volume']*vol_scale for k in stats if k['input']==1 }
         # TODO: figure out what to do when keys are missing, i.e something is definetely wrong
         volumes['CSF']=_vol_cls.get(1,0.0)
         volumes['GM']=_vol_cls.get(2,0.0)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Cache of MINC header information
+#
+# Headers are identified by (path, size, mtime, inode), so modifying a file
+# invalidates its entry automatically. Entries are kept in memory and,
+# if IPL_HEADER_CACHE=<file.sqlite> is set, in a small sqlite database shared
+# by all processes.
+
+from __future__ import print_function
+
+import os
+import json
+import sqlite3
+import threading
+import subprocess
+import collections
+import logging
+
+try:
+    from minc2_simple import minc2_file
+    have_minc2_simple = True
+except ImportError:
+    # minc2_simple not available :(
+    have_minc2_simple = False
+
+logger = logging.getLogger("MINC")
+
+diminfo = collections.namedtuple('dimension', ['length', 'start', 'step', 'direction_cosines'])
+
+# in-memory cache, least recently used entries are dropped
+_memo = collections.OrderedDict()
+_memo_max = 10000
+_lock = threading.Lock()
+_store = None
+_store_configured = False
+
+# position of dimension attributes in the header record
+_dim_attributes = {'length': 0, 'start': 1, 'step': 2, 'direction_cosines': 3}
+
+
+class HeaderStore(object):
+    """on-disk store of header records, shared between processes"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        _dir = os.path.dirname(self.path)
+        if not os.path.exists(_dir):
+            try:
+                os.makedirs(_dir)
+            except OSError:
+                pass
+        self._db = sqlite3.connect(self.path, timeout=60.0, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS headers (key TEXT PRIMARY KEY, value TEXT)')
+
+    def get(self, key):
+        try:
+            r = self._db.execute('SELECT value FROM headers WHERE key=?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.debug('Header cache read failed:{}'.format(str(e)))
+            return None
+        return json.loads(r[0]) if r is not None else None
+
+    def put(self, key, value):
+        try:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO headers (key,value) VALUES (?,?)',
+                                 (key, json.dumps(value)))
+        except sqlite3.Error as e:
+            logger.debug('Header cache write failed:{}'.format(str(e)))
+
+
+def configure(path=None):
+    """use on-disk header store (or only in-memory cache if path is None)"""
+    global _store, _store_configured
+    _store_configured = True
+    _store = HeaderStore(path) if path else None
+
+
+def _remember(key, r):
+    with _lock:
+        _memo.pop(key, None)
+        _memo[key] = r
+        while len(_memo) > _memo_max:
+            _memo.popitem(last=False)
+
+
+def _format_value(v):
+    """format a number the way mincinfo does (%.20g)"""
+    return '%.20g' % v
+
+
+def _get_store():
+    if not _store_configured:
+        configure(os.environ.get('IPL_HEADER_CACHE', None))
+    return _store
+
+
+def _file_key(path):
+    st = os.stat(path)
+    return '{}:{}:{}:{}'.format(os.path.abspath(path), st.st_size,
+                                getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino)
+
+
+def _mincinfo(args):
+    return subprocess.Popen(['mincinfo'] + args,
+                            stdout=subprocess.PIPE).communicate()[0].decode()
+
+
+_dim_names = {}
+if have_minc2_simple:
+    _dim_names = {minc2_file.MINC2_DIM_X:    'xspace',
+                  minc2_file.MINC2_DIM_Y:    'yspace',
+                  minc2_file.MINC2_DIM_Z:    'zspace',
+                  minc2_file.MINC2_DIM_TIME: 'time',
+                  minc2_file.MINC2_DIM_VEC:  'vector_dimension'}
+
+
+def _read_minc2(path):
+    """read dimension information in-process"""
+    f = minc2_file(path)
+    try:
+        dims = f.store_dims()
+        # minc2_simple lists dimensions starting from the fastest varying
+        # while mincinfo starts with the slowest one
+        dimorder = []
+        info = {}
+        for d in reversed(dims):
+            name = _dim_names.get(d.id, None)
+            if name is None:
+                raise ValueError('Unknown dimension')
+            dimorder.append(name)
+            if name not in ('xspace', 'yspace', 'zspace'):
+                cos = None
+            elif d.have_dir_cos:
+                cos = [float(d.dir_cos[0]), float(d.dir_cos[1]), float(d.dir_cos[2])]
+            else:
+                cos = [1.0 if name == j else 0.0 for j in ('xspace', 'yspace', 'zspace')]
+            info[name] = [int(d.length), float(d.start), float(d.step), cos]
+    finally:
+        f.close()
+    return {'dimorder': dimorder, 'dims': info, 'attrs': {}}
+
+
+def _read_mincinfo(path):
+    """read dimension information with mincinfo"""
+    dimorder = _mincinfo(['-vardims', 'image', path]).rstrip('\n').rstrip(' ').split(' ')
+    req = []
+    for i in dimorder:
+        req.extend(['-dimlength', i,
+                    '-attvalue', '{}:start'.format(i),
+                    '-attvalue', '{}:step'.format(i)])
+        if i in ('xspace', 'yspace', 'zspace'):
+            req.extend(['-attvalue', '{}:direction_cosines'.format(i)])
+    req.append(path)
+    _info = _mincinfo(req).rstrip('\n').rstrip(' ').split("\n")
+    info = {}
+    k = 0
+    for i in dimorder:
+        length = int(_info[k])
+        start = float(_info[k + 1])
+        step = float(_info[k + 2])
+        k += 3
+        cos = None
+        if i in ('xspace', 'yspace', 'zspace'):
+            cos = [float(j) for j in _info[k].rstrip(' ').split(' ')]
+            k += 1
+        info[i] = [length, start, step, cos]
+    return {'dimorder': dimorder, 'dims': info, 'attrs': {}}
+
+
+def header(path):
+    """return header record {'dimorder':[], 'dims':{}, 'attrs':{}}"""
+    key = _file_key(path)
+    with _lock:
+        r = _memo.pop(key, None)
+        if r is not None:
+            _memo[key] = r
+    if r is not None:
+        return r
+    store = _get_store()
+    if store is not None:
+        r = store.get(key)
+    if r is None:
+        r = None
+        if have_minc2_simple:
+            try:
+                r = _read_minc2(path)
+            except (ValueError, AttributeError, IndexError) as e:
+                logger.debug('Falling back to mincinfo for {}:{}'.format(path, str(e)))
+        if r is None:
+            r = _read_mincinfo(path)
+        if store is not None:
+            store.put(key, r)
+    _remember(key, r)
+    return r
+
+
+def prefetch(paths, threads=8):
+    """read headers of many files at once, i.e for a whole library"""
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        return list(ex.map(header, paths))
+
+
+def dimorder(path):
+    """names of image dimensions, slowest varying first"""
+    return list(header(path)['dimorder'])
+
+
+def dims(path):
+    """dict of diminfo per dimension"""
+    return {k: diminfo(*v) for k, v in header(path)['dims'].items()}
+
+
+def attribute(path, attr):
+    """value of an attribute, as printed by mincinfo -attvalue"""
+    h = header(path)
+    if ':' in attr:
+        (var, name) = attr.split(':', 1)
+        if var in h['dims'] and name in _dim_attributes:
+            v = h['dims'][var][_dim_attributes[name]]
+            if name == 'direction_cosines':
+                if v is None:
+                    v = [1.0 if var == j else 0.0 for j in ('xspace', 'yspace', 'zspace')]
+                return ' '.join(_format_value(i) for i in v)
+            return _format_value(v)
+    try:
+        return h['attrs'][attr]
+    except KeyError:
+        pass
+    v = _mincinfo(['-attvalue', attr, path]).rstrip('\n').rstrip(' ')
+    key = _file_key(path)
+    h = dict(h)
+    h['attrs'] = dict(h['attrs'])
+    h['attrs'][attr] = v
+    _remember(key, h)
+    store = _get_store()
+    if store is not None:
+        store.put(key, h)
+    return v
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -30,8 +30,12 @@ def label_normalize(sample, sample_labels, ref, ref_labels, out=None,sample_mask
     with mincTools() as minc:
         if not mincTools.checkfiles(outputs=[out]):     return
         
-        ref_stats   = {i[0]:i[5] for i in minc.label_stats(ref_labels,      volume=ref, mask=ref_mask,median=median)}
-        sample_stats= {i[0]:i[5] for i in minc.label_stats(sample_labels,volume=sample,mask=sample_mask,median=median)}
+        # both label volumes in one pass
+        _stat='median' if median else 'mean'
+        stats=minc.label_table([ref_labels, sample_labels], volumes=[ref, sample],
+                               masks=[ref_mask, sample_mask], median=median)
+        ref_stats   = {i['label']:i[_stat][0] for i in stats if i['input']==0}
+        sample_stats= {i['label']:i[_stat][0] for i in stats if i['input']==1}
         x=[]
         y=[]
         
@@ -99,32 +103,34 @@ def nuyl_normalize2(
         # create gradient maps
         
         if filter_gradients:
-            minc.blur(source,minc.tmp('source_grad.mnc'),fwhm,gmag=True,output_float=True)
-            minc.blur(target,minc.tmp('target_grad.mnc'),fwhm,gmag=True,output_float=True)
+            # independent branches for source and target run concurrently
+            minc.submit(minc.blur,source,minc.tmp('source_grad.mnc'),fwhm,gmag=True,output_float=True)
+            minc.submit(minc.blur,target,minc.tmp('target_grad.mnc'),fwhm,gmag=True,output_float=True)
             # create masks of areas with low gradient
-            minc.binary_morphology(minc.tmp('source_grad.mnc'),'D[1] I[0]',minc.tmp('source_grad_mask.mnc'),binarize_bimodal=True)
+            minc.submit(minc.binary_morphology,minc.tmp('source_grad.mnc'),'D[1] I[0]',minc.tmp('source_grad_mask.mnc'),binarize_bimodal=True)
             source_mask=minc.tmp('source_grad_mask.mnc')
             
-            minc.binary_morphology(minc.tmp('target_grad.mnc'),'D[1] I[0]',minc.tmp('target_grad_mask.mnc'),binarize_bimodal=True)
+            minc.submit(minc.binary_morphology,minc.tmp('target_grad.mnc'),'D[1] I[0]',minc.tmp('target_grad_mask.mnc'),binarize_bimodal=True)
             target_mask=minc.tmp('target_grad_mask.mnc')
             
             if remove_bg:
-                minc.binary_morphology(source,'D[8]',minc.tmp('source_mask.mnc'),binarize_bimodal=True)
-                minc.binary_morphology(target,'D[8]',minc.tmp('target_mask.mnc'),binarize_bimodal=True)
-                minc.calc([source_mask,minc.tmp('source_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('source_grad_mask2.mnc'))
-                minc.calc([target_mask,minc.tmp('target_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('target_grad_mask2.mnc'))
+                minc.submit(minc.binary_morphology,source,'D[8]',minc.tmp('source_mask.mnc'),binarize_bimodal=True)
+                minc.submit(minc.binary_morphology,target,'D[8]',minc.tmp('target_mask.mnc'),binarize_bimodal=True)
+                minc.submit(minc.calc,[source_mask,minc.tmp('source_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('source_grad_mask2.mnc'))
+                minc.submit(minc.calc,[target_mask,minc.tmp('target_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('target_grad_mask2.mnc'))
                 source_mask=minc.tmp('source_grad_mask2.mnc')
                 target_mask=minc.tmp('target_grad_mask2.mnc')
                 
             if source_mask is not None:
-                minc.resample_labels(source_mask,minc.tmp('source_mask.mnc'),like=minc.tmp('source_grad_mask.mnc'))
-                minc.calc([minc.tmp('source_grad_mask.mnc'),minc.tmp('source_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('source_mask2.mnc'))
+                minc.submit(minc.resample_labels,source_mask,minc.tmp('source_mask.mnc'),like=minc.tmp('source_grad_mask.mnc'))
+                minc.submit(minc.calc,[minc.tmp('source_grad_mask.mnc'),minc.tmp('source_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('source_mask2.mnc'))
                 source_mask=minc.tmp('source_mask2.mnc')
                 
             if target_mask is not None:
-                minc.resample_labels(target_mask,minc.tmp('target_mask.mnc'),like=minc.tmp('target_grad_mask.mnc'))
-                minc.calc([minc.tmp('target_grad_mask.mnc'),minc.tmp('target_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('target_mask2.mnc'))
+                minc.submit(minc.resample_labels,target_mask,minc.tmp('target_mask.mnc'),like=minc.tmp('target_grad_mask.mnc'))
+                minc.submit(minc.calc,[minc.tmp('target_grad_mask.mnc'),minc.tmp('target_mask.mnc')],'A[0]>0.5&&A[1]>0.5?1:0',minc.tmp('target_mask2.mnc'))
                 target_mask=minc.tmp('target_mask2.mnc')
+            minc.gather()
 
         # now run iterative normalization
         for i in range(iterations):
@@ -141,8 +147,12 @@ def patch_normalize(sample, sample_labels, ref, ref_labels, out=None,sample_mask
     with mincTools() as minc:
         if not mincTools.checkfiles(outputs=[out]):     return
         
-        ref_stats   = {i[0]:i[5] for i in minc.label_stats(ref_labels,      volume=ref, mask=ref_mask,median=median)}
-        sample_stats= {i[0]:i[5] for i in minc.label_stats(sample_labels,volume=sample,mask=sample_mask,median=median)}
+        # both label volumes in one pass
+        _stat='median' if median else 'mean'
+        stats=minc.label_table([ref_labels, sample_labels], volumes=[ref, sample],
+                               masks=[ref_mask, sample_mask], median=median)
+        ref_stats   = {i['label']:i[_stat][0] for i in stats if i['input']==0}
+        sample_stats= {i['label']:i[_stat][0] for i in stats if i['input']==1}
         x=[]
         y=[]
         
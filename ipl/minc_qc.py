@@ -19,6 +19,8 @@ import matplotlib.gridspec as gridspec
 
 from minc2_simple import minc2_file
 
+from .stream import open_volume,volume_shape,orthogonal_slices
+
 import matplotlib.cm  as cmx
 import matplotlib.colors as colors
 
@@ -84,6 +86,12 @@ def over_blend(si,so, ialpha, oalpha):
     return out
 
 
+def _slice_positions(data_shape,samples):
+    """indexes of slices to show along each axis"""
+    return [ [ int( (data_shape[a]/samples)*j+(data_shape[a]%samples)/2 ) for j in range(0,samples) ]
+             for a in range(3) ]
+
+
 def qc(
     input,
     output,
@@ -128,37 +136,38 @@ def qc(
         oalpha -- alpha channel for colour mixing of mask image
     """
     
-    #_img=minc.Image(input)
-    #_idata=_img.data
-    _img=minc2_file(input)
-    _img.setup_standard_order()
-    _idata=_img.load_complete_volume(minc2_file.MINC2_FLOAT)
+    # volumes are read slab by slab, keeping only the displayed slices
+    _img=open_volume(input)
     _idims=_img.representation_dims()
     
-    data_shape=_idata.shape
+    data_shape=volume_shape(_img)
     spacing=[_idims[0].step,_idims[1].step,_idims[2].step]
+    (axial,coronal,sagittal)=_slice_positions(data_shape,samples)
+    
+    (_iaxial,_icoronal,_isagittal,(imin,imax))=orthogonal_slices(_img,axial,coronal,sagittal)
+    _img.close()
     
     _ovl=None
-    _odata=None
     omin=0
     omax=1
     
     if mask is not None:
-        _ovl=minc2_file(mask)
-        _ovl.setup_standard_order()
-        _ovl_data=_ovl.load_complete_volume(minc2_file.MINC2_FLOAT)
-        if _ovl_data.shape != data_shape:
-            raise "Overlay shape does not match image!\nOvl={} Image={}".format(repr(_ovl_data.shape),repr(data_shape))
+        _ovl=open_volume(mask)
+        if volume_shape(_ovl) != data_shape:
+            raise "Overlay shape does not match image!\nOvl={} Image={}".format(repr(volume_shape(_ovl)),repr(data_shape))
+        (_oaxial,_ocoronal,_osagittal,(_omin,_omax))=orthogonal_slices(_ovl,axial,coronal,sagittal)
+        _ovl.close()
         if mask_range is None:
-            omin=np.nanmin(_ovl_data)
-            omax=np.nanmax(_ovl_data)
+            omin=_omin
+            omax=_omax
         else:
             omin=mask_range[0]
             omax=mask_range[1]
-        _odata=_ovl_data
         
         if mask_bg is not None:
-            _odata=ma.masked_less(_odata, mask_bg)
+            _oaxial   =[ma.masked_less(i, mask_bg) for i in _oaxial]
+            _ocoronal =[ma.masked_less(i, mask_bg) for i in _ocoronal]
+            _osagittal=[ma.masked_less(i, mask_bg) for i in _osagittal]
         
     slices=[]
     
@@ -168,8 +177,8 @@ def qc(
         vmin=image_range[0]
         vmax=image_range[1]
     else:
-        vmin=np.nanmin(_idata)
-        vmax=np.nanmax(_idata)
+        vmin=imin
+        vmax=imax
 
     cm = copy.copy(plt.get_cmap(image_cmap))
     cmo= copy.copy(plt.get_cmap(mask_cmap))
@@ -184,11 +193,10 @@ def qc(
     
     # axial slices
     for j in range(0,samples):
-        i=int( (data_shape[0]/samples)*j+(data_shape[0]%samples)/2 )
-        si=scalarMap.to_rgba(_idata[i , : ,:])
+        si=scalarMap.to_rgba(_iaxial[j])
 
         if _ovl is not None:
-            so=oscalarMap.to_rgba(_odata[i , : ,:])
+            so=oscalarMap.to_rgba(_oaxial[j])
             if use_max: si=max_blend(si,so)
             elif use_over: si=over_blend(si,so, ialpha, oalpha)
             else: si=alpha_blend(si, so, ialpha, oalpha)
@@ -196,11 +204,10 @@ def qc(
         aspects.append( spacing[0]/spacing[1] )
     # coronal slices
     for j in range(0,samples):
-        i=int( (data_shape[1]/samples)*j+(data_shape[1]%samples)/2 )
-        si=scalarMap.to_rgba(_idata[: , i ,:])
+        si=scalarMap.to_rgba(_icoronal[j])
         
         if _ovl is not None:
-            so=oscalarMap.to_rgba(_odata[: , i ,:])
+            so=oscalarMap.to_rgba(_ocoronal[j])
             if use_max: si=max_blend(si,so)
             elif use_over: si=over_blend(si,so, ialpha, oalpha)
             else: si=alpha_blend(si, so, ialpha, oalpha)
@@ -209,10 +216,9 @@ def qc(
         
     # sagittal slices
     for j in range(0,samples):
-        i=int( (data_shape[2]/samples)*j+(data_shape[2]%samples)/2 )
-        si=scalarMap.to_rgba(_idata[: , : , i])
+        si=scalarMap.to_rgba(_isagittal[j])
         if _ovl is not None:
-            so=oscalarMap.to_rgba(_odata[: , : , i])
+            so=oscalarMap.to_rgba(_osagittal[j])
             if use_max: si=max_blend(si,so)
             elif use_over: si=over_blend(si,so, ialpha, oalpha)
             else: si=alpha_blend(si, so, ialpha, oalpha)
@@ -263,15 +269,17 @@ def qc_field_contour(
     """show field contours
     """
     
-    _img=minc2_file(input)
-    _img.setup_standard_order()
-    _idata=_img.load_complete_volume(minc2_file.MINC2_FLOAT)
+    _img=open_volume(input)
     _idims=_img.representation_dims()
     
-    data_shape=_idata.shape
+    data_shape=volume_shape(_img)
     spacing=[_idims[0].step,_idims[1].step,_idims[2].step]
+    (axial,coronal,sagittal)=_slice_positions(data_shape,samples)
     
-    slices=[]
+    (_iaxial,_icoronal,_isagittal,(imin,imax))=orthogonal_slices(_img,axial,coronal,sagittal)
+    _img.close()
+    
+    slices=_iaxial+_icoronal+_isagittal
     
     # setup ranges
     vmin=vmax=0.0
@@ -279,8 +287,8 @@ def qc_field_contour(
         vmin=image_range[0]
         vmax=image_range[1]
     else:
-        vmin=np.nanmin(_idata)
-        vmax=np.nanmax(_idata)
+        vmin=imin
+        vmax=imax
 
     cm = plt.get_cmap(image_cmap)
 
@@ -288,21 +296,6 @@ def qc_field_contour(
     
     scalarMap  = cmx.ScalarMappable(norm=cNorm, cmap=cm)
     
-    for j in range(0,samples):
-        i=(data_shape[0]/samples)*j+(data_shape[0]%samples)/2
-        si=_idata[i , : ,:]
-        slices.append( si )
-        
-    for j in range(0,samples):
-        i=(data_shape[1]/samples)*j+(data_shape[1]%samples)/2
-        si=_idata[: , i ,:]
-        slices.append( si )
-        
-    for j in range(0,samples):
-        i=(data_shape[2]/samples)*j+(data_shape[2]%samples)/2
-        si=_idata[: , : , i]
-        slices.append( si )
-    
     w, h = plt.figaspect(3.0/samples)
     fig = plt.figure(figsize=(w,h))
     
@@ -18,11 +18,21 @@ import fcntl
 import traceback
 import collections
 import math
+import time
 import logging
+import threading
+import multiprocessing
+import concurrent.futures
 
 
 import inspect
 
+from .result_cache import get_result_cache, parse_size
+from . import profile
+from . import numpy_backend
+from . import minc_header
+from . import workflow
+from . import compression
 
 logger = logging.getLogger("MINC")
 logger.setLevel(logging.DEBUG)
@@ -74,22 +84,82 @@ class mincError(Exception):
         return self.__repr__()
         
 
+# RAM-backed temporary directories of this process, used for accounting
+_ram_dirs = set()
+
+# usage of RAM-backed directories is measured at most once per interval (s)
+_ram_usage_interval = 1.0
+_ram_usage_lock = threading.Lock()
+_ram_usage_cache = {'bytes': 0, 'time': None}
+
+def _dir_usage(path):
+    """total size of files in a directory tree"""
+    total=0
+    for (root, dirs, files) in os.walk(path):
+        for f in files:
+            try:
+                total+=os.path.getsize(os.path.join(root,f))
+            except OSError:
+                pass
+    return total
+
+def _ram_usage():
+    """total size of files in RAM-backed directories of this process,
+    measured at most once per _ram_usage_interval"""
+    now=time.time()
+    with _ram_usage_lock:
+        if _ram_usage_cache['time'] is not None and now-_ram_usage_cache['time'] < _ram_usage_interval:
+            return _ram_usage_cache['bytes']
+    total=sum(_dir_usage(i) for i in list(_ram_dirs))
+    with _ram_usage_lock:
+        _ram_usage_cache['bytes']=total
+        _ram_usage_cache['time']=now
+    return total
+
+def _ram_tmpdir():
+    """location of RAM-backed temporary directory: IPL_RAM_TMPDIR or /dev/shm"""
+    d=os.environ.get('IPL_RAM_TMPDIR','/dev/shm')
+    if d and os.path.isdir(d) and os.access(d, os.W_OK):
+        return d
+    return None
+
 class temp_files(object):
-    """Class to keep track of temp files"""
+    """Class to keep track of temp files
+    
+    If ram_budget (or IPL_RAM_BUDGET environment variable, i.e 2G) is set, 
+    temporary files are allocated on a RAM-backed file system (see _ram_tmpdir) 
+    until all such files of this process take more than ram_budget bytes, 
+    after that new files go to the regular temporary directory.
+    The budget is advisory: usage is measured periodically (see _ram_usage) 
+    and before files are written, so it could be exceeded by files written 
+    in the meantime
     
-    def __init__(self, tempdir=None, prefix=None):
+    MINC files written inside temporary directories use compression level 
+    for temporary files, see ipl.compression
+    """
+    
+    def __init__(self, tempdir=None, prefix=None, ram_budget=None):
         
         self.tempdir = tempdir
         self.clean_tempdir = False
         self.tempfiles = {}
+        self.ramdir = None
+        self.ram_budget = parse_size(ram_budget if ram_budget is not None else os.environ.get('IPL_RAM_BUDGET',None))
         if not self.tempdir:
             if prefix is None:
                 prefix='iplMincTools'
             self.tempdir = tempfile.mkdtemp(prefix=prefix, dir=os.environ.get('TMPDIR',None) )
             self.clean_tempdir = True
             
+            if self.ram_budget and _ram_tmpdir() is not None:
+                self.ramdir = tempfile.mkdtemp(prefix=prefix, dir=_ram_tmpdir())
+                _ram_dirs.add(self.ramdir)
+                compression.register_temp_dir(self.ramdir)
+            
         if not os.path.exists(self.tempdir):
             os.makedirs(self.tempdir)
+        if self.clean_tempdir:
+            compression.register_temp_dir(self.tempdir)
 
     def __enter__(self):
         return self
@@ -108,13 +178,33 @@ class temp_files(object):
     def do_cleanup(self):
         """remove temporary directory if present"""
         if self.clean_tempdir and self.tempdir is not None:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Temporary files: {}'.format(repr(self.bytes_written())))
             shutil.rmtree(self.tempdir)
+            compression.unregister_temp_dir(self.tempdir)
+            if self.ramdir is not None:
+                shutil.rmtree(self.ramdir, ignore_errors=True)
+                _ram_dirs.discard(self.ramdir)
+                compression.unregister_temp_dir(self.ramdir)
+                self.ramdir=None
             self.clean_tempdir=False
 
+    def bytes_written(self):
+        """size of temporary files currently kept in RAM and on disk"""
+        return {'ram':  _dir_usage(self.ramdir) if self.ramdir is not None else 0,
+                'disk': _dir_usage(self.tempdir)}
+
+    def _alloc_dir(self):
+        """directory for a new temporary file, spill to disk when RAM budget is used"""
+        if self.ramdir is not None:
+            if _ram_usage() < self.ram_budget:
+                return self.ramdir
+        return self.tempdir
+
     def temp_file(self, suffix='', prefix=''):
         """create temporary file"""
 
-        (h, name) = tempfile.mkstemp(suffix=suffix, prefix=prefix,dir=self.tempdir)
+        (h, name) = tempfile.mkstemp(suffix=suffix, prefix=prefix,dir=self._alloc_dir())
         os.close(h)
         os.unlink(name)
         return name
@@ -131,7 +221,7 @@ class temp_files(object):
         """ Create temporary directory for processing"""
 
         name = tempfile.mkdtemp(suffix=suffix, prefix=prefix,
-                                dir=self.tempdir)
+                                dir=self._alloc_dir())
         return name
 
     @property
@@ -139,7 +229,8 @@ class temp_files(object):
         return self.tempdir
     
 class cache_files(temp_files):
-    """Class to keep track of work files"""
+    """Class to keep track of work files, written with compression level 
+    for temporary files"""
     def __init__(self, work_dir=None, context='',tempdir=None):
         self._locks={}
         super(cache_files,self).__init__(tempdir=tempdir)
@@ -150,6 +241,7 @@ class cache_files(temp_files):
             self.cache_dir=self.work_dir+os.sep+context+os.sep
             if not os.path.exists(self.cache_dir):
                 os.makedirs(self.cache_dir)
+            compression.register_temp_dir(self.cache_dir)
 
         
     def cache(self,name,suffix=''):
@@ -224,13 +316,27 @@ class cache_files(temp_files):
         super(cache_files,self).do_cleanup()
 
 class mincTools(temp_files):
-    """minc toolkit interface , mostly basic tools """
-
-    def __init__(self, tempdir=None, resample=None, verbose=0, prefix=None):
-        super(mincTools, self).__init__(tempdir=tempdir,prefix=prefix)
+    """minc toolkit interface , mostly basic tools 
+    
+    backend -- 'cli' to run all operations with minc tools, 
+               'numpy' to run simple voxel-wise operations in-process
+               default is taken from IPL_MINC_BACKEND environment variable
+    slots   -- maximum number of commands running concurrently, see submit()
+               default is taken from IPL_LOCAL_SLOTS environment variable
+               or number of CPUs
+    """
+
+    def __init__(self, tempdir=None, resample=None, verbose=0, prefix=None, backend=None, slots=None, ram_budget=None):
+        super(mincTools, self).__init__(tempdir=tempdir,prefix=prefix,ram_budget=ram_budget)
         # TODO: add some options?
         self.resample = resample
         self.verbose  = verbose
+        self.backend  = backend if backend is not None else os.environ.get('IPL_MINC_BACKEND','cli')
+        self.slots    = slots if slots is not None else int(os.environ.get('IPL_LOCAL_SLOTS',multiprocessing.cpu_count()))
+        self._executor = None
+        self._pending  = []
+        self._writer   = {}  # path -> future of the last job writing it
+        self._readers  = {}  # path -> futures of jobs reading it since
 
     def __enter__(self):
         return super(mincTools,self).__enter__()
@@ -241,8 +347,146 @@ class mincTools(temp_files):
         value,
         traceback,
         ):
+        # don't remove temp files under running jobs
+        self._shutdown_jobs()
         return super(mincTools,self).__exit__(type,value,traceback)
 
+    _path_re = re.compile(r'.*\.(mnc|xfm|gz|csv|txt|json|jpg|tag|obj|exp|imp)$')
+
+    @staticmethod
+    def _path_args(args, kwargs={}):
+        """collect arguments which look like file names"""
+        paths=[]
+        def _collect(a):
+            if isinstance(a, basestring):
+                if os.sep in a or mincTools._path_re.match(a):
+                    paths.append(a)
+            elif isinstance(a, (list, tuple)):
+                for i in a: _collect(i)
+        for a in args: _collect(a)
+        for a in kwargs.values(): _collect(a)
+        return paths
+
+    @staticmethod
+    def _output_param(name, names):
+        if name.startswith('output') or name in ('out', 'outputs', 'sdfile'):
+            return True
+        # i.e binary_morphology(source, expression, target)
+        return name == 'target' and not any(i.startswith('output') for i in names)
+
+    def _path_roles(self, fn, args, kwargs):
+        """split file name arguments of a callable into (reads, writes)
+        outputs are recognized by parameter names used in this class,
+        if there are none, files which don't exist yet are outputs"""
+        try:
+            bound = inspect.signature(fn).bind(*args, **kwargs).arguments
+        except (TypeError, ValueError, AttributeError):
+            bound = None
+        if bound is not None:
+            names = list(bound.keys())
+            reads=[]
+            writes=[]
+            for (n, v) in bound.items():
+                (writes if self._output_param(n, names) else reads).extend(self._path_args([v]))
+            if writes:
+                return (reads, writes)
+        paths  = self._path_args(args, kwargs)
+        writes = [i for i in paths if not os.path.exists(i) and os.path.abspath(i) not in self._writer]
+        return ([i for i in paths if i not in writes], writes)
+
+    def submit(self, fn, *args, **kwargs):
+        """Run a command asynchronously, returns concurrent.futures.Future
+        
+        fn -- either a command line (list), which is then executed by command() 
+              with keyword arguments inputs, outputs etc, 
+              or a callable, usually a method of this object, i.e minc.blur
+        
+        Jobs run on a pool of self.slots threads. A job waits for the last 
+        previously submitted job writing any of its files, and a job writing 
+        a file also waits for all jobs reading it since then, so temporary 
+        files could be reused. For command lines files are listed in inputs
+        and outputs, for callables every argument that looks like a file name 
+        is considered, outputs are recognized by parameter names (see 
+        _path_roles).
+        Call gather() to wait for completion.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1,self.slots))
+        
+        if isinstance(fn, list):
+            kwargs.setdefault('verbose', self.verbose)
+            _inputs  = kwargs.get('inputs')  or []
+            _outputs = kwargs.get('outputs') or []
+            if isinstance(_inputs, basestring):  _inputs  = [_inputs]
+            if isinstance(_outputs, basestring): _outputs = [_outputs]
+            _reads   = [i for i in list(_inputs) + self._path_args(fn[1:]) if i not in _outputs]
+            args     = (fn,)
+            fn       = self.command
+        else:
+            (_reads, _outputs) = self._path_roles(fn, args, kwargs)
+        _reads   = set(os.path.abspath(i) for i in _reads)
+        _outputs = set(os.path.abspath(i) for i in _outputs)
+        
+        deps=set( self._writer[i] for i in _reads | _outputs if i in self._writer )
+        for i in _outputs:
+            deps.update( self._readers.get(i, []) )
+        deps=set( d for d in deps if not d.done() )
+        # preserve stage label for tracing, and state of the workflow stage
+        label=profile.current_stage()
+        force=workflow.rerun_forced()
+        
+        def _job():
+            for d in deps:
+                d.result() # will re-raise exception of the dependency
+            with profile.stage(label):
+                return workflow.run_forced(force, fn, *args, **kwargs)
+        
+        # executor runs jobs in the order of submission, so dependencies 
+        # are always started before the jobs waiting for them
+        future=self._executor.submit(_job)
+        for o in _outputs:
+            self._writer[o]=future
+            self._readers[o]=[]
+        for i in _reads - _outputs:
+            self._readers.setdefault(i, []).append(future)
+        self._pending.append(future)
+        return future
+
+    def gather(self, futures=None):
+        """wait for submitted jobs (all by default) to finish, re-raise first error
+        returns list of results"""
+        if futures is None:
+            futures=self._pending
+        results=[]
+        error=None
+        for f in list(futures):
+            try:
+                results.append(f.result())
+            except Exception as e:
+                results.append(None)
+                if error is None: error=e
+        self._pending=[ f for f in self._pending if not f.done() ]
+        self._writer ={ k:f for k,f in self._writer.items() if not f.done() }
+        self._readers={ k:[f for f in l if not f.done()] for k,l in self._readers.items() }
+        self._readers={ k:l for k,l in self._readers.items() if l }
+        if error is not None:
+            raise error
+        return results
+
+    def _shutdown_jobs(self):
+        if self._executor is not None:
+            concurrent.futures.wait(self._pending)
+            self._executor.shutdown(wait=True)
+            self._executor=None
+            self._pending=[]
+            self._writer={}
+            self._readers={}
+
+    @staticmethod
+    def stage(label):
+        """label commands executed within the context for tracing, see ipl.profile"""
+        return profile.stage(label)
+
     @staticmethod
     def checkfiles(
         inputs=None,
@@ -274,6 +518,10 @@ class mincTools(temp_files):
                         if timer < itime or itime < 0:
                             itime = timer
 
+        # stage is out of date, existing outputs are stale
+        if workflow.rerun_forced():
+            return True
+
         # Check if outputs exist AND is newer than inputs
 
         outExists = False
@@ -307,7 +555,7 @@ class mincTools(temp_files):
         return True
 
     @staticmethod
-    def execute(cmds, verbose=1):
+    def execute(cmds, verbose=1, outputs=None):
         """
         Execute a command line waiting for the end of it
         Arguments:
@@ -315,6 +563,7 @@ class mincTools(temp_files):
         
         Keyword arguments:
         verbose: if false no message will appear
+        outputs: output files, used to select compression level (see ipl.compression.command_env)
 
         return : False if error, otherwise the execution output
         """
@@ -322,16 +571,14 @@ class mincTools(temp_files):
         output=""
         outvalue=0
         logger.debug(repr(cmds))
+        env=compression.command_env(cmds, outputs)
         try:
 
             if verbose<2:
                 with open(os.devnull, "w") as fnull:
-                    p=subprocess.Popen(cmds, stdout=fnull, stderr=subprocess.PIPE)
+                    (outvalue,output,output_stderr)=profile.run(cmds, stdout=fnull, stderr=subprocess.PIPE, env=env)
             else:
-                p=subprocess.Popen(cmds, stderr=subprocess.PIPE)
-            
-            (output,output_stderr)=p.communicate()
-            outvalue=p.wait()
+                (outvalue,output,output_stderr)=profile.run(cmds, stderr=subprocess.PIPE, env=env)
 
         except OSError:
             logger.error("command {} Error:{}!\nMessage: {}\n{}".format(str(cmds),str(outvalue),output_stderr,traceback.format_exc()))
@@ -342,12 +589,13 @@ class mincTools(temp_files):
         return outvalue
         
     @staticmethod
-    def execute_w_output(cmds, verbose=0):
+    def execute_w_output(cmds, verbose=0, outputs=None):
         """
         Execute a command line waiting for the end of it
 
         cmds: list containg the command line
         verbose: if false no message will appear
+        outputs: output files, used to select compression level (see ipl.compression.command_env)
 
         return : False if error, otherwise the execution output
         """
@@ -356,11 +604,10 @@ class mincTools(temp_files):
 
         if verbose>0:
             logger.debug(repr(cmds))
+        env=compression.command_env(cmds, outputs)
         try:
-            p=subprocess.Popen(cmds,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (output,outerr)=p.communicate()
+            (outvalue,output,outerr)=profile.run(cmds,stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
             logger.debug(output.decode())
-            outvalue=p.wait()
         except OSError as e:
             logger.error("command {} Error:{}!\n{}".format(repr(cmds),str(e),traceback.format_exc()))
             raise mincError("ERROR: command {} Error:{}!\n{}".format(repr(cmds),str(e),traceback.format_exc()))
@@ -387,6 +634,12 @@ class mincTools(temp_files):
         outputlines: store the output as a string 
         timecheck: The command won't be executed if the output exists and is newer than the input file.
 
+        If result cache is enabled (see ipl.result_cache), outputs of the same 
+        command applied to the same inputs are reused instead of recomputing
+        
+        MINC_COMPRESS is set according to the compression policy for outputs, 
+        see ipl.compression
+
         return : False if error, otherwise the execution output
         """
 
@@ -396,6 +649,14 @@ class mincTools(temp_files):
                                     verbose=verbose,
                                     timecheck=timecheck):
             return 0
+        
+        env=compression.command_env(cmds, outputs if outputs is not None else [])
+        cache=get_result_cache()
+        cache_key=None
+        if cache is not None:
+            cache_key=cache.key(cmds, inputs=inputs, outputs=outputs, env=env)
+            if cache.fetch(cache_key, outputs):
+                return 0
         outvalue=0
         output_stderr=""
         output=""
@@ -403,12 +664,11 @@ class mincTools(temp_files):
         try:
             if verbose<2:
                 with open(os.devnull, "w") as fnull:
-                    p=subprocess.Popen(cmds, stdout=fnull, stderr=subprocess.PIPE,shell=use_shell)
+                    (outvalue,output,output_stderr)=profile.run(cmds, stdout=fnull, stderr=subprocess.PIPE,shell=use_shell,
+                                                                env=env, inputs=inputs, outputs=outputs)
             else:
-                p=subprocess.Popen(cmds, stderr=subprocess.PIPE,shell=use_shell)
-            
-            (output,output_stderr)=p.communicate()
-            outvalue=p.wait()
+                (outvalue,output,output_stderr)=profile.run(cmds, stderr=subprocess.PIPE,shell=use_shell,
+                                                            env=env, inputs=inputs, outputs=outputs)
             
         except OSError:
             logger.error("command {} Error:{}!\nMessage: {}\n{}".format(str(cmds),str(outvalue),output_stderr,traceback.format_exc()))
@@ -430,9 +690,29 @@ class mincTools(temp_files):
 
         if not outExists:
             raise mincError('ERROR: Command didn not produce output: {}!'.format(str(cmds)))
+        
+        if cache_key is not None:
+            cache.store(cache_key, outputs, cmds=cmds)
 
         return outvalue
 
+    def _in_process(self, operation, inputs, outputs, *args, **kwargs):
+        """try to run operation with numpy backend
+        returns (True,result) on success and (False,None) if command line tool 
+        should be used instead
+        """
+        if self.backend != 'numpy':
+            return (False,None)
+        if outputs and not self.checkfiles(inputs=inputs, outputs=outputs,
+                                           verbose=self.verbose):
+            return (True,None)
+        try:
+            with profile.inprocess('numpy:'+operation, inputs=inputs, outputs=outputs):
+                return (True, getattr(numpy_backend, operation)(*args, **kwargs))
+        except numpy_backend.Unsupported as e:
+            logger.debug('Falling back to command line for {}:{}'.format(operation,str(e)))
+            return (False,None)
+
     @staticmethod
     def qsub(
         comm,
@@ -533,20 +813,13 @@ class mincTools(temp_files):
 
     @staticmethod
     def query_dimorder(input):
-        '''read a value of an attribute inside minc file'''
-
-        i = subprocess.Popen(['mincinfo', '-vardims', 'image', input],
-                             stdout=subprocess.PIPE).communicate()
-        return i[0].decode().rstrip('\n').split(' ')
+        '''read order of image dimensions inside minc file'''
+        return minc_header.dimorder(input)
     
     @staticmethod
     def query_attribute(input, attribute):
         '''read a value of an attribute inside minc file'''
-
-        i = subprocess.Popen(['mincinfo', '-attvalue', attribute,
-                             input],
-                             stdout=subprocess.PIPE).communicate()
-        return i[0].decode().rstrip('\n').rstrip(' ')
+        return minc_header.attribute(input, attribute)
         
     @staticmethod
     def set_attribute(input, attribute, value):
@@ -569,31 +842,9 @@ class mincTools(temp_files):
         Arguments:
             input -- input minc file
         Returns dict with entries per dimension
+        Header information is cached, see ipl.minc_header
         """
-        # TODO: make this robust to errors!
-        _image_dims = subprocess.Popen(['mincinfo', '-vardims', 'image', input],
-                             stdout=subprocess.PIPE).communicate()[0].decode().rstrip('\n').rstrip(' ').split(' ')
-        
-        _req=['mincinfo']
-        for i in _image_dims:
-            _req.extend(['-dimlength',i,
-                         '-attvalue', '{}:start'.format(i),
-                         '-attvalue', '{}:step'.format(i), 
-                         '-attvalue', '{}:direction_cosines'.format(i)])
-        _req.append(input)
-        _info= subprocess.Popen(_req,
-                             stdout=subprocess.PIPE).communicate()[0].decode().rstrip('\n').rstrip(' ').split("\n")
-
-        diminfo=collections.namedtuple('dimension',['length','start','step','direction_cosines'])
-        
-        _result={}
-        for i,j in enumerate(_image_dims):
-            _result[j]=diminfo(length=int(_info[i*4]),
-                               start=float(_info[i*4+1]),
-                               step=float(_info[i*4+2]),
-                               direction_cosines=[float(k) for k in _info[i*4+3].rstrip(' ').split(' ') ])
-            
-        return _result
+        return minc_header.dims(input)
         
 
     def resample_smooth(
@@ -893,6 +1144,10 @@ class mincTools(temp_files):
         datatype=None,
         ):
         """average images"""
+        _outputs=[output] if sdfile is None else [output,sdfile]
+        if self._in_process('average', inputs, _outputs,
+                            inputs, output, sdfile=sdfile, datatype=datatype)[0]:
+            return
 
         cmd = ['mincaverage', '-q', '-clob']
         cmd.extend(inputs)
@@ -913,6 +1168,10 @@ class mincTools(temp_files):
         datatype=None,
         ):
         """average images"""
+        _outputs=[output] if madfile is None else [output,madfile]
+        if self._in_process('median', inputs, _outputs,
+                            inputs, output, madfile=madfile, datatype=datatype)[0]:
+            return
 
         cmd = ['minc_median', '--clob']
         cmd.extend(inputs)
@@ -936,6 +1195,9 @@ class mincTools(temp_files):
         zero=False
         ):
         """apply mathematical expression to image(s)"""
+        if self._in_process('calc', inputs, [output],
+                            inputs, expression, output, datatype=datatype, labels=labels, zero=zero)[0]:
+            return
 
         cmd = ['minccalc', '-copy_header','-q', '-clob', '-express', expression]
         
@@ -960,6 +1222,9 @@ class mincTools(temp_files):
         labels=False
         ):
         """apply mathematical operation to image(s)"""
+        if self._in_process('math', inputs, [output],
+                            inputs, operation, output, datatype=datatype, labels=labels)[0]:
+            return
 
         cmd = ['mincmath', '-q', '-clob', '-copy_header', '-'+operation]
         
@@ -980,6 +1245,12 @@ class mincTools(temp_files):
               val_ceil=None,
               val_range=None,
               single_value=True):
+        (done,r)=self._in_process('stats', [input], None,
+                                  input, stats, mask=mask, mask_binvalue=mask_binvalue,
+                                  val_floor=val_floor, val_ceil=val_ceil, val_range=val_range,
+                                  single_value=single_value)
+        if done:
+            return r
         args=['mincstats',input,'-q']
         
         if isinstance(stats, list): 
@@ -1707,6 +1978,12 @@ class mincTools(temp_files):
         """reshape minc files, #TODO add more options to fully support mincreshape"""
         if signed and unsigned:
             raise mincError('Attempt to reshape file to have both signed and unsigned datatype')
+        if self._in_process('reshape', [input], [output],
+                            input, output, normalize=normalize, datatype=datatype,
+                            image_range=image_range, valid_range=valid_range,
+                            dimorder=dimorder, signed=signed, unsigned=unsigned,
+                            dimrange=dimrange)[0]:
+            return
         cmd = ['mincreshape', input, output, '-q']
         if image_range:
             cmd.extend(['-image_range', str(image_range[0]),
@@ -1777,7 +2054,90 @@ class mincTools(temp_files):
                     volume=None, 
                     median=False, 
                     mask=None):
-        ''' calculate label statistics : label_id, volume, mx, my, mz,[mean/median] '''
+        ''' calculate label statistics : label_id, volume, mx, my, mz,[mean/median] 
+        uses itk_label_stats unless backend is 'numpy' '''
+        if self.backend != 'numpy':
+            return self._itk_label_stats(input, bg=bg, label_defs=label_defs, volume=volume,
+                                         median=median, mask=mask)
+        rows=self.label_table([input], volumes=[volume], masks=[mask], bg=bg,
+                              label_defs=label_defs, median=median and volume is not None)
+        out=[]
+        for r in rows:
+            row=[r['label'], r['volume']] + r['centroid']
+            if volume is not None:
+                row.append(r['median'][0] if median else r['mean'][0])
+            out.append(row)
+        return out
+
+    def label_table(self, labels,
+                    volumes=None,
+                    masks=None,
+                    bg=False,
+                    label_defs=None,
+                    median=False,
+                    sd=False):
+        '''
+        calculate statistics of many label volumes at once, reading every file only once
+        
+        Arguments:
+        labels -- list of label volumes
+        
+        Keyword arguments:
+        volumes -- intensity volume (or list of volumes) for each label volume
+        masks -- mask (or list of masks) for each label volume
+        bg -- include background label
+        label_defs -- label names (dict, list or csv file)
+        median -- calculate per-label median of intensity volumes
+        sd -- calculate per-label standard deviation of intensity volumes
+        
+        return : list of rows {'input','labels','mask','label','count','volume','centroid','mean','median','sd'},
+                 input is the index of the label volume in labels,
+                 mean, median and sd are lists with one entry per intensity volume
+        
+        Uses in-process numpy implementation with backend='numpy',
+        itk_label_stats otherwise
+        '''
+        labels=labels if isinstance(labels, list) else [labels]
+        volumes=volumes if volumes is not None else [None]*len(labels)
+        masks=masks if masks is not None else [None]*len(labels)
+        if self.backend=='numpy' and numpy_backend.have_numpy_backend:
+            _inputs=[i for i in labels+volumes+masks if isinstance(i, basestring)]
+            try:
+                with profile.inprocess('numpy:label_table', inputs=_inputs):
+                    return numpy_backend.label_table(labels, volumes=volumes, masks=masks, bg=bg,
+                                                     label_defs=label_defs, median=median, sd=sd,
+                                                     threads=self.slots)
+            except numpy_backend.Unsupported as e:
+                logger.debug('Falling back to itk_label_stats:{}'.format(str(e)))
+        if sd:
+            raise mincError('Per-label SD is only available with numpy backend')
+
+        out=[]
+        for k,(l,v,m) in enumerate(zip(labels, volumes, masks)):
+            v=v if isinstance(v, list) else ([v] if v is not None else [])
+            m=m if isinstance(m, list) else [m]
+            for _m in m:
+                rows=collections.OrderedDict()
+                for r in self._itk_label_stats(l, bg=bg, label_defs=label_defs, mask=_m):
+                    rows[r[0]]={'input':k, 'labels':l, 'mask':_m, 'label':r[0], 'count':None,
+                                'volume':r[1], 'centroid':r[2:5],
+                                'mean':[], 'median':[], 'sd':[]}
+                for _v in v:
+                    _stats=['mean','median'] if median else ['mean']
+                    for stat in _stats:
+                        for r in self._itk_label_stats(l, bg=bg, label_defs=label_defs, mask=_m,
+                                                       volume=_v, median=(stat=='median')):
+                            rows[r[0]][stat].append(r[5])
+                out.extend(rows.values())
+        return out
+
+    def _itk_label_stats(self, input, 
+                    bg=False, 
+                    label_defs=None, 
+                    volume=None, 
+                    median=False, 
+                    mask=None):
+        ''' run itk_label_stats : label_id, volume, mx, my, mz,[mean/median] '''
         _label_file=label_defs
         cmd=['itk_label_stats',input]
         if bg: cmd.append('--bg')
@@ -1946,6 +2306,11 @@ class mincTools(temp_files):
             shutil.rmtree(temp_dir)
 
     def binary_morphology(self, source, expression, target , binarize_bimodal=False, binarize_threshold=None):
+        if self._in_process('binary_morphology', [source], [target],
+                            source, expression, target, 
+                            binarize_bimodal=binarize_bimodal, 
+                            binarize_threshold=binarize_threshold)[0]:
+            return
         cmd=['itk_morph',source,target]
         if expression is not None and expression!='':
             cmd.extend(['--exp',expression])
@@ -2108,8 +2473,14 @@ class mincTools(temp_files):
         self.command(cmd, inputs=inputs,outputs=[output], verbose=self.verbose)
         
         
-    def downsample_registration_files(self, sources, targets, source_mask, target_mask, downsample=None):
-        if downsample is not None:
+    def downsample_registration_files(self, sources, targets, source_mask, target_mask, downsample=None, pyramid=None):
+        if downsample is not None and pyramid is not None:
+            # reuse shared copies, see ipl.pyramid
+            sources_lr=[pyramid.downsample(i,downsample) for i in sources]
+            targets_lr=[pyramid.downsample(i,downsample) for i in targets]
+            source_mask_lr=pyramid.downsample(source_mask,downsample,labels=True) if source_mask is not None else None
+            target_mask_lr=pyramid.downsample(target_mask,downsample,labels=True) if target_mask is not None else None
+        elif downsample is not None:
             sources_lr=[]
             targets_lr=[]
             for _s,_ in enumerate(sources):
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Convergence of iterative model creation
+#
+# After every iteration the following is recorded in <prefix>/convergence.json:
+#   rms_change   -- RMS intensity change of the model (within mask)
+#   displacement -- mean displacement magnitude of the averaged correction
+#                   transformation (mm)
+#   sd           -- median SD of the model
+#   sd_change    -- relative change of sd since the previous iteration
+# Only values used by the stopping rule are calculated, the others are
+# recorded as null.
+#
+# Stopping rule is set with options['convergence'], i.e:
+#   {"rms": 1.0, "displacement": 0.2, "sd": 0.01, "min_iter": 2}
+# when all given criteria are below thresholds, after at least min_iter
+# iterations at the current stage of protocol, remaining iterations of the
+# stage are skipped.
+
+import os
+import json
+import itertools
+
+import numpy as np
+
+from ipl import minc_header
+from ipl import numpy_backend
+from ipl import xfm_average
+from ipl.minc_tools import mincError
+
+from .structures import MriDataset
+from .filter import model_difference
+
+_criteria = {'rms': 'rms_change', 'displacement': 'displacement', 'sd': 'sd_change'}
+
+
+def vector_magnitude(path):
+    """mean magnitude of a vector field (displacement grid or velocity),
+    None if it can't be calculated in-process"""
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        (vol, f) = numpy_backend.load(path)
+        f.close()
+    except numpy_backend.Unsupported:
+        return None
+    axis = minc_header.header(path)['dimorder'].index('vector_dimension')
+    return float(np.mean(np.sqrt(np.sum(vol * vol, axis=axis))))
+
+
+def linear_magnitude(mat, like):
+    """mean displacement of corners of the volume like by a linear
+    transformation"""
+    dims = minc_header.header(like)['dims']
+    corners = []
+    for idx in itertools.product((0, 1), repeat=3):
+        p = np.zeros(3)
+        for (k, d) in zip(idx, ('xspace', 'yspace', 'zspace')):
+            (length, start, step, cos) = dims[d]
+            p += (start + k * (length - 1) * step) * np.asarray(cos)
+        corners.append(p)
+    corners = np.asarray(corners)
+    moved = corners.dot(mat[0:3, 0:3].T) + mat[0:3, 3]
+    return float(np.mean(np.sqrt(np.sum((moved - corners) ** 2, axis=1))))
+
+
+def transform_displacement(transform, like=None):
+    """mean displacement of MriTransform or LDDMriTransform, like is needed
+    for linear transformations"""
+    if transform is None:
+        return None
+    if hasattr(transform, 'vel'):
+        return vector_magnitude(transform.vel)
+    if not xfm_average.have_minc2_simple or not os.path.exists(transform.xfm):
+        return None
+    try:
+        t = xfm_average.read_transform(transform.xfm)
+    except numpy_backend.Unsupported:
+        return None
+    if t[0] == 'linear':
+        return linear_magnitude(t[1], like) if like is not None else None
+    return vector_magnitude(t[1])
+
+
+def _same_sampling(a, b):
+    return minc_header.header(a)['dims'] == minc_header.header(b)['dims']
+
+
+def rms_change(model, previous, mask=None):
+    """RMS intensity change between two volumes, None if they have
+    different sampling"""
+    if previous is None or not os.path.exists(previous) or not _same_sampling(model, previous):
+        return None
+    if mask is not None and (not os.path.exists(mask) or not _same_sampling(model, mask)):
+        mask = None
+    return model_difference(MriDataset(scan=model), MriDataset(scan=previous), mask=mask)
+
+
+class ConvergenceMonitor(object):
+    """history of model changes, and stopping rule"""
+
+    def __init__(self, prefix, options={}):
+        self.path = prefix + os.sep + 'convergence.json'
+        self.rule = options.get('convergence', None)
+        self.history = []
+        self._sd = None
+        self._stage = None
+        self._stage_iter = 0
+
+    def uses(self, criterion):
+        """check if stopping rule depends on criterion ('rms', 'displacement'
+        or 'sd'), callers don't have to calculate unused values"""
+        return bool(self.rule) and criterion in self.rule
+
+    def update(self, it, stage, level, model, previous=None, displacement=None, sd=None, mask=None):
+        """record changes after an iteration, returns True if remaining
+        iterations at this stage of protocol should be skipped
+
+        stage, level    -- index of the protocol stage, and its level
+        model, previous -- volumes of the new and the previous estimate
+        displacement    -- of the averaged correction transformation,
+                           see transform_displacement
+        sd              -- median SD of the new estimate
+        """
+        if stage != self._stage:
+            self._stage = stage
+            self._stage_iter = 0
+        self._stage_iter += 1
+
+        _rms = None
+        if self.uses('rms'):
+            try:
+                _rms = rms_change(model, previous, mask=mask)
+            except mincError:
+                pass
+        r = {'iter':         it,
+             'stage':        stage,
+             'level':        level,
+             'rms_change':   _rms,
+             'displacement': displacement,
+             'sd':           sd,
+             'sd_change':    None}
+        if sd is not None and self._sd:
+            r['sd_change'] = abs(sd - self._sd) / abs(self._sd)
+        if sd is not None:
+            self._sd = sd
+        r['converged'] = self._converged(r)
+        self.history.append(r)
+        self.save()
+        if r['converged']:
+            print("Iteration {}: model converged at level {}, {}".format(
+                it, level, ', '.join('{}={}'.format(k, r[v]) for (k, v) in _criteria.items() if k in self.rule)))
+        return r['converged']
+
+    def _converged(self, r):
+        if not self.rule:
+            return False
+        if self._stage_iter < self.rule.get('min_iter', 1):
+            return False
+        checked = False
+        for (k, v) in _criteria.items():
+            if k in self.rule:
+                if r[v] is None or r[v] > self.rule[k]:
+                    return False
+                checked = True
+        return checked
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({'rule': self.rule, 'history': self.history}, f, indent=1)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
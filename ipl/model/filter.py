@@ -3,9 +3,11 @@ import os
 import sys
 import csv
 import traceback
+import math
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl.stream     import mean_sd,reduce_samples,x_symmetric,iterate
 
 try:
     from minc2_simple import minc2_file
@@ -19,67 +21,8 @@ except ImportError:
 
 def faster_average(infiles, out_avg, out_sd=None, binary=False, threshold=0.5):
     # faster then mincaverage for large number of samples
-    ref=minc2_file(infiles[0])
-    dims_ref=ref.store_dims()
-    o_avg=minc2_file()
-    
-    if binary:
-        o_avg.define(dims_ref, minc2_file.MINC2_BYTE,  minc2_file.MINC2_BYTE)
-    else:
-        o_avg.define(dims_ref, minc2_file.MINC2_FLOAT, minc2_file.MINC2_FLOAT)
-        
-    o_avg.create(out_avg)
-    o_avg.copy_metadata(ref)
-    o_avg.setup_standard_order()
-    
-    if out_sd is not None:
-        o_sd=minc2_file()
-        o_sd.define(dims_ref, minc2_file.MINC2_FLOAT, minc2_file.MINC2_FLOAT)
-        o_sd.create(out_sd)
-        o_sd.copy_metadata(ref)
-        o_sd.setup_standard_order()
-
-    ref.setup_standard_order()
-    
-    # iterate over all input files and update avg and sd
-    vol_avg=ref.load_complete_volume(minc2_file.MINC2_FLOAT).astype(np.float64)
-    ref.close()
-    
-    if out_sd is not None:
-        vol_sd=vol_avg*vol_avg
-
-    lll=1.0
-
-    for i in range(1,len(infiles)):
-        print(infiles[i])
-        in_minc=minc2_file(infiles[i])
-        #TODO: check dimensions
-        in_minc.setup_standard_order()
-        v=in_minc.load_complete_volume(minc2_file.MINC2_FLOAT).astype(np.float64)
-        in_minc.close()
-        vol_avg+=v
-        lll+=1.0
-
-        if out_sd is not None:
-            vol_sd+=v*v
-
-        
-    #Averaging
-    vol_avg/=lll
-    
-    if binary:
-        # binarize:
-        vol_avg=np.greater(vol_avg,threshold).astype('int8')
-    else:
-        vol_avg=vol_avg.astype(np.float)
-    
-    o_avg.save_complete_volume(vol_avg)
-    
-    if out_sd is not None:
-        vol_sd/=lll
-        vol_sd-=vol_avg*vol_avg
-        vol_sd=np.sqrt(vol_sd).astype(np.float)
-        o_sd.save_complete_volume(vol_sd)
+    # volumes are processed slab by slab, to keep memory usage bounded
+    mean_sd(infiles, out_avg, output_sd=out_sd, binary=binary, threshold=threshold)
 
 
 def generate_flip_sample(input):
@@ -144,17 +87,21 @@ def average_samples(
             if output_sd:
                 out_sd=output_sd.scan
 
-            if median:
+            # flip averages in the same pass, if sampling allows it
+            in_pass = symmetrize and have_minc2_simple and x_symmetric(avg[0])
+            if in_pass:
+                out_scan=output.scan
+
+            if have_minc2_simple:
+                # samples are read in parallel, slab by slab
+                reduce_samples(avg, out_scan, output_sd=out_sd,
+                               median=median, symmetrize=in_pass)
+            elif median:
                 m.median(avg, out_scan,madfile=out_sd)
             else:
-                if have_minc2_simple:
-                    faster_average(avg,out_scan,out_sd=out_sd)
-                else:
-                    m.average(avg, out_scan,sdfile=out_sd)
+                m.average(avg, out_scan,sdfile=out_sd)
 
-            if symmetrize:
-                # TODO: replace flipping of averages with averaging of flipped 
-                # some day
+            if symmetrize and not in_pass:
                 m.flip_volume_x(out_scan,m.tmp('flip.mnc'))
                 m.average([out_scan,m.tmp('flip.mnc')],output.scan)
             
@@ -170,26 +117,18 @@ def average_samples(
 
                 if not os.path.exists(output.mask):
                     
-                    if symmetrize:
-                        if have_minc2_simple:
-                            faster_average(avg,m.tmp('avg_mask.mnc'))
-                        else:
-                            m.average(avg,m.tmp('avg_mask.mnc'),datatype='-float')
-                        
+                    if have_minc2_simple:
+                        reduce_samples(avg,m.tmp('avg_mask.mnc'),symmetrize=in_pass)
+                    else:
+                        m.average(avg,m.tmp('avg_mask.mnc'),datatype='-float')
+
+                    if symmetrize and not in_pass:
                         m.flip_volume_x(m.tmp('avg_mask.mnc'),m.tmp('flip_avg_mask.mnc'))
                         m.average([m.tmp('avg_mask.mnc'),m.tmp('flip_avg_mask.mnc')],m.tmp('sym_avg_mask.mnc'),datatype='-float')
                         m.calc([m.tmp('sym_avg_mask.mnc')],'A[0]>=0.5?1:0',output.mask, datatype='-byte',labels=True)
                     else:
-                        if have_minc2_simple:
-                            faster_average(avg,m.tmp('avg_mask.mnc'))
-                        else:
-                            m.average(avg,m.tmp('avg_mask.mnc'),datatype='-float')
                         m.calc([m.tmp('avg_mask.mnc')],'A[0]>=0.5?1:0',output.mask, datatype='-byte',labels=True)
 
-
-                    
-                    
-
         return  True
     except mincError as e:
         print("Exception in average_samples:{}".format(str(e)))
@@ -223,6 +162,40 @@ def average_stats(
         raise
 
 
+def model_difference(
+    model,
+    ref,
+    mask=None
+    ):
+    """RMS intensity difference between two estimates of a model within mask"""
+    try:
+        if have_minc2_simple:
+            inputs=[model.scan, ref.scan]
+            if mask is not None:
+                inputs.append(mask)
+            ssd=0.0
+            cnt=0
+            for (z0,z1,s) in iterate(inputs):
+                d=s[0].astype(np.float64)-s[1]
+                if mask is not None:
+                    d=d[s[2]>0.5]
+                ssd+=float(np.sum(d*d))
+                cnt+=d.size
+            return math.sqrt(ssd/cnt) if cnt>0 else 0.0
+        else:
+            with mincTools() as m:
+                m.calc([model.scan, ref.scan],'(A[0]-A[1])*(A[0]-A[1])',m.tmp('diff2.mnc'),datatype='-float')
+                return math.sqrt(float(m.stats(m.tmp('diff2.mnc'),'-mean',mask=mask)))
+    except mincError as e:
+        print("mincError in model_difference:{}".format(repr(e)))
+        traceback.print_exc(file=sys.stdout)
+        raise
+    except :
+        print("Exception in model_difference:{}".format(sys.exc_info()[0]))
+        traceback.print_exc(file=sys.stdout)
+        raise
+
+
 def calculate_diff_bias_field(sample, model, output, symmetric=False, distance=100, n4=False ):
     try:
         with mincTools() as m:
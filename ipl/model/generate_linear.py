@@ -16,6 +16,9 @@ from ipl.model.filter           import resample_and_correct_bias
 from ipl.model.registration     import linear_register_step, non_linear_register_step
 from ipl.model.registration     import average_transforms
 from ipl.model.resample         import concat_resample, concat_resample_nl
+from ipl.model.convergence      import ConvergenceMonitor, transform_displacement
+from ipl.pyramid                import PyramidCache
+from ipl.workflow               import run_forced, rerun_forced
 
 from scoop import futures, shared
 
@@ -61,10 +64,14 @@ def generate_linear_average(
     downsample = options.get('downsample',None)
     use_n4     = options.get('N4',False)
     use_median = options.get('median',False)
+    use_pyramid= options.get('pyramid',False)
 
     models=[]
     models_sd=[]
     models_bias=[]
+    convergence=ConvergenceMonitor(prefix, options)
+    # opt-in: downsampled and blurred samples are kept between iterations
+    pyramid=PyramidCache(prefix+os.sep+'pyramid') if use_pyramid else None
 
     if symmetric:
         flipdir=prefix+os.sep+'flip'
@@ -80,7 +87,7 @@ def generate_linear_average(
             if s.mask is not None:
                 s.mask_f=prefix+os.sep+'flip'+os.sep+'mask_'+_s_name
 
-            flip_all.append( futures.submit( generate_flip_sample,s )  )
+            flip_all.append( futures.submit(run_forced, rerun_forced(), generate_flip_sample,s )  )
 
         futures.wait(flip_all, return_when=futures.ALL_COMPLETED)
 
@@ -117,7 +124,7 @@ def generate_linear_average(
 
             if it>skip and it<stop_early:
                 transforms.append(
-                    futures.submit(
+                    futures.submit(run_forced, rerun_forced(),
                         linear_register_step,
                         s,
                         current_model,
@@ -130,7 +137,8 @@ def generate_linear_average(
                         linreg=linreg,
                         work_dir=prefix,
                         bias=prev_bias_field,
-                        downsample=downsample)
+                        downsample=downsample,
+                        pyramid=pyramid)
                     )
                 inv_transforms.append(sample_inv_xfm)
                 fwd_transforms.append(sample_xfm)
@@ -139,6 +147,11 @@ def generate_linear_average(
         # wait for jobs to finish
         if it>skip and it<stop_early:
             futures.wait(transforms, return_when=futures.ALL_COMPLETED)
+
+        # versions of the current model are not needed anymore
+        if pyramid is not None:
+            pyramid.evict(current_model.scan)
+            pyramid.evict(current_model.mask)
     
         # remove information from previous iteration
         if cleanup and it>1 :
@@ -152,11 +165,13 @@ def generate_linear_average(
 
         # 2 average all transformations
         if it>skip and it<stop_early:
-            result=futures.submit(
+            result=futures.submit(run_forced, rerun_forced(),
                 average_transforms, inv_transforms, avg_inv_transform, nl=False, symmetric=symmetric
                 # TODO: maybe make median transforms?
                 )
             futures.wait([result], return_when=futures.ALL_COMPLETED)
+            displacement=transform_displacement(avg_inv_transform, like=current_model.scan) \
+                if convergence.uses('displacement') else None
 
         corr=[]
         corr_transforms=[]
@@ -172,7 +187,7 @@ def generate_linear_average(
             x=MriTransform(name=s.name+'_corr',prefix=it_prefix,iter=it,linear=True)
             
             if it>skip and it<stop_early:
-                corr.append(futures.submit( 
+                corr.append(futures.submit(run_forced, rerun_forced(),
                     concat_resample, s, fwd_transforms[i], avg_inv_transform, 
                     c, x, current_model, symmetric=symmetric, qc=qc, bias=prev_bias_field 
                     ))
@@ -193,7 +208,7 @@ def generate_linear_average(
             
         # 4 average resampled samples to create new estimate
         if it>skip and it<stop_early:
-            result=futures.submit(
+            result=futures.submit(run_forced, rerun_forced(),
                 average_samples, corr_samples, next_model, next_model_sd, symmetric=symmetric, symmetrize=symmetric,median=use_median
                 )
 
@@ -218,7 +233,7 @@ def generate_linear_average(
                 b=MriDataset(prefix=it_prefix,iter=it,name='bias_'+s.name)
                 
                 if it>skip and it<stop_early:
-                    biascorr_results.append( futures.submit( 
+                    biascorr_results.append( futures.submit(run_forced, rerun_forced(),
                         calculate_diff_bias_field, 
                             c, next_model, b, symmetric=symmetric, distance=biasdist,
                             n4=use_n4
@@ -228,7 +243,7 @@ def generate_linear_average(
             if it>skip and it<stop_early:
                 futures.wait(biascorr_results, return_when=futures.ALL_COMPLETED)
 
-                result=futures.submit( 
+                result=futures.submit(run_forced, rerun_forced(),
                     average_bias_fields, new_bias_fields, next_model_bias, symmetric=symmetric
                     )
                 futures.wait([result], return_when=futures.ALL_COMPLETED)
@@ -244,7 +259,7 @@ def generate_linear_average(
                 b=new_bias_fields[i]
                 out=MriDataset(prefix=it_prefix,iter=it,name='c_bias_'+s.name)
                 if it>skip and it<stop_early:
-                    biascorr_results.append( futures.submit( 
+                    biascorr_results.append( futures.submit(run_forced, rerun_forced(),
                         resample_and_correct_bias, b, x , next_model_bias, out, previous=prev_bias_field, symmetric=symmetric 
                         ) )
                 new_corr_bias_fields.append( out )
@@ -255,11 +270,18 @@ def generate_linear_average(
         # swap bias fields
         if biascorr: bias_fields=new_bias_fields
         
+        previous_model=current_model
         current_model=next_model
         current_model_sd=next_model_sd
         
         if it>skip and it<stop_early:
-            sd.append( futures.submit(average_stats, next_model, next_model_sd ) )
+            sd.append( futures.submit(run_forced, rerun_forced(), average_stats, next_model, next_model_sd ) )
+            # skip remaining iterations if converged
+            if convergence.update(it, 0, None, next_model.scan, previous_model.scan,
+                                  displacement=displacement,
+                                  sd=sd[-1].result() if convergence.uses('sd') else None,
+                                  mask=next_model.mask):
+                break
 
     # copy output to the destination
     futures.wait(sd, return_when=futures.ALL_COMPLETED)
@@ -278,6 +300,9 @@ def generate_linear_average(
             m.cleanup()
         for m in models_sd:
             m.cleanup()
+
+        if pyramid is not None:
+            pyramid.cleanup()
             
     results={
             'model':     current_model,
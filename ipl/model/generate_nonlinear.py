@@ -11,6 +11,7 @@ from ipl.minc_tools import mincTools,mincError
 from ipl.model.structures       import MriDataset, MriTransform,MRIEncoder
 from ipl.model.filter           import generate_flip_sample, normalize_sample
 from ipl.model.filter           import average_samples,average_stats
+from ipl.model.filter           import model_difference
 from ipl.model.filter           import calculate_diff_bias_field,average_bias_fields
 from ipl.model.filter           import resample_and_correct_bias
 
@@ -20,8 +21,11 @@ from ipl.model.registration     import dd_register_step
 from ipl.model.registration     import ants_register_step
 from ipl.model.registration     import elastix_register_step
 from ipl.model.registration     import average_transforms
+from ipl.model.convergence      import ConvergenceMonitor, transform_displacement
 from ipl.model.resample         import concat_resample
 from ipl.model.resample         import concat_resample_nl
+from ipl.pyramid                import PyramidCache
+from ipl.workflow               import run_forced, rerun_forced
 
 from scoop import futures, shared
 
@@ -67,9 +71,13 @@ def generate_nonlinear_average(
     use_elastix=   options.get('use_elastix',False)
     start_level=   options.get('start_level',None)
     use_median=    options.get('median',False)
+    use_pyramid=   options.get('pyramid',False)
 
     models=[]
     models_sd=[]
+    convergence=ConvergenceMonitor(prefix, options)
+    # opt-in: downsampled and blurred samples are kept between iterations
+    pyramid=PyramidCache(prefix+os.sep+'pyramid') if use_pyramid else None
 
     if symmetric:
         flipdir=prefix+os.sep+'flip'
@@ -85,12 +93,12 @@ def generate_nonlinear_average(
             if s.mask is not None:
                 s.mask_f=prefix+os.sep+'flip'+os.sep+'mask_'+_s_name
 
-            flip_all.append( futures.submit( generate_flip_sample,s )  )
+            flip_all.append( futures.submit(run_forced, rerun_forced(), generate_flip_sample,s )  )
 
         futures.wait(flip_all, return_when=futures.ALL_COMPLETED)
     # go through all the iterations
     it=0
-    for (i,p) in enumerate(protocol):
+    for (stage,p) in enumerate(protocol):
         downsample=p.get('downsample',downsample_)
         for j in range(1,p['iter']+1):
             it+=1
@@ -129,7 +137,7 @@ def generate_nonlinear_average(
                 if it>skip and it<stop_early:
                     if use_dd:
                         transforms.append(
-                            futures.submit(
+                            futures.submit(run_forced, rerun_forced(),
                                 dd_register_step,
                                 s,
                                 current_model,
@@ -145,7 +153,7 @@ def generate_nonlinear_average(
                             )
                     elif use_ants:
                         transforms.append(
-                            futures.submit(
+                            futures.submit(run_forced, rerun_forced(),
                                 ants_register_step,
                                 s,
                                 current_model,
@@ -157,11 +165,12 @@ def generate_nonlinear_average(
                                 level=p['level'],
                                 start=start,
                                 work_dir=prefix,
-                                downsample=downsample)
+                                downsample=downsample,
+                                pyramid=pyramid)
                             )
                     elif use_elastix:
                         transforms.append(
-                            futures.submit(
+                            futures.submit(run_forced, rerun_forced(),
                                 elastix_register_step,
                                 s,
                                 current_model,
@@ -177,7 +186,7 @@ def generate_nonlinear_average(
                             )
                     else:
                         transforms.append(
-                            futures.submit(
+                            futures.submit(run_forced, rerun_forced(),
                                 non_linear_register_step,
                                 s,
                                 current_model,
@@ -189,7 +198,8 @@ def generate_nonlinear_average(
                                 level=p['level'],
                                 start=start,
                                 work_dir=prefix,
-                                downsample=downsample)
+                                downsample=downsample,
+                                pyramid=pyramid)
                             )
                 inv_transforms.append(sample_inv_xfm)
                 fwd_transforms.append(sample_xfm)
@@ -198,6 +208,11 @@ def generate_nonlinear_average(
             if it>skip and it<stop_early:
                 futures.wait(transforms, return_when=futures.ALL_COMPLETED)
 
+            # versions of the current model are not needed anymore
+            if pyramid is not None:
+                pyramid.evict(current_model.scan)
+                pyramid.evict(current_model.mask)
+
             if cleanup and it>1 :
                 # remove information from previous iteration
                 for s in corr_samples:
@@ -210,8 +225,10 @@ def generate_nonlinear_average(
 
             # 2 average all transformations
             if it>skip and it<stop_early:
-                result=futures.submit(average_transforms, inv_transforms, avg_inv_transform, nl=True, symmetric=symmetric)
+                result=futures.submit(run_forced, rerun_forced(), average_transforms, inv_transforms, avg_inv_transform, nl=True, symmetric=symmetric)
                 futures.wait([result], return_when=futures.ALL_COMPLETED)
+                displacement=transform_displacement(avg_inv_transform) \
+                    if convergence.uses('displacement') else None
 
             corr=[]
             corr_transforms=[]
@@ -222,7 +239,7 @@ def generate_nonlinear_average(
                 x=MriTransform(name=s.name+'_corr',prefix=it_prefix,iter=it)
 
                 if it>skip and it<stop_early:
-                    corr.append(futures.submit( 
+                    corr.append(futures.submit(run_forced, rerun_forced(),
                         concat_resample_nl, 
                         s, 
                         fwd_transforms[i], 
@@ -247,7 +264,7 @@ def generate_nonlinear_average(
                 
             # 4 average resampled samples to create new estimate
             if it>skip and it<stop_early:
-                result=futures.submit(average_samples, corr_samples, next_model, next_model_sd, symmetric=symmetric, symmetrize=symmetric,median=use_median)
+                result=futures.submit(run_forced, rerun_forced(), average_samples, corr_samples, next_model, next_model_sd, symmetric=symmetric, symmetrize=symmetric,median=use_median)
                 futures.wait([result], return_when=futures.ALL_COMPLETED)
 
             if cleanup and it>1:
@@ -255,12 +272,19 @@ def generate_nonlinear_average(
                 models.append(next_model)
                 models_sd.append(next_model_sd)
 
+            previous_model=current_model
             current_model=next_model
             current_model_sd=next_model_sd
 
             if it>skip and it<stop_early:
-                result=futures.submit(average_stats, next_model, next_model_sd)
+                result=futures.submit(run_forced, rerun_forced(), average_stats, next_model, next_model_sd)
                 sd.append(result)
+                # skip remaining iterations at this level if converged
+                if convergence.update(it, stage, p['level'], next_model.scan, previous_model.scan,
+                                      displacement=displacement,
+                                      sd=result.result() if convergence.uses('sd') else None,
+                                      mask=next_model.mask):
+                    break
     
     # copy output to the destination
     futures.wait(sd, return_when=futures.ALL_COMPLETED)
@@ -292,8 +316,307 @@ def generate_nonlinear_average(
         for m in models_sd:
             m.cleanup()
 
+        if pyramid is not None:
+            pyramid.cleanup()
+
     return results
 
+def _load_dataset(d):
+    """MriDataset from results.json"""
+    s=MriDataset(scan=d['scan'],mask=d['mask'],name=d['name'],iter=d['iter'],
+                 par_int=d.get('par_int',[]),par_def=d.get('par_def',[]))
+    s.scan_f=d.get('scan_f',None)
+    s.mask_f=d.get('mask_f',None)
+    return s
+
+
+def _load_transform(d):
+    """MriTransform from results.json"""
+    x=MriTransform(prefix=os.path.dirname(d['xfm']),name=d['name'],iter=d['iter'],
+                   linear=d.get('linear',False))
+    x.xfm=d['xfm']
+    x.grid=d['grid']
+    x.xfm_f=d.get('xfm_f',None)
+    x.grid_f=d.get('grid_f',None)
+    return x
+
+
+def update_nonlinear_average(
+    samples,
+    previous,
+    prefix='.',
+    options={}
+    ):
+    """ add samples to a model created by generate_nonlinear_average
+
+    previous -- prefix of the previous run, the final model and the
+                transformations of its samples are loaded from results.json
+    
+    Only new samples are registered, following update_protocol (default:
+    two iterations at the finest level of protocol). Samples already in 
+    the model are resampled with their saved transformations and the 
+    centring correction, which is the average inverse transformation of 
+    new samples scaled by their fraction in the whole population, since 
+    transformations of old samples are already centred.
+    Changes of the model are reported in update.json
+    prefix has to be different from previous, since outputs are named the
+    same way
+    """
+    if os.path.realpath(prefix)==os.path.realpath(previous):
+        raise mincError('Update of the model should be done in a new prefix, not in {}'.format(previous))
+
+    with open(previous+os.sep+'results.json','r') as f:
+        prev=json.load(f)
+
+    old_samples=[_load_dataset(i) for i in prev['samples']]
+    old_transforms=[_load_transform(i) for i in prev['xfm']]
+    previous_model=_load_dataset(prev['model'])
+
+    current_model=previous_model
+    current_model_sd=_load_dataset(prev['model_sd'])
+
+    protocol=options.get('protocol', [{'iter':4,'level':32},
+                                      {'iter':4,'level':32}] )
+    update_protocol=options.get('update_protocol',[{'iter':2,'level':protocol[-1]['level']}])
+    if sum(p['iter'] for p in update_protocol)<1:
+        raise mincError('update_protocol should have at least one iteration')
+
+    # has to be the same as in the previous run
+    symmetric=     prev.get('symmetric',False)
+    cleanup=       options.get('cleanup',False)
+    parameters=    options.get('parameters',None)
+    qc=            options.get('qc',False)
+    downsample_=   options.get('downsample',None)
+    use_dd=        options.get('use_dd',False)
+    use_ants=      options.get('use_ants',False)
+    use_elastix=   options.get('use_elastix',False)
+    start_level=   options.get('start_level',protocol[0]['level'])
+    use_median=    options.get('median',False)
+    use_pyramid=   options.get('pyramid',False)
+
+    pyramid=PyramidCache(prefix+os.sep+'pyramid') if use_pyramid else None
+    register_args={}
+
+    if use_dd:
+        register_step=dd_register_step
+    elif use_ants:
+        register_step=ants_register_step
+        register_args['pyramid']=pyramid
+    elif use_elastix:
+        register_step=elastix_register_step
+    else:
+        register_step=non_linear_register_step
+        register_args['pyramid']=pyramid
+
+    if symmetric:
+        flipdir=prefix+os.sep+'flip'
+        if not os.path.exists(flipdir):
+            os.makedirs(flipdir)
+
+        flip_all=[]
+        for (i, s) in enumerate(samples):
+            _s_name=os.path.basename(s.scan).rsplit('.gz',1)[0]
+            s.scan_f=prefix+os.sep+'flip'+os.sep+_s_name
+
+            if s.mask is not None:
+                s.mask_f=prefix+os.sep+'flip'+os.sep+'mask_'+_s_name
+
+            flip_all.append( futures.submit(run_forced, rerun_forced(), generate_flip_sample,s )  )
+
+        futures.wait(flip_all, return_when=futures.ALL_COMPLETED)
+
+    all_samples=old_samples+samples
+    weight=float(len(samples))/len(all_samples)
+
+    # transformations of new samples from the previous iteration
+    new_transforms=None
+    corr_transforms=[]
+    corr_samples=[]
+    models=[]
+    models_sd=[]
+    sd=[]
+    history=[]
+
+    it=0
+    for (i,p) in enumerate(update_protocol):
+        downsample=p.get('downsample',downsample_)
+        for j in range(1,p['iter']+1):
+            it+=1
+            next_model=MriDataset(prefix=prefix,iter=it,name='avg')
+            next_model_sd=MriDataset(prefix=prefix,iter=it,name='sd')
+
+            it_prefix=prefix+os.sep+str(it)
+            if not os.path.exists(it_prefix):
+                os.makedirs(it_prefix)
+
+            # 1 register new subjects to current template
+            transforms=[]
+            inv_transforms=[]
+            fwd_transforms=[]
+            for (i, s) in enumerate(samples):
+                sample_xfm=MriTransform(name=s.name,prefix=it_prefix,iter=it)
+                sample_inv_xfm=MriTransform(name=s.name+'_inv',prefix=it_prefix,iter=it)
+
+                transforms.append(
+                    futures.submit(run_forced, rerun_forced(),
+                        register_step,
+                        s,
+                        current_model,
+                        sample_xfm,
+                        output_invert=sample_inv_xfm,
+                        init_xfm=new_transforms[i] if new_transforms is not None else None,
+                        symmetric=symmetric,
+                        parameters=parameters,
+                        level=p['level'],
+                        start=start_level if new_transforms is None else None,
+                        work_dir=prefix,
+                        downsample=downsample,
+                        **register_args)
+                    )
+                inv_transforms.append(sample_inv_xfm)
+                fwd_transforms.append(sample_xfm)
+
+            futures.wait(transforms, return_when=futures.ALL_COMPLETED)
+
+            # versions of the current model are not needed anymore
+            if pyramid is not None:
+                pyramid.evict(current_model.scan)
+                pyramid.evict(current_model.mask)
+
+            # 2 centring correction
+            avg_inv_transform=MriTransform(name='avg_inv', prefix=it_prefix, iter=it)
+            result=futures.submit(run_forced, rerun_forced(), average_transforms, inv_transforms, avg_inv_transform, nl=True, symmetric=symmetric, weight=weight)
+            futures.wait([result], return_when=futures.ALL_COMPLETED)
+
+            # 3 concatenate correction and resample all subjects
+            if it==1:
+                prev_transforms=old_transforms+fwd_transforms
+            else:
+                prev_transforms=corr_transforms[0:len(old_samples)]+fwd_transforms
+
+            corr=[]
+            _corr_transforms=[]
+            _corr_samples=[]
+            for (i, s) in enumerate(all_samples):
+                c=MriDataset(prefix=it_prefix,iter=it,name=s.name)
+                x=MriTransform(name=s.name+'_corr',prefix=it_prefix,iter=it)
+
+                corr.append(futures.submit(run_forced, rerun_forced(),
+                    concat_resample_nl,
+                    s,
+                    prev_transforms[i],
+                    avg_inv_transform,
+                    c,
+                    x,
+                    current_model,
+                    level=p['level'], symmetric=symmetric, qc=qc ))
+                _corr_transforms.append(x)
+                _corr_samples.append(c)
+
+            futures.wait(corr, return_when=futures.ALL_COMPLETED)
+
+            if cleanup and it>1:
+                # remove information from previous iteration
+                # results of the previous run are kept
+                for s in corr_samples:
+                    s.cleanup(verbose=True)
+                for x in corr_transforms:
+                    x.cleanup(verbose=True)
+
+            corr_transforms=_corr_transforms
+            corr_samples=_corr_samples
+            new_transforms=corr_transforms[len(old_samples):]
+
+            # 4 average resampled samples to create new estimate
+            result=futures.submit(run_forced, rerun_forced(), average_samples, corr_samples, next_model, next_model_sd, symmetric=symmetric, symmetrize=symmetric,median=use_median)
+            futures.wait([result], return_when=futures.ALL_COMPLETED)
+
+            _mask=next_model.mask if os.path.exists(next_model.mask) else None
+            history.append({'iter':       it,
+                            'level':      p['level'],
+                            'centring':   transform_displacement(avg_inv_transform),
+                            'rms_change': model_difference(next_model, current_model, mask=_mask)})
+
+            if cleanup:
+                for x in inv_transforms:
+                    x.cleanup()
+                for x in fwd_transforms:
+                    x.cleanup()
+                avg_inv_transform.cleanup()
+
+            if cleanup and it>1:
+                models.append(current_model)
+                models_sd.append(current_model_sd)
+
+            current_model=next_model
+            current_model_sd=next_model_sd
+
+            result=futures.submit(run_forced, rerun_forced(), average_stats, next_model, next_model_sd)
+            sd.append(result)
+
+    futures.wait(sd, return_when=futures.ALL_COMPLETED)
+    with open(prefix+os.sep+'stats.txt','w') as f:
+        for s in sd:
+            f.write("{}\n".format(s.result()))
+
+    report={
+            'previous':    previous,
+            'old_samples': len(old_samples),
+            'new_samples': len(samples),
+            'iterations':  history,
+            'rms_change':  model_difference(current_model, previous_model, mask=_mask)
+            }
+    print("Model moved by {} (RMS) after adding {} samples to {}".format(
+        report['rms_change'], len(samples), len(old_samples)))
+
+    with open(prefix+os.sep+'update.json','w') as f:
+        json.dump(report, f, indent=1)
+
+    results={
+            'model':      current_model,
+            'model_sd':   current_model_sd,
+            'xfm':        corr_transforms,
+            'biascorr':   None,
+            'scan':       corr_samples,
+            'symmetric':  symmetric,
+            'samples':    all_samples,
+            'update':     report
+            }
+
+    with open(prefix+os.sep+'results.json','w') as f:
+         json.dump(results, f, indent=1, cls=MRIEncoder)
+
+    if cleanup:
+        for m in models:
+            m.cleanup()
+        for m in models_sd:
+            m.cleanup()
+        if pyramid is not None:
+            pyramid.cleanup()
+
+    return results
+
+def update_nonlinear_model(samples, previous, work_prefix=None, options={}):
+    internal_sample=[]
+    try:
+        for i in samples:
+            s=MriDataset(scan=i[0],mask=i[1])
+            internal_sample.append(s)
+
+        if work_prefix is not None and not os.path.exists(work_prefix):
+            os.makedirs(work_prefix)
+
+        return update_nonlinear_average(internal_sample,previous,prefix=work_prefix,options=options)
+
+    except mincError as e:
+        print("Exception in update_nonlinear_model:{}".format(str(e)))
+        traceback.print_exc(file=sys.stdout)
+        raise
+    except :
+        print("Exception in update_nonlinear_model:{}".format(sys.exc_info()[0]))
+        traceback.print_exc(file=sys.stdout)
+        raise
+
 def generate_nonlinear_model_csv(input_csv, model=None, mask=None, work_prefix=None, options={},skip=0,stop_early=100000):
     internal_sample=[]
 
@@ -7,80 +7,30 @@ import traceback
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl import numpy_backend
 
 import ipl.registration
 import ipl.dd_registration
 import ipl.ants_registration
 import ipl.elastix_registration
+import ipl.xfm_average
 
 import numpy as np
 
 from .structures import *
 from .filter import build_approximation
 
-try:
-    # needed to read and write XFM files
-    from minc2_simple import minc2_xfm
-    # needed for matrix log and exp
-    import scipy.linalg
-except:
-    pass
-
-def xfmavg(inputs, output, verbose=False):
-    # TODO: handle inversion flag correctly
-    all_linear=True
-    all_nonlinear=True
-    input_xfms=[]
-    input_grids=[]
-    
-    for j in inputs:
-        x=minc2_xfm(j)
-        if x.get_n_concat()==1 and x.get_n_type(0)==minc2_xfm.MINC2_XFM_LINEAR:
-            # this is a linear matrix
-            input_xfms.append(np.asmatrix(x.get_linear_transform()))
-        else:
-            all_linear&=False
-            # strip identity matrixes
-            nl=[]
-            _identity=np.asmatrix(np.identity(4))
-            _eps=1e-6
-            if x.get_n_type(0)==minc2_xfm.MINC2_XFM_LINEAR and x.get_n_type(1)==minc2_xfm.MINC2_XFM_GRID_TRANSFORM:
-                if scipy.linalg.norm(_identity-np.asmatrix(x.get_linear_transform(0)) )>_eps: # this is non-identity matrix
-                    all_nonlinear&=False
-                else:
-                    # TODO: if grid have to be inverted!
-                    (grid_file,grid_invert)=x.get_grid_transform(1)
-                    input_grids.append(grid_file)
-            elif x.get_n_type(1)==minc2_xfm.MINC2_XFM_GRID_TRANSFORM:
-                # TODO: if grid have to be inverted!
-                (grid_file,grid_invert)=x.get_grid_transform(0)
-                input_grids.append(grid_file)
-                
-    if all_linear:
-        acc=np.asmatrix(np.zeros([4,4],dtype=np.complex))
-        for i in input_xfms:
-            print(i)
-            acc+=scipy.linalg.logm(i)
-            
-        acc/=len(input_xfms)
-        acc=np.asarray(scipy.linalg.expm(acc).real,'float64','C')
-        
-        x=minc2_xfm()
-        x.append_linear_transform(acc)
-        x.save(output)
-        
-    elif all_nonlinear:
-        
-        output_grid=output.rsplit('.xfm',1)[0]+'_grid_0.mnc'
-        
-        with mincTools(verbose=2) as m:
-            m.average(input_grids,output_grid)
-        
-        x=minc2_xfm()
-        x.append_grid_transform(output_grid, False)
-        x.save(output)
-    else:
-        raise Exception("Mixed XFM files provided as input")
+
+def xfmavg(inputs, output, verbose=False, weight=1.0, weights=None, trim=0.0):
+    """average transformations in-process
+    weight  -- fraction of the average transformation to apply
+    weights -- weight of every transformation
+    trim    -- fraction of outliers excluded from the average
+    """
+    try:
+        ipl.xfm_average.xfmavg(inputs, output, weights=weights, trim=trim, scale=weight)
+    except numpy_backend.Unsupported as e:
+        raise mincError("Can't average transformations:{}".format(str(e)))
 
 def linear_register_step(
     sample,
@@ -95,11 +45,15 @@ def linear_register_step(
     work_dir=None,
     bias=None,
     downsample=None,
-    avg_symmetric=True
+    avg_symmetric=True,
+    pyramid=None
     ):
     """perform linear registration to the model, and calculate inverse"""
 
     try:
+        if bias is not None:
+            # corrected scan is temporary, nothing to share
+            pyramid=None
         _init_xfm=None
         _init_xfm_f=None
         
@@ -140,6 +94,7 @@ def linear_register_step(
                     parameters=reg_type,
                     conf=linreg,
                     downsample=downsample,
+                    pyramid=pyramid,
                     #work_dir=work_dir
                     )
                 ipl.registration.linear_register(
@@ -153,6 +108,7 @@ def linear_register_step(
                     parameters=reg_type,
                     conf=linreg,
                     downsample=downsample,
+                    pyramid=pyramid,
                     #work_dir=work_dir
                     )
                     
@@ -174,7 +130,8 @@ def linear_register_step(
                     objective=objective,
                     parameters=reg_type,
                     conf=linreg,
-                    downsample=downsample
+                    downsample=downsample,
+                    pyramid=pyramid
                     #work_dir=work_dir
                     )
             if output_invert is not None:
@@ -206,7 +163,8 @@ def non_linear_register_step(
     work_dir=None,
     downsample=None,
     avg_symmetric=True,
-    verbose=2   
+    verbose=2,
+    pyramid=None
     ):
     """perform linear registration to the model, and calculate inverse"""
 
@@ -240,6 +198,7 @@ def non_linear_register_step(
                         level=level,
                         start=start,
                         downsample=downsample,
+                        pyramid=pyramid,
                         #work_dir=work_dir
                         )
                     
@@ -254,6 +213,7 @@ def non_linear_register_step(
                         level=level,
                         start=start,
                         downsample=downsample,
+                        pyramid=pyramid,
                         #work_dir=work_dir
                         )
                     
@@ -287,6 +247,7 @@ def non_linear_register_step(
                         level=level,
                         start=start,
                         downsample=downsample,
+                        pyramid=pyramid,
                         #work_dir=work_dir
                         )
                     m.xfm_normalize(m.tmp('forward.xfm'),model.scan,output.xfm,step=level)
@@ -433,7 +394,8 @@ def ants_register_step(
     work_dir=None,
     downsample=None,
     avg_symmetric=True,
-    verbose=2 
+    verbose=2,
+    pyramid=None
     ):
     """perform linear registration to the model, and calculate inverse"""
 
@@ -468,6 +430,7 @@ def ants_register_step(
                         level=level,
                         start=start,
                         downsample=downsample,
+                        pyramid=pyramid,
                         #work_dir=work_dir
                         )
                     
@@ -482,6 +445,7 @@ def ants_register_step(
                         level=level,
                         start=start,
                         downsample=downsample,
+                        pyramid=pyramid,
                         #work_dir=work_dir
                         )
                     
@@ -515,6 +479,7 @@ def ants_register_step(
                         level=level,
                         start=start,
                         downsample=downsample,
+                        pyramid=pyramid,
                         #work_dir=work_dir
                         )
                     m.xfm_normalize(out+'.xfm',model.scan,output.xfm,step=level)
@@ -656,9 +621,12 @@ def average_transforms(
     output,
     nl=False,
     symmetric=False,
-    invert=False
+    invert=False,
+    weight=1.0,
+    trim=0.0
     ):
-    """average given transformations"""
+    """average given transformations, weight scales the average,
+    trim is the fraction of outliers excluded"""
     try:
         with mincTools() as m:
             avg = []
@@ -672,7 +640,7 @@ def average_transforms(
                     avg.append(i.xfm_f)
             if invert:
                 out_xfm=m.tmp("average.xfm")
-            xfmavg(avg, out_xfm)
+            xfmavg(avg, out_xfm, weight=weight, trim=trim)
 
             if invert:
                 m.xfminvert(out_xfm, output.xfm)
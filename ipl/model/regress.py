@@ -23,6 +23,8 @@ from .registration     import ants_register_step
 from .registration     import average_transforms
 from .registration     import non_linear_register_step_regress_std
 from .resample         import concat_resample_nl
+from .convergence      import ConvergenceMonitor, transform_displacement
+from ipl.workflow import run_forced, rerun_forced
 
 from scoop import futures, shared
 
@@ -117,8 +119,9 @@ def regress(
         # go through all the iterations
         it=0
         residuals=[]
+        convergence=ConvergenceMonitor(prefix, options)
         
-        for (i,p) in enumerate(protocol):
+        for (stage,p) in enumerate(protocol):
             blur_int_model=p.get('blur_int',None)
             blur_def_model=p.get('blur_def',None)
             for j in range(1,p['iter']+1):
@@ -168,7 +171,7 @@ def regress(
                             previous_def=prev_def_estimate[i]
                         
                         r.append(
-                            futures.submit(
+                            futures.submit(run_forced, rerun_forced(),
                                 non_linear_register_step_regress_std,
                                 s,
                                 current_int_model,
@@ -197,6 +200,8 @@ def regress(
                         avg_inv_transform=MriTransform(name='avg_inv',prefix=it_prefix,iter=it)
                         # 2 average all transformations
                         average_transforms(def_estimate, avg_inv_transform, symmetric=False, invert=True,nl=True)
+                    displacement=transform_displacement(avg_inv_transform) \
+                        if convergence.uses('displacement') else None
 
                     corr=[]
                     corr_transforms=[]
@@ -207,7 +212,7 @@ def regress(
                         c=MriDataset(prefix=it_prefix,iter=it,name=s.name)
                         x=MriTransform(name=s.name+'_corr',prefix=it_prefix,iter=it)
                         
-                        corr.append(futures.submit(concat_resample_nl, 
+                        corr.append(futures.submit(run_forced, rerun_forced(), concat_resample_nl, 
                             s, def_estimate[i], avg_inv_transform, 
                             c, x,
                             current_int_model,
@@ -224,7 +229,7 @@ def regress(
                     # 4. perform regression and create new estimate
                     # 5. calculate residulas (?)
                     # 4+5
-                    result=futures.submit(voxel_regression,
+                    result=futures.submit(run_forced, rerun_forced(), voxel_regression,
                                         int_design_matrix, def_design_matrix,
                                         corr_samples,      corr_transforms,    
                                         next_int_model,    next_def_model,     
@@ -250,6 +255,7 @@ def regress(
                 else:
                     # files were there, reuse them
                     print("Iteration {} already performed, skipping".format(it))
+                    displacement=None
                     corr_transforms=[]
                     # this is a hack right now
                     for (i, s) in enumerate(samples):
@@ -260,12 +266,17 @@ def regress(
                 def_models.append(current_def_model)
                 int_residuals.append(int_residual)
                 def_residuals.append(def_residual)
+
+                if isinstance(current_int_model, MriDatasetRegress):
+                    previous_int_model=current_int_model.volume[0]
+                else:
+                    previous_int_model=current_int_model.scan
                     
                 current_int_model=next_int_model
                 current_def_model=next_def_model
                 
                
-                result=futures.submit(average_stats_regression,
+                result=futures.submit(run_forced, rerun_forced(), average_stats_regression,
                                       current_int_model, current_def_model,
                                       int_residual, def_residual  )
                 residuals.append(result)
@@ -283,6 +294,14 @@ def regress(
                 # TODO: regularize?
                 prev_def_estimate=corr_transforms # have to use adjusted def estimate
 
+                # skip remaining iterations at this level if converged
+                if convergence.update(it, stage, p['level'],
+                                      current_int_model.volume[0], previous_int_model,
+                                      displacement=displacement,
+                                      sd=result.result()[0] if convergence.uses('sd') else None,
+                                      mask=current_int_model.mask):
+                    break
+
         # copy output to the destination
         futures.wait(residuals, return_when=futures.ALL_COMPLETED)
         with open(prefix+os.sep+'stats.txt','w') as f:
@@ -8,6 +8,14 @@ import copy
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
 from .structures_ldd       import MriDataset, LDDMriTransform, LDDMRIEncoder,MriDatasetRegress
+from ipl.stream     import reduce_samples
+
+try:
+    from minc2_simple import minc2_file
+    have_minc2_simple=True
+except ImportError:
+    # minc2_simple not available :(
+    have_minc2_simple=False
 
 def generate_flip_sample(input):
     '''generate flipped version of sample'''
@@ -61,7 +69,12 @@ def average_samples(
                 for s in samples:
                     avg.append(s.scan_f)
             
-            if output_sd:
+            if have_minc2_simple:
+                # same normalization of sd as mincaverage
+                reduce_samples(avg, output.scan,
+                               output_sd=output_sd.scan if output_sd else None,
+                               ddof=1)
+            elif output_sd:
                 m.average(avg, output.scan, sdfile=output_sd.scan)
             else:
                 m.average(avg, output.scan)
@@ -77,7 +90,10 @@ def average_samples(
                         avg.append(s.mask_f)
 
                 if not os.path.exists(output.mask):
-                    m.average(avg,m.tmp('avg_mask.mnc'),datatype='-float')
+                    if have_minc2_simple:
+                        reduce_samples(avg,m.tmp('avg_mask.mnc'))
+                    else:
+                        m.average(avg,m.tmp('avg_mask.mnc'),datatype='-float')
                     m.calc([m.tmp('avg_mask.mnc')],'A[0]>0.5?1:0',m.tmp('avg_mask_.mnc'),datatype='-byte')
                     m.reshape(m.tmp('avg_mask_.mnc'),output.mask,image_range=[0,1],valid_range=[0,1])
                     
@@ -17,6 +17,8 @@ from .filter_ldd           import resample_and_correct_bias_ldd
 from .registration_ldd     import non_linear_register_step_ldd
 from .registration_ldd     import average_transforms_ldd
 from .resample_ldd         import concat_resample_ldd
+from ipl.model.convergence import ConvergenceMonitor, transform_displacement
+from ipl.workflow import run_forced, rerun_forced
 
 from scoop import futures, shared
 
@@ -61,6 +63,7 @@ def generate_ldd_average(
 
         models=[]
         models_sd=[]
+        convergence=ConvergenceMonitor(prefix, options)
 
         if symmetric:
             flipdir=prefix+os.sep+'flip'
@@ -75,12 +78,12 @@ def generate_ldd_average(
                 if s.mask is not None:
                     s.mask_f=prefix+os.sep+'flip'+os.sep+'mask_'+os.path.basename(s.scan)
 
-                flip_all.append( futures.submit( generate_flip_sample,s )  )
+                flip_all.append( futures.submit(run_forced, rerun_forced(), generate_flip_sample,s )  )
 
             futures.wait(flip_all, return_when=futures.ALL_COMPLETED)
         # go through all the iterations
         it=0
-        for (i,p) in enumerate(protocol):
+        for (stage,p) in enumerate(protocol):
             for j in range(1,p['iter']+1):
                 it+=1
                 # this will be a model for next iteration actually
@@ -107,7 +110,7 @@ def generate_ldd_average(
                         prev_transform = corr_transforms[i]
 
                     transforms.append(
-                        futures.submit(
+                        futures.submit(run_forced, rerun_forced(),
                             non_linear_register_step_ldd,
                             s,
                             current_model,
@@ -136,6 +139,8 @@ def generate_ldd_average(
 
                 # 2 average all transformations
                 average_transforms_ldd(fwd_transforms, avg_inv_transform, symmetric=symmetric, invert=True)
+                displacement=transform_displacement(avg_inv_transform) \
+                    if convergence.uses('displacement') else None
 
                 corr=[]
                 corr_transforms=[]
@@ -146,7 +151,7 @@ def generate_ldd_average(
                     c=MriDataset(prefix=it_prefix,iter=it,name=s.name)
                     x=LDDMriTransform(name=s.name+'_corr',prefix=it_prefix,iter=it)
 
-                    corr.append(futures.submit(concat_resample_ldd, s,
+                    corr.append(futures.submit(run_forced, rerun_forced(), concat_resample_ldd, s,
                         fwd_transforms[i], avg_inv_transform, c, x, current_model.scan,
                         symmetric=symmetric, qc=qc ))
 
@@ -157,7 +162,7 @@ def generate_ldd_average(
 
                 # 4 average resampled samples to create new estimate
 
-                result=futures.submit(average_samples, corr_samples, next_model, next_model_sd, symmetric=symmetric)
+                result=futures.submit(run_forced, rerun_forced(), average_samples, corr_samples, next_model, next_model_sd, symmetric=symmetric)
                 futures.wait([result], return_when=futures.ALL_COMPLETED)
                 
 
@@ -170,12 +175,20 @@ def generate_ldd_average(
                     models.append(next_model)
                     models_sd.append(next_model_sd)
 
+                previous_model=current_model
                 current_model=next_model
                 current_model_sd=next_model_sd
 
-                result=futures.submit(average_stats, next_model, next_model_sd)
+                result=futures.submit(run_forced, rerun_forced(), average_stats, next_model, next_model_sd)
                 sd.append(result)
 
+                # skip remaining iterations at this level if converged
+                if convergence.update(it, stage, p['level'], next_model.scan, previous_model.scan,
+                                      displacement=displacement,
+                                      sd=result.result() if convergence.uses('sd') else None,
+                                      mask=next_model.mask):
+                    break
+
         # copy output to the destination
         futures.wait(sd, return_when=futures.ALL_COMPLETED)
         with open(prefix+os.sep+'stats.txt','w') as f:
@@ -20,6 +20,7 @@ from .registration_ldd     import non_linear_register_step_ldd
 from .registration_ldd     import average_transforms_ldd
 from .registration_ldd     import non_linear_register_step_regress_ldd
 from .resample_ldd         import concat_resample_ldd
+from ipl.workflow import run_forced, rerun_forced
 
 from scoop import futures, shared
 
@@ -177,7 +178,7 @@ def regress_ldd(
                             previous_velocity=prev_velocity_estimate[i]
                         
                         r.append(
-                            futures.submit(
+                            futures.submit(run_forced, rerun_forced(),
                                 non_linear_register_step_regress_ldd,
                                 s,
                                 current_intensity_model,
@@ -218,7 +219,7 @@ def regress_ldd(
                         c=MriDataset(prefix=it_prefix,iter=it,name=s.name)
                         x=LDDMriTransform(name=s.name+'_corr',prefix=it_prefix,iter=it)
 
-                        corr.append(futures.submit(concat_resample_ldd, 
+                        corr.append(futures.submit(run_forced, rerun_forced(), concat_resample_ldd, 
                             s, velocity_estimate[i], avg_inv_transform, 
                             c, x,
                             model=ref_model,
@@ -233,7 +234,7 @@ def regress_ldd(
                     # 4. perform regression and create new estimate
                     # 5. calculate residulas (?)
                     # 4+5
-                    result=futures.submit(voxel_regression,
+                    result=futures.submit(run_forced, rerun_forced(), voxel_regression,
                                         intensity_design_matrix, velocity_design_matrix,
                                         corr_samples,            corr_transforms,    
                                         next_intensity_model,    next_velocity_model,     
@@ -274,7 +275,7 @@ def regress_ldd(
                 current_velocity_model=next_velocity_model
                 
                
-                result=futures.submit(average_stats_regression,
+                result=futures.submit(run_forced, rerun_forced(), average_stats_regression,
                                       current_intensity_model, current_velocity_model,
                                       intensity_residual, velocity_residual  )
                 residuals.append(result)
@@ -0,0 +1,822 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# In-process implementation of simple minc tools (minccalc, mincmath,
+# mincaverage, minc_median, mincstats, itk_morph, itk_label_stats and
+# mincreshape) using numpy and minc2_simple.
+#
+# Every function raises Unsupported when it can't reproduce behaviour of the
+# corresponding command line tool, so that the caller could fall back to it.
+
+from __future__ import print_function
+
+import os
+import re
+from math import pi as _pi, e as _e
+
+try:
+    from minc2_simple import minc2_file
+    import numpy as np
+    have_numpy_backend = True
+except ImportError:
+    # minc2_simple not available :(
+    have_numpy_backend = False
+
+try:
+    import scipy.ndimage
+    have_scipy_ndimage = True
+except ImportError:
+    have_scipy_ndimage = False
+
+
+class Unsupported(Exception):
+    """Operation can't be performed in-process, use command line tool"""
+    pass
+
+
+def _check_backend():
+    if not have_numpy_backend:
+        raise Unsupported('minc2_simple or numpy is not available')
+
+
+##########################################################################
+# I/O
+
+def load(path, data_type=None):
+    """load complete volume in the file order, returns (volume,minc2_file)"""
+    _check_backend()
+    if data_type is None:
+        data_type = minc2_file.MINC2_DOUBLE
+    f = minc2_file(path)
+    return (f.load_complete_volume(data_type), f)
+
+
+def load_many(paths, data_type=None):
+    """load several volumes, checking that they all have the same shape"""
+    vols = []
+    ref = None
+    for p in paths:
+        (v, f) = load(p, data_type=data_type)
+        if ref is None:
+            ref = f
+        elif v.shape != vols[0].shape:
+            raise Unsupported('Volumes have different shape: {} and {}'.format(paths[0], p))
+        else:
+            f.close()
+        vols.append(v)
+    return (vols, ref)
+
+
+_types = {
+    'byte':   ('MINC2_UBYTE',  'uint8'),
+    'short':  ('MINC2_SHORT',  'int16'),
+    'int':    ('MINC2_INT',    'int32'),
+    'long':   ('MINC2_INT',    'int32'),
+    'float':  ('MINC2_FLOAT',  'float32'),
+    'double': ('MINC2_DOUBLE', 'float64'),
+}
+
+
+def _store_datatype(f):
+    """storage data type of an open file, as accepted by save"""
+    try:
+        store_type = f.store_type()
+    except AttributeError:
+        raise Unsupported('Storage type is not available')
+    for (name, (minc_type, np_type)) in _types.items():
+        if getattr(minc2_file, minc_type) == store_type and name != 'long':
+            return name
+    raise Unsupported('Unsupported storage type:{}'.format(store_type))
+
+
+def _fits(vol, datatype):
+    """check if values can be stored exactly with integer datatype"""
+    info = np.iinfo(_types[datatype][1])
+    return np.array_equal(vol, np.round(vol)) and \
+        np.nanmin(vol) >= info.min and np.nanmax(vol) <= info.max
+
+
+def _label_datatype(vol):
+    """smallest data type fitting all label values"""
+    vol = np.round(vol)
+    for datatype in ('byte', 'short'):
+        if _fits(vol, datatype):
+            return datatype
+    return 'int'
+
+
+def _parse_datatype(datatype):
+    if datatype is None:
+        return None
+    datatype = datatype.lstrip('-')
+    if datatype not in _types:
+        raise Unsupported('Unsupported data type:{}'.format(datatype))
+    return datatype
+
+
+def save(ref, output, vol, datatype=None, labels=False, dims=None):
+    """save volume imitating header of ref (minc2_file or path)
+
+    integer data types are only used for label volumes (or when all values are
+    integer), intensities are stored as floating point to avoid rescaling
+    """
+    _check_backend()
+    if not isinstance(ref, minc2_file):
+        ref = minc2_file(ref)
+    datatype = _parse_datatype(datatype)
+
+    if datatype is None or datatype in ('float', 'double'):
+        if labels and datatype is None:
+            datatype = _label_datatype(vol)
+        elif datatype is None:
+            datatype = 'float'
+    if datatype not in ('float', 'double') and not labels:
+        # integer output only when values are integer
+        if not np.array_equal(vol, np.round(vol)):
+            datatype = 'float'
+
+    (minc_type, np_type) = _types[datatype]
+    minc_type = getattr(minc2_file, minc_type)
+
+    _tmp = os.path.join(os.path.dirname(os.path.abspath(output)),
+                        '.' + os.path.basename(output) + '.partial.mnc')
+    o = minc2_file()
+    o.define(dims if dims is not None else ref.store_dims(), minc_type, minc_type)
+    o.create(_tmp)
+    o.copy_metadata(ref)
+    if np_type.startswith('float'):
+        o.save_complete_volume(np.ascontiguousarray(vol, dtype=np_type))
+    else:
+        o.save_complete_volume(np.ascontiguousarray(np.round(vol), dtype=np_type))
+    o.close()
+    os.rename(_tmp, output)
+
+
+def voxel_volume(ref):
+    """volume of a single voxel in mm^3"""
+    v = 1.0
+    for d in ref.store_dims():
+        if d.id in (minc2_file.MINC2_DIM_X, minc2_file.MINC2_DIM_Y, minc2_file.MINC2_DIM_Z):
+            v *= abs(d.step)
+    return v
+
+
+def axis_dims(ref):
+    """dimension descriptions in numpy axis order (minc2_simple lists
+    dimensions starting from the fastest varying)"""
+    return list(reversed(ref.store_dims()))
+
+
+def voxel_to_world(ref, coords):
+    """convert voxel coordinates (N,3) in numpy axis order to world (N,3)"""
+    coords = np.asarray(coords, dtype=np.float64)
+    world = np.zeros(coords.shape[0:-1] + (3,))
+    for a, d in enumerate(axis_dims(ref)):
+        if d.id not in (minc2_file.MINC2_DIM_X, minc2_file.MINC2_DIM_Y, minc2_file.MINC2_DIM_Z):
+            raise Unsupported('Only spatial volumes are supported')
+        if d.have_dir_cos:
+            cos = np.array([d.dir_cos[0], d.dir_cos[1], d.dir_cos[2]])
+        else:
+            cos = np.zeros(3)
+            cos[[minc2_file.MINC2_DIM_X, minc2_file.MINC2_DIM_Y, minc2_file.MINC2_DIM_Z].index(d.id)] = 1.0
+        world += np.multiply.outer(d.start + coords[..., a] * d.step, cos)
+    return world
+
+
+##########################################################################
+# minccalc expression evaluator
+
+_token_re = re.compile(r"""
+    \s*(?:
+      (?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) |
+      (?P<vol>A\s*\[\s*(?P<idx>\d+)\s*\]) |
+      (?P<id>[A-Za-z_][A-Za-z_0-9]*) |
+      (?P<op>\|\||&&|==|!=|<=|>=|[-+*/^<>!?:(),])
+    )""", re.VERBOSE)
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        m = _token_re.match(expression, pos)
+        if m is None or m.end() == pos:
+            raise Unsupported('Can\'t parse expression:{}'.format(expression))
+        pos = m.end()
+        if m.group('num') is not None:
+            tokens.append(('num', float(m.group('num'))))
+        elif m.group('vol') is not None:
+            tokens.append(('vol', int(m.group('idx'))))
+        elif m.group('id') is not None:
+            tokens.append(('id', m.group('id')))
+        else:
+            tokens.append(('op', m.group('op')))
+        # skip trailing whitespace
+        while pos < len(expression) and expression[pos].isspace():
+            pos += 1
+    return tokens
+
+
+def _bool(x):
+    return (x != 0).astype(np.float64) if isinstance(x, np.ndarray) else float(x != 0)
+
+
+_functions = {
+    'abs':   (1, lambda a: np.abs(a)),
+    'sqrt':  (1, lambda a: np.sqrt(a)),
+    'exp':   (1, lambda a: np.exp(a)),
+    'log':   (1, lambda a: np.log(a)),
+    'sin':   (1, lambda a: np.sin(a)),
+    'cos':   (1, lambda a: np.cos(a)),
+    'tan':   (1, lambda a: np.tan(a)),
+    'asin':  (1, lambda a: np.arcsin(a)),
+    'acos':  (1, lambda a: np.arccos(a)),
+    'atan':  (1, lambda a: np.arctan(a)),
+    'isnan': (1, lambda a: np.isnan(a).astype(np.float64)),
+    'clamp': (3, lambda a, b, c: np.clip(a, b, c)),
+    'segment': (3, lambda a, b, c: np.logical_and(a >= b, a <= c).astype(np.float64)),
+}
+
+_constants = {'NaN': float('nan'), 'nan': float('nan'), 'pi': _pi, 'e': _e}
+
+
+class _Parser(object):
+    """recursive descent parser, producing python closures evaluating
+    expression on a list of volumes, follows C operator precedence"""
+
+    def __init__(self, expression):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.max_vol = -1
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, op):
+        if self.peek() == ('op', op):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, op):
+        if not self.accept(op):
+            raise Unsupported('Expected {} at token {}'.format(op, self.pos))
+
+    def parse(self):
+        e = self.ternary()
+        if self.pos != len(self.tokens):
+            raise Unsupported('Unexpected token:{}'.format(repr(self.peek())))
+        return e
+
+    def ternary(self):
+        c = self.logical_or()
+        if self.accept('?'):
+            a = self.ternary()
+            self.expect(':')
+            b = self.ternary()
+            return lambda v: np.where(c(v) != 0, a(v), b(v))
+        return c
+
+    def _binary(self, sub, ops):
+        l = sub()
+        while True:
+            (t, op) = self.peek()
+            if t == 'op' and op in ops:
+                self.pos += 1
+                r = sub()
+                l = (lambda f, a, b: lambda v: f(a(v), b(v)))(ops[op], l, r)
+            else:
+                return l
+
+    def logical_or(self):
+        return self._binary(self.logical_and,
+                            {'||': lambda a, b: _bool(np.logical_or(a != 0, b != 0))})
+
+    def logical_and(self):
+        return self._binary(self.equality,
+                            {'&&': lambda a, b: _bool(np.logical_and(a != 0, b != 0))})
+
+    def equality(self):
+        return self._binary(self.relational,
+                            {'==': lambda a, b: _bool(np.equal(a, b)),
+                             '!=': lambda a, b: _bool(np.not_equal(a, b))})
+
+    def relational(self):
+        return self._binary(self.additive,
+                            {'<':  lambda a, b: _bool(np.less(a, b)),
+                             '<=': lambda a, b: _bool(np.less_equal(a, b)),
+                             '>':  lambda a, b: _bool(np.greater(a, b)),
+                             '>=': lambda a, b: _bool(np.greater_equal(a, b))})
+
+    def additive(self):
+        return self._binary(self.multiplicative,
+                            {'+': lambda a, b: a + b,
+                             '-': lambda a, b: a - b})
+
+    def multiplicative(self):
+        return self._binary(self.unary,
+                            {'*': lambda a, b: a * b,
+                             '/': lambda a, b: np.true_divide(a, b)})
+
+    def unary(self):
+        if self.accept('-'):
+            a = self.unary()
+            return lambda v: -a(v)
+        if self.accept('+'):
+            return self.unary()
+        if self.accept('!'):
+            a = self.unary()
+            return lambda v: _bool(np.equal(a(v), 0))
+        return self.power()
+
+    def power(self):
+        a = self.primary()
+        if self.accept('^'):
+            b = self.unary()
+            return lambda v: np.power(a(v), b(v))
+        return a
+
+    def primary(self):
+        (t, val) = self.peek()
+        self.pos += 1
+        if t == 'num':
+            return lambda v: val
+        elif t == 'vol':
+            self.max_vol = max(self.max_vol, val)
+            return lambda v: v[val]
+        elif t == 'id':
+            if val in _functions:
+                (nargs, fn) = _functions[val]
+                self.expect('(')
+                args = [self.ternary()]
+                while self.accept(','):
+                    args.append(self.ternary())
+                self.expect(')')
+                if len(args) != nargs:
+                    raise Unsupported('Wrong number of arguments for {}'.format(val))
+                return lambda v: fn(*[a(v) for a in args])
+            elif val in _constants:
+                c = _constants[val]
+                return lambda v: c
+            raise Unsupported('Unsupported identifier:{}'.format(val))
+        elif (t, val) == ('op', '('):
+            e = self.ternary()
+            self.expect(')')
+            return e
+        raise Unsupported('Unexpected token:{}'.format(repr((t, val))))
+
+
+def compile_expression(expression):
+    """compile minccalc expression, returns (function, number of volumes used)"""
+    if not have_numpy_backend:
+        raise Unsupported('numpy is not available')
+    p = _Parser(expression)
+    return (p.parse(), p.max_vol + 1)
+
+
+def calc(inputs, expression, output, datatype=None, labels=False, zero=False):
+    """equivalent of minccalc -copy_header"""
+    (fn, n) = compile_expression(expression)
+    if n > len(inputs):
+        raise Unsupported('Expression refers to more volumes than given')
+    (vols, ref) = load_many(inputs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = fn(vols)
+    if not isinstance(out, np.ndarray) or out.shape != vols[0].shape:
+        out = np.broadcast_to(out, vols[0].shape)
+    if zero:
+        out = np.where(np.isfinite(out), out, 0.0)
+    save(ref, output, out, datatype=datatype, labels=labels)
+
+
+##########################################################################
+# mincmath
+
+_math_nary = {
+    'add':  lambda a, b: np.add(a, b),
+    'mult': lambda a, b: np.multiply(a, b),
+    'max':  lambda a, b: np.maximum(a, b),
+    'min':  lambda a, b: np.minimum(a, b),
+    'and':  lambda a, b: _bool(np.logical_and(a != 0, b != 0)),
+    'or':   lambda a, b: _bool(np.logical_or(a != 0, b != 0)),
+}
+
+_math_binary = {
+    'sub': lambda a, b: np.subtract(a, b),
+    'div': lambda a, b: np.true_divide(a, b),
+    'gt':  lambda a, b: _bool(np.greater(a, b)),
+    'ge':  lambda a, b: _bool(np.greater_equal(a, b)),
+    'lt':  lambda a, b: _bool(np.less(a, b)),
+    'le':  lambda a, b: _bool(np.less_equal(a, b)),
+    'eq':  lambda a, b: _bool(np.equal(a, b)),
+    'ne':  lambda a, b: _bool(np.not_equal(a, b)),
+}
+
+_math_unary = {
+    'not':  lambda a: _bool(np.equal(a, 0)),
+    'abs':  lambda a: np.abs(a),
+    'sqrt': lambda a: np.sqrt(a),
+    'exp':  lambda a: np.exp(a),
+    'log':  lambda a: np.log(a),
+    'isnan':  lambda a: _bool(np.isnan(a)),
+    'nisnan': lambda a: _bool(~np.isnan(a)),
+}
+
+
+def math(inputs, operation, output, datatype=None, labels=False):
+    """equivalent of mincmath -copy_header"""
+    _check_backend()
+    if operation in _math_unary:
+        if len(inputs) != 1:
+            raise Unsupported('{} needs one input'.format(operation))
+    elif operation in _math_binary:
+        if len(inputs) != 2:
+            raise Unsupported('{} needs two inputs'.format(operation))
+    elif operation in _math_nary:
+        if len(inputs) < 2:
+            raise Unsupported('{} needs two or more inputs'.format(operation))
+    else:
+        raise Unsupported('Unsupported operation:{}'.format(operation))
+
+    (vols, ref) = load_many(inputs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if operation in _math_unary:
+            out = _math_unary[operation](vols[0])
+        elif operation in _math_binary:
+            out = _math_binary[operation](vols[0], vols[1])
+        else:
+            out = vols[0]
+            for v in vols[1:]:
+                out = _math_nary[operation](out, v)
+    save(ref, output, out, datatype=datatype, labels=labels)
+
+
+##########################################################################
+# averaging
+
+def average(inputs, output, sdfile=None, datatype=None):
+    """equivalent of mincaverage -copy_header"""
+    _check_backend()
+    (acc, ref) = load(inputs[0])
+    acc = acc.copy()
+    acc2 = acc * acc if sdfile is not None else None
+    for i in inputs[1:]:
+        (v, f) = load(i)
+        f.close()
+        if v.shape != acc.shape:
+            raise Unsupported('Volumes have different shape: {} and {}'.format(inputs[0], i))
+        acc += v
+        if acc2 is not None:
+            acc2 += v * v
+    n = float(len(inputs))
+    avg = acc / n
+    save(ref, output, avg, datatype=datatype)
+    if sdfile is not None:
+        if n > 1:
+            var = (acc2 - acc * acc / n) / (n - 1.0)
+        else:
+            var = np.zeros_like(acc)
+        save(ref, sdfile, np.sqrt(np.clip(var, 0.0, None)), datatype=datatype)
+
+
+def median(inputs, output, madfile=None, datatype=None):
+    """equivalent of minc_median"""
+    (vols, ref) = load_many(inputs, data_type=minc2_file.MINC2_FLOAT if have_numpy_backend else None)
+    stack = np.stack(vols)
+    del vols
+    med = np.median(stack, axis=0)
+    save(ref, output, med, datatype=datatype)
+    if madfile is not None:
+        save(ref, madfile, np.median(np.abs(stack - med), axis=0), datatype=datatype)
+
+
+##########################################################################
+# mincstats
+
+def stats(input, stats, mask=None, mask_binvalue=1,
+          val_floor=None, val_ceil=None, val_range=None,
+          single_value=True):
+    """equivalent of mincstats -q"""
+    if not isinstance(stats, list):
+        stats = [stats]
+    (vol, ref) = load(input)
+    sel = np.isfinite(vol)
+    if mask is not None:
+        (m, _) = load(mask)
+        if m.shape != vol.shape:
+            # mincstats would resample mask
+            raise Unsupported('Mask shape is different')
+        sel &= np.abs(m - mask_binvalue) < 0.5
+    if val_floor is not None:
+        sel &= vol >= val_floor
+    if val_ceil is not None:
+        sel &= vol <= val_ceil
+    if val_range is not None:
+        sel &= (vol >= val_range[0]) & (vol <= val_range[1])
+    v = vol[sel]
+
+    out = []
+    i = 0
+    while i < len(stats):
+        s = stats[i]
+        if s == '-mean':
+            out.append(np.mean(v))
+        elif s == '-median':
+            out.append(np.median(v))
+        elif s in ('-stddev', '-std'):
+            out.append(np.std(v, ddof=1) if v.size > 1 else 0.0)
+        elif s in ('-var', '-variance'):
+            out.append(np.var(v, ddof=1) if v.size > 1 else 0.0)
+        elif s == '-sum':
+            out.append(np.sum(v))
+        elif s == '-min':
+            out.append(np.min(v))
+        elif s == '-max':
+            out.append(np.max(v))
+        elif s == '-count':
+            out.append(float(v.size))
+        elif s == '-volume':
+            out.append(v.size * voxel_volume(ref))
+        elif s == '-pctT':
+            i += 1
+            out.append(np.percentile(v, float(stats[i])))
+        else:
+            raise Unsupported('Unsupported statistic:{}'.format(s))
+        i += 1
+    out = [float(j) for j in out]
+    if single_value:
+        if len(out) != 1:
+            raise Unsupported('Single value requested for multiple statistics')
+        return out[0]
+    return out
+
+
+##########################################################################
+# morphology
+
+_morph_re = re.compile(r'^([DEOC])\[(\d+)\]$')
+
+
+def _ball(radius):
+    r = np.arange(-radius, radius + 1)
+    (z, y, x) = np.meshgrid(r, r, r, indexing='ij')
+    return (x * x + y * y + z * z) <= radius * radius
+
+
+def binary_morphology(source, expression, target, binarize_bimodal=False, binarize_threshold=None):
+    """equivalent of itk_morph for dilation/erosion/opening/closing with
+    ball-shaped structuring elements"""
+    _check_backend()
+    if not have_scipy_ndimage:
+        raise Unsupported('scipy.ndimage is not available')
+    if binarize_bimodal:
+        raise Unsupported('Bimodal thresholding is not supported')
+    ops = []
+    if expression is not None and expression != '':
+        for e in expression.split():
+            m = _morph_re.match(e)
+            if m is None:
+                raise Unsupported('Unsupported morphology operation:{}'.format(e))
+            ops.append((m.group(1), int(m.group(2))))
+    (vol, ref) = load(source)
+    if binarize_threshold is not None:
+        img = vol > binarize_threshold
+    else:
+        img = vol > 0.5
+    for (op, r) in ops:
+        if r == 0:
+            continue
+        se = _ball(r)
+        if op == 'D':
+            img = scipy.ndimage.binary_dilation(img, structure=se)
+        elif op == 'E':
+            img = scipy.ndimage.binary_erosion(img, structure=se)
+        elif op == 'O':
+            img = scipy.ndimage.binary_opening(img, structure=se)
+        elif op == 'C':
+            img = scipy.ndimage.binary_closing(img, structure=se)
+    save(ref, target, img.astype(np.uint8), datatype='byte', labels=True)
+
+
+##########################################################################
+# label statistics
+
+def label_names(label_defs):
+    """label id -> name mapping from a dict, a list of pairs or a csv file"""
+    if label_defs is None:
+        return None
+    if isinstance(label_defs, dict):
+        return {int(i): j for i, j in label_defs.items()}
+    elif isinstance(label_defs, list):
+        return {int(i[0]): i[1] for i in label_defs}
+    # label definitions in a csv file
+    names = {}
+    with open(label_defs, 'r') as f:
+        for r in f:
+            r = r.strip().split(',')
+            if len(r) > 1:
+                names[int(r[0])] = r[1]
+    return names
+
+
+def _as_list(x):
+    if x is None:
+        return []
+    if isinstance(x, (list, tuple)):
+        return list(x)
+    return [x]
+
+
+def label_file_stats(labels, volumes=None, masks=None, bg=False,
+                     median=False, sd=False):
+    """statistics of one label volume, in a single pass over the data
+
+    volumes - intensity volume(s) to calculate per-label mean (and
+              optionally median and SD)
+    masks   - mask(s) restricting the calculation, None stands for the
+              whole volume. Statistics are reported for every mask.
+
+    returns list of rows:
+      {'labels','mask','label','count','volume','centroid','mean','median','sd'}
+    with mean,median and sd being lists, one entry per intensity volume
+    """
+    (lbl, ref) = load(labels, data_type=minc2_file.MINC2_INT if have_numpy_backend else None)
+    lbl = lbl.astype(np.int64)
+    volumes = _as_list(volumes)
+    masks = _as_list(masks) or [None]
+
+    vols = []
+    for v in volumes:
+        (_v, _) = load(v)
+        if _v.shape != lbl.shape:
+            raise Unsupported('Volume shape is different:{}'.format(v))
+        vols.append(_v)
+
+    vox = voxel_volume(ref)
+    out = []
+    for m in masks:
+        sel = np.ones(lbl.shape, dtype=bool)
+        if m is not None:
+            (_m, _) = load(m)
+            if _m.shape != lbl.shape:
+                raise Unsupported('Mask shape is different:{}'.format(m))
+            sel &= _m > 0.5
+        if not bg:
+            sel &= lbl != 0
+        l = lbl[sel]
+        if np.any(l < 0):
+            raise Unsupported('Negative labels')
+
+        n = np.bincount(l)
+        present = np.nonzero(n)[0]
+        cnt = n[present].astype(np.float64)
+        idx = np.nonzero(sel)
+        coords = np.stack([np.bincount(l, weights=idx[a])[present] / cnt
+                           for a in range(lbl.ndim)], axis=-1)
+        centroids = voxel_to_world(ref, coords)
+
+        means = []
+        medians = []
+        sds = []
+        for v in vols:
+            v = v[sel]
+            mean = np.bincount(l, weights=v)[present] / cnt
+            means.append(mean)
+            if sd:
+                _mean = np.zeros(n.shape[0])
+                _mean[present] = mean
+                ss = np.bincount(l, weights=(v - _mean[l]) ** 2)[present]
+                sds.append(np.sqrt(ss / np.maximum(cnt - 1.0, 1.0)))
+            if median:
+                order = np.lexsort((v, l))
+                ls = l[order]
+                vs = v[order]
+                starts = np.searchsorted(ls, present, side='left')
+                ends = np.searchsorted(ls, present, side='right')
+                medians.append(np.array([np.median(vs[s:e]) for s, e in zip(starts, ends)]))
+
+        for k, i in enumerate(present):
+            out.append({'labels':   labels,
+                        'mask':     m,
+                        'label':    int(i),
+                        'count':    int(n[i]),
+                        'volume':   float(n[i] * vox),
+                        'centroid': [float(c) for c in centroids[k]],
+                        'mean':     [float(j[k]) for j in means],
+                        'median':   [float(j[k]) for j in medians],
+                        'sd':       [float(j[k]) for j in sds]})
+    ref.close()
+    return out
+
+
+def label_table(labels, volumes=None, masks=None, bg=False, label_defs=None,
+                median=False, sd=False, threads=4):
+    """label statistics of many label volumes, collected into one table
+
+    labels  - list of label volumes
+    volumes - intensity volume(s) for each label volume (same length as labels)
+    masks   - mask(s) for each label volume (same length as labels)
+
+    returns list of rows, as in label_file_stats, in the order of labels,
+    with 'input' set to the index of the label volume.
+    If label_defs is given, labels are replaced by names and labels without
+    definition are dropped.
+    """
+    _check_backend()
+    labels = _as_list(labels)
+    volumes = volumes if volumes is not None else [None] * len(labels)
+    masks = masks if masks is not None else [None] * len(labels)
+    if len(volumes) != len(labels) or len(masks) != len(labels):
+        raise ValueError('volumes and masks should be given for every label volume')
+
+    def _stats(i):
+        return label_file_stats(labels[i], volumes=volumes[i], masks=masks[i],
+                                bg=bg, median=median, sd=sd)
+
+    if threads > 1 and len(labels) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            tables = list(ex.map(_stats, range(len(labels))))
+    else:
+        tables = [_stats(i) for i in range(len(labels))]
+
+    names = label_names(label_defs)
+    out = []
+    for (k, t) in enumerate(tables):
+        for r in t:
+            r['input'] = k
+            if names is not None:
+                if r['label'] not in names:
+                    continue
+                r['label'] = names[r['label']]
+            out.append(r)
+    return out
+
+
+def label_stats(input, bg=False, label_defs=None, volume=None,
+                median=False, mask=None):
+    """equivalent of itk_label_stats: label_id, volume, mx, my, mz,[mean/median]"""
+    rows = label_table([input], volumes=[volume], masks=[mask], bg=bg,
+                       label_defs=label_defs, median=median and volume is not None,
+                       threads=1)
+    out = []
+    for r in rows:
+        row = [r['label'], r['volume']] + r['centroid']
+        if volume is not None:
+            row.append(r['median'][0] if median else r['mean'][0])
+        out.append(row)
+    return out
+
+
+##########################################################################
+# mincreshape
+
+_dimrange_re = re.compile(r'^(\w+)=(\d+),(\d+)$')
+
+_dim_names = {}
+if have_numpy_backend:
+    _dim_names = {'xspace': minc2_file.MINC2_DIM_X,
+                  'yspace': minc2_file.MINC2_DIM_Y,
+                  'zspace': minc2_file.MINC2_DIM_Z}
+
+
+def reshape(input, output, normalize=False, datatype=None,
+            image_range=None, valid_range=None, dimorder=None,
+            signed=False, unsigned=False, dimrange=None):
+    """equivalent of mincreshape for type conversion and cropping"""
+    _check_backend()
+    if normalize or image_range or valid_range or dimorder or signed or unsigned:
+        raise Unsupported('Unsupported mincreshape options')
+    (vol, ref) = load(input)
+    dims = ref.store_dims()
+    if datatype is None:
+        # like mincreshape, keep the storage type
+        datatype = _store_datatype(ref)
+        if datatype not in ('float', 'double') and not _fits(vol, datatype):
+            # scaled integer volume, would need rescaling
+            raise Unsupported('Scaled integer volume {}'.format(input))
+    if dimrange is not None:
+        if not isinstance(dimrange, list):
+            dimrange = [dimrange]
+        slices = [slice(None)] * vol.ndim
+        for r in dimrange:
+            m = _dimrange_re.match(r)
+            if m is None or m.group(1) not in _dim_names:
+                raise Unsupported('Unsupported dimrange:{}'.format(r))
+            (start, count) = (int(m.group(2)), int(m.group(3)))
+            if count == 0:
+                raise Unsupported('Unsupported dimrange:{}'.format(r))
+            for k, d in enumerate(dims):
+                if d.id == _dim_names[m.group(1)]:
+                    a = vol.ndim - 1 - k
+                    start = max(0, min(start, d.length))
+                    count = min(count, d.length - start)
+                    slices[a] = slice(start, start + count)
+                    d.start = d.start + start * d.step
+                    d.length = count
+        vol = vol[tuple(slices)]
+    save(ref, output, vol, datatype=datatype, dims=dims)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
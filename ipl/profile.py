@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Tracing of external commands and trace reports
+#
+# Tracing is enabled with IPL_TRACE=<file.jsonl> environment variable or by
+# calling set_trace(), every external command launched through mincTools
+# is then recorded as one JSON line. Run
+#    python -m ipl.profile <file.jsonl>
+# to get per-tool and per-stage summary
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import json
+import errno
+import socket
+import fcntl
+import inspect
+import threading
+import subprocess
+import argparse
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_trace_file = None
+_trace_configured = False
+_local = threading.local()
+
+# modules considered to be part of the command launching machinery
+_skip_modules = ('minc_tools.py', 'profile.py', 'result_cache.py',
+                 'compression.py', 'contextlib.py', 'threading.py')
+
+
+def set_trace(trace_file):
+    """enable (or disable if trace_file is None) tracing for this process"""
+    global _trace_file, _trace_configured
+    _trace_configured = True
+    _trace_file = os.path.abspath(trace_file) if trace_file else None
+
+
+def get_trace():
+    """return current trace file, or None if tracing is disabled"""
+    if not _trace_configured:
+        set_trace(os.environ.get('IPL_TRACE', None))
+    return _trace_file
+
+
+@contextlib.contextmanager
+def stage(label):
+    """label all commands executed inside the context with pipeline stage name"""
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    _local.stages.append(label)
+    try:
+        yield label
+    finally:
+        _local.stages.pop()
+
+
+def current_stage():
+    """return current stage label, either explicit or from the call stack"""
+    stages = getattr(_local, 'stages', None)
+    if stages:
+        return '/'.join(stages)
+    f = sys._getframe(1)
+    while f is not None:
+        fname = f.f_code.co_filename
+        if os.path.basename(fname) not in _skip_modules:
+            mod = f.f_globals.get('__name__', None) or inspect.getmodulename(fname)
+            return '{}.{}'.format(mod, f.f_code.co_name)
+        f = f.f_back
+    return 'unknown'
+
+
+def _exit_code(sts):
+    """exit code of a child process, like Popen.returncode"""
+    if os.WIFSIGNALED(sts):
+        return -os.WTERMSIG(sts)
+    return os.WEXITSTATUS(sts)
+
+
+def _communicate_wait4(p):
+    """read outputs of Popen p and reap it with os.wait4, to get resource
+    usage of this child only
+    returns (exit code, stdout, stderr, rusage)"""
+    out = {}
+
+    def _read(name, f):
+        out[name] = f.read()
+        f.close()
+    readers = [threading.Thread(target=_read, args=(n, f))
+               for (n, f) in (('stdout', p.stdout), ('stderr', p.stderr)) if f is not None]
+    for t in readers:
+        t.start()
+    while True:
+        try:
+            (pid, sts, ru) = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    for t in readers:
+        t.join()
+    # the process is reaped, Popen should not wait for it
+    p.returncode = _exit_code(sts)
+    return (p.returncode, out.get('stdout', None), out.get('stderr', None), ru)
+
+
+def _file_sizes(paths):
+    total = 0
+    for i in paths:
+        try:
+            if os.path.isfile(i):
+                total += os.path.getsize(i)
+        except OSError:
+            pass
+    return total
+
+
+def _arg_files(cmds):
+    if not isinstance(cmds, list):
+        return []
+    return [str(i) for i in cmds[1:] if os.path.isfile(str(i))]
+
+
+def run(cmds, stdout=None, stderr=None, shell=False, env=None,
+        inputs=None, outputs=None):
+    """run external command and record a trace event if tracing is enabled
+
+    returns (exit code, stdout, stderr)
+    """
+    trace = get_trace()
+    if trace is None:
+        p = subprocess.Popen(cmds, stdout=stdout, stderr=stderr, shell=shell, env=env)
+        (output, output_stderr) = p.communicate()
+        return (p.wait(), output, output_stderr)
+
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    _before = set(_arg_files(cmds))
+    if inputs is None:
+        inputs = list(_before)
+
+    ru_before = None
+    if resource is not None:
+        ru_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    t0 = time.time()
+    p = subprocess.Popen(cmds, stdout=stdout, stderr=stderr, shell=shell, env=env)
+    ru = None
+    if hasattr(os, 'wait4'):
+        (outvalue, output, output_stderr, ru) = _communicate_wait4(p)
+    else:
+        (output, output_stderr) = p.communicate()
+        outvalue = p.wait()
+    wall = time.time() - t0
+
+    if ru is None and ru_before is not None:
+        # fall back to difference of accumulated children usage
+        _ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        utime = _ru.ru_utime - ru_before.ru_utime
+        stime = _ru.ru_stime - ru_before.ru_stime
+        maxrss = _ru.ru_maxrss
+        inblock = _ru.ru_inblock - ru_before.ru_inblock
+        oublock = _ru.ru_oublock - ru_before.ru_oublock
+    elif ru is not None:
+        utime, stime, maxrss = ru.ru_utime, ru.ru_stime, ru.ru_maxrss
+        inblock, oublock = ru.ru_inblock, ru.ru_oublock
+    else:
+        utime = stime = maxrss = inblock = oublock = None
+
+    if outputs is None:
+        outputs = [i for i in _arg_files(cmds) if i not in _before]
+
+    event = {
+        'time':    t0,
+        'host':    socket.gethostname(),
+        'pid':     os.getpid(),
+        'tool':    os.path.basename(cmds[0]) if isinstance(cmds, list) else str(cmds).split(' ', 1)[0],
+        'argv':    [str(i) for i in cmds] if isinstance(cmds, list) else cmds,
+        'stage':   current_stage(),
+        'status':  outvalue,
+        'wall':    wall,
+        'utime':   utime,
+        'stime':   stime,
+        'maxrss_kb': maxrss,
+        'input_bytes':  _file_sizes(inputs),
+        'output_bytes': _file_sizes(outputs),
+        'read_blocks':  inblock,
+        'write_blocks': oublock,
+    }
+    record(event)
+    return (outvalue, output, output_stderr)
+
+
+@contextlib.contextmanager
+def inprocess(tool, inputs=None, outputs=None):
+    """record operation performed in-process instead of an external command"""
+    if get_trace() is None:
+        yield
+        return
+    t0 = time.time()
+    c0 = time.process_time() if hasattr(time, 'process_time') else time.clock()
+    status = 0
+    try:
+        yield
+    except Exception:
+        status = -1
+        raise
+    finally:
+        c1 = time.process_time() if hasattr(time, 'process_time') else time.clock()
+        maxrss = None
+        if resource is not None:
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record({
+            'time':    t0,
+            'host':    socket.gethostname(),
+            'pid':     os.getpid(),
+            'tool':    tool,
+            'argv':    [tool] + list(inputs or []) + list(outputs or []),
+            'stage':   current_stage(),
+            'status':  status,
+            'wall':    time.time() - t0,
+            'utime':   c1 - c0,
+            'stime':   0.0,
+            'maxrss_kb': maxrss,
+            'input_bytes':  _file_sizes(inputs or []),
+            'output_bytes': _file_sizes(outputs or []),
+            'read_blocks':  None,
+            'write_blocks': None,
+        })
+
+
+def record(event):
+    """append one event to the trace file"""
+    trace = get_trace()
+    if trace is None:
+        return
+    line = json.dumps(event) + "\n"
+    with open(trace, 'a') as f:
+        # multiple scoop workers could be writing to the same file
+        fcntl.lockf(f.fileno(), fcntl.LOCK_EX)
+        try:
+            f.write(line)
+        finally:
+            fcntl.lockf(f.fileno(), fcntl.LOCK_UN)
+
+
+def load_trace(trace_file):
+    """read trace events from file"""
+    events = []
+    with open(trace_file, 'r') as f:
+        for l in f:
+            l = l.strip()
+            if l:
+                events.append(json.loads(l))
+    return events
+
+
+def aggregate(events, key='tool'):
+    """aggregate trace events by tool or stage, sorted by total wall time"""
+    agg = {}
+    for e in events:
+        k = e.get(key, 'unknown')
+        a = agg.setdefault(k, {key: k, 'count': 0, 'wall': 0.0, 'cpu': 0.0,
+                               'maxrss_kb': 0, 'input_bytes': 0,
+                               'output_bytes': 0, 'failed': 0})
+        a['count'] += 1
+        a['wall'] += e.get('wall') or 0.0
+        a['cpu'] += (e.get('utime') or 0.0) + (e.get('stime') or 0.0)
+        a['maxrss_kb'] = max(a['maxrss_kb'], e.get('maxrss_kb') or 0)
+        a['input_bytes'] += e.get('input_bytes') or 0
+        a['output_bytes'] += e.get('output_bytes') or 0
+        if e.get('status', 0) != 0:
+            a['failed'] += 1
+    return sorted(agg.values(), key=lambda a: a['wall'], reverse=True)
+
+
+def format_report(rows, key='tool', top=None):
+    total = sum(r['wall'] for r in rows) or 1.0
+    out = ["{:<50} {:>7} {:>10} {:>6} {:>10} {:>9} {:>10} {:>10}".format(
+        key, 'count', 'wall,s', '%', 'cpu,s', 'rss,MB', 'in,MB', 'out,MB')]
+    for r in rows[0:top]:
+        out.append("{:<50} {:>7} {:>10.1f} {:>6.1f} {:>10.1f} {:>9.1f} {:>10.1f} {:>10.1f}".format(
+            str(r[key])[-50:], r['count'], r['wall'], 100.0 * r['wall'] / total,
+            r['cpu'], r['maxrss_kb'] / 1024.0,
+            r['input_bytes'] / 1048576.0, r['output_bytes'] / 1048576.0))
+    return "\n".join(out)
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Summarize trace of external commands')
+
+    parser.add_argument('trace',
+                        nargs='+',
+                        help="Trace file(s) in JSON lines format")
+
+    parser.add_argument('--by',
+                        choices=['tool', 'stage', 'both'],
+                        default='both',
+                        help="Aggregate by tool, by stage or both")
+
+    parser.add_argument('--top',
+                        type=int,
+                        default=20,
+                        help="Show only top entries")
+
+    parser.add_argument('--json',
+                        action="store_true",
+                        default=False,
+                        help="Output aggregated results in json format")
+
+    return parser.parse_args()
+
+
+def main():
+    options = parse_options()
+    events = []
+    for t in options.trace:
+        events.extend(load_trace(t))
+
+    keys = ['tool', 'stage'] if options.by == 'both' else [options.by]
+    report = {k: aggregate(events, key=k) for k in keys}
+
+    if options.json:
+        json.dump(report, sys.stdout, indent=2)
+        print("")
+    else:
+        print("{} commands, {:.1f}s total wall time".format(
+            len(events), sum(e.get('wall') or 0.0 for e in events)))
+        for k in keys:
+            print("")
+            print(format_report(report[k], key=k, top=options.top))
+
+
+if __name__ == '__main__':
+    main()
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Cache of downsampled and blurred versions of volumes
+#
+# Registration steps of iterative model creation downsample and blur every
+# sample, and the current model, each time they are registered. With the
+# cache every version is built once per (volume, operation) and stored in a
+# shared directory (i.e <prefix>/pyramid), so that versions of samples are
+# reused between iterations. Entries of every source volume are kept in their
+# own subdirectory, keyed by the modification time of the source, so that
+# versions of a model estimate can be evicted when it is no longer used.
+# Entries are built under a lock and published atomically, so parallel
+# registration jobs (threads or processes) share them.
+
+from __future__ import print_function
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+
+from .minc_tools import mincTools
+from .result_cache import stat_key
+
+logger = logging.getLogger("MINC")
+
+# fcntl locks don't exclude threads of the same process
+_lock = threading.Lock()
+_entry_locks = {}
+
+
+def _entry_lock(path):
+    with _lock:
+        l = _entry_locks.get(path, None)
+        if l is None:
+            l = _entry_locks[path] = threading.Lock()
+        return l
+
+
+class PyramidCache(object):
+    """Directory of downsampled and blurred volumes"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        if not os.path.exists(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # created by another process
+                pass
+
+    def _source_dir(self, path):
+        """directory with entries of a source volume, entries derived from
+        other entries are kept together with them"""
+        path = os.path.abspath(path)
+        if os.path.dirname(os.path.dirname(path)) == self.root:
+            return os.path.dirname(path)
+        return os.path.join(self.root, hashlib.sha1(path.encode()).hexdigest()[0:16])
+
+    def _entry(self, path, operation):
+        key = hashlib.sha1(json.dumps([list(stat_key(path)), operation]).encode()).hexdigest()
+        base = os.path.basename(path).rsplit('.gz', 1)[0].rsplit('.mnc', 1)[0]
+        return os.path.join(self._source_dir(path),
+                            '{}_{}_{}.mnc'.format(base, '_'.join(str(i) for i in operation), key[0:8]))
+
+    def _build(self, output, build):
+        if os.path.exists(output):
+            return output
+        parent = os.path.dirname(output)
+        if not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass
+        with _entry_lock(output), open(output + '.lock', 'a') as lock:
+            fcntl.lockf(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                # could have been built while waiting for the lock
+                if not os.path.exists(output):
+                    tmp = output.rsplit('.mnc', 1)[0] + '.{}_{}.tmp.mnc'.format(
+                        os.getpid(), threading.current_thread().ident)
+                    build(tmp)
+                    os.rename(tmp, output)
+                    logger.debug('Pyramid: built {}'.format(output))
+            finally:
+                fcntl.lockf(lock.fileno(), fcntl.LOCK_UN)
+        return output
+
+    def downsample(self, path, step, labels=False):
+        """volume resampled to step, labels are resampled with nearest
+        neighbour"""
+        output = self._entry(path, ('labels' if labels else 'ds', step))
+
+        def _build(tmp):
+            with mincTools() as m:
+                if labels:
+                    m.resample_labels(path, tmp, unistep=step, datatype='byte')
+                else:
+                    m.resample_smooth(path, tmp, unistep=step)
+        return self._build(output, _build)
+
+    def blur(self, path, fwhm, gmag=False):
+        """blurred volume, or magnitude of gradient of blurred volume"""
+        output = self._entry(path, ('dxyz' if gmag else 'blur', fwhm))
+
+        def _build(tmp):
+            with mincTools() as m:
+                m.blur(path, tmp, gmag=gmag, fwhm=fwhm)
+        return self._build(output, _build)
+
+    def evict(self, path):
+        """remove all entries of a source volume, i.e of a previous model
+        estimate, once nothing is registered to it"""
+        if path is None:
+            return
+        shutil.rmtree(self._source_dir(path), ignore_errors=True)
+
+    def cleanup(self):
+        """remove all entries"""
+        shutil.rmtree(self.root, ignore_errors=True)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -19,6 +19,7 @@ import json
 
 import ipl.elastix_registration
 import ipl.minc_tools as minc_tools
+import ipl.compression
 
 import numpy as np 
 
@@ -116,6 +117,9 @@ if __name__ == "__main__":
             trg_info=minc.mincinfo(options.target)
             #
             parts=3
+            # measurement volumes are never kept
+            ipl.compression.configure(temp=0, final=0)
+            # also for files written by other means
             os.environ['MINC_COMPRESS']='0'
             
             parameters={'metric':metric,
@@ -273,7 +273,8 @@ def linear_register(
     work_dir=None,
     start=None,
     downsample=None,
-    verbose=0
+    verbose=0,
+    pyramid=None
     ):
     """Perform linear registration, replacement for bestlinreg.pl script
     
@@ -305,6 +306,7 @@ def linear_register(
         start - initial blurring level, default 16mm from configuration
         downsample - downsample initial files to this step size, default None
         verbose  - verbosity level
+        pyramid - ipl.pyramid.PyramidCache to reuse downsampled and blurred files (optional)
     Returns:
         resulting XFM file
 
@@ -377,7 +379,7 @@ def linear_register(
         # figure out what to do here:
         with ipl.minc_tools.cache_files(work_dir=work_dir,context='reg') as tmp:
             
-            (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample)
+            (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample, pyramid=pyramid)
                 
             # a fitting we shall go...
             for (i,c) in enumerate(conf):
@@ -404,13 +406,17 @@ def linear_register(
                     tmp_targets=[]
                     
                     for s_,_ in enumerate(sources_lr):
-                        tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_source):
-                            minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                            
-                        tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_target):
-                            minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
+                        if pyramid is not None:
+                            tmp_source = pyramid.blur(sources_lr[s_], c['blur_fwhm'], gmag=(c['blur']=='dxyz'))
+                            tmp_target = pyramid.blur(targets_lr[s_], c['blur_fwhm'], gmag=(c['blur']=='dxyz'))
+                        else:
+                            tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
+                            if not os.path.exists(tmp_source):
+                                minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
+                                
+                            tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
+                            if not os.path.exists(tmp_target):
+                                minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
                             
                         tmp_sources.append(tmp_source)
                         tmp_targets.append(tmp_target)
@@ -569,7 +575,8 @@ def non_linear_register_full(
     start=32,
     parameters=None,
     work_dir=None,
-    downsample=None
+    downsample=None,
+    pyramid=None
     ):
     """perform non-linear registration, multiple levels
     Args:
@@ -584,6 +591,7 @@ def non_linear_register_full(
         start - initial step size, default 32mm 
         level - final step size, default 4mm
         downsample - downsample initial files to this step size, default None
+        pyramid - ipl.pyramid.PyramidCache to reuse downsampled and blurred files (optional)
 
     Returns:
         resulting XFM file
@@ -686,7 +694,7 @@ def non_linear_register_full(
       # figure out what to do here:
       with ipl.minc_tools.cache_files(work_dir=work_dir,context='reg') as tmp:
           # a fitting we shall go...
-          (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample)
+          (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample, pyramid=pyramid)
           
           for (i,c) in enumerate(parameters['conf']):
 
@@ -709,12 +717,16 @@ def non_linear_register_full(
                     tmp_targets=[]
                     
                     for s_,_ in enumerate(sources_lr):
-                        tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_source):
-                            minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                        tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_target):
-                            minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
+                        if pyramid is not None:
+                            tmp_source = pyramid.blur(sources_lr[s_], c['blur_fwhm'], gmag=(c['blur']=='dxyz'))
+                            tmp_target = pyramid.blur(targets_lr[s_], c['blur_fwhm'], gmag=(c['blur']=='dxyz'))
+                        else:
+                            tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
+                            if not os.path.exists(tmp_source):
+                                minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
+                            tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
+                            if not os.path.exists(tmp_target):
+                                minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
                         tmp_sources.append(tmp_source)
                         tmp_targets.append(tmp_target)
 
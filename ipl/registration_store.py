@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Store of registration results shared between experiments
+#
+# Entries are keyed by registration method, its parameters and content of
+# all input files: for MINC volumes the digest covers sampling and voxel
+# values, but not the header history, so that the same scan resampled again
+# in a different work directory is recognized; for transformations comment
+# lines are ignored and grid files are followed. Transformations are stored
+# together with their grids and placed back under the requested names.
+# Entries are published atomically, so concurrent processes can share one
+# store. The store is selected with IPL_REGISTRATION_STORE environment
+# variable or explicitly.
+
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import logging
+
+try:
+    from minc2_simple import minc2_file
+    have_minc2_simple = True
+except ImportError:
+    # minc2_simple not available :(
+    have_minc2_simple = False
+
+from . import minc_header
+from . import stream
+from .result_cache import file_digest, stat_key, grid_re, BoundedMemo
+
+logger = logging.getLogger("MINC")
+
+# memoized content digests, keyed by (path, size, mtime, inode)
+_digest_memo = BoundedMemo()
+_lock = threading.Lock()
+_stores = {}
+
+
+def _grids(path):
+    """list of (reference, path) of grid files of a transformation"""
+    with open(path, 'r') as f:
+        xfm = f.read()
+    base = os.path.dirname(os.path.abspath(path))
+    return (xfm, [(g, g if os.path.isabs(g) else os.path.join(base, g))
+                  for g in grid_re.findall(xfm)])
+
+
+def content_digest(path):
+    """digest of file content, ignoring history of MINC files"""
+    key = stat_key(path)
+    d = _digest_memo.get(key)
+    if d is not None:
+        return d
+    h = hashlib.sha1()
+    if path.endswith('.xfm'):
+        (xfm, grids) = _grids(path)
+        for l in xfm.splitlines():
+            if not l.startswith('%') and not grid_re.match(l):
+                h.update(l.encode())
+        for (g, g_path) in grids:
+            h.update(content_digest(g_path).encode())
+    elif path.endswith('.mnc') and have_minc2_simple:
+        hdr = minc_header.header(path)
+        h.update(json.dumps([hdr['dimorder'], hdr['dims']], sort_keys=True).encode())
+        # voxel values are hashed slab by slab, to keep memory use bounded
+        for (z0, z1, (slab,)) in stream.iterate([path], data_type=minc2_file.MINC2_DOUBLE):
+            h.update(slab.tobytes())
+    else:
+        h.update(file_digest(path).encode())
+    d = h.hexdigest()
+    _digest_memo.put(key, d)
+    return d
+
+
+def copy_xfm(src, dst):
+    """copy transformation with grid files, grids are renamed after dst"""
+    (xfm, grids) = _grids(src)
+    dst_base = dst.rsplit('.xfm', 1)[0]
+    for (k, (g, g_path)) in enumerate(grids):
+        _g = '{}_grid_{}.mnc'.format(dst_base, k)
+        shutil.copyfile(g_path, _g)
+        xfm = xfm.replace(g, os.path.basename(_g))
+    tmp = dst + '.{}.tmp'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(xfm)
+    os.rename(tmp, dst)
+
+
+def _copy(src, dst):
+    if src.endswith('.xfm'):
+        copy_xfm(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+class RegistrationStore(object):
+    """Directory of registration results, keyed by inputs and parameters"""
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        if not os.path.exists(self.store_dir):
+            try:
+                os.makedirs(self.store_dir)
+            except OSError:
+                # created by another process
+                pass
+
+    def key(self, method, inputs, parameters=None):
+        """calculate key, inputs could contain None for missing files"""
+        _norm = [method, json.dumps(parameters, sort_keys=True, default=str)]
+        for i in inputs:
+            if i is None:
+                _norm.append(None)
+            elif not os.path.exists(i):
+                return None
+            else:
+                _norm.append(content_digest(i))
+        h = hashlib.sha1()
+        h.update(json.dumps(_norm).encode())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.store_dir, key[0:2], key)
+
+    def _name(self, i, output):
+        return 'out{}{}'.format(i, os.path.splitext(output)[1])
+
+    def fetch(self, key, outputs):
+        """place stored results, returns True if found"""
+        if key is None:
+            return False
+        entry = self._entry(key)
+        if not os.path.exists(os.path.join(entry, 'meta.json')):
+            return False
+        try:
+            for (i, o) in enumerate(outputs):
+                _copy(os.path.join(entry, self._name(i, o)), o)
+        except (IOError, OSError) as e:
+            logger.debug('Registration store miss on {}:{}'.format(key, str(e)))
+            return False
+        logger.debug('Registration store hit:{}'.format(key))
+        return True
+
+    def store(self, key, outputs, method=None):
+        """store results of a finished registration"""
+        if key is None or not all(os.path.isfile(o) for o in outputs):
+            return
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        parent = os.path.dirname(entry)
+        if not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass
+        tmp = tempfile.mkdtemp(prefix='.' + key, dir=parent)
+        try:
+            for (i, o) in enumerate(outputs):
+                _copy(o, os.path.join(tmp, self._name(i, o)))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'method': method, 'outputs': outputs}, f)
+            # atomically publish
+            os.rename(tmp, entry)
+        except OSError:
+            # somebody else stored the same result first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def get_registration_store(store_dir=None):
+    """registration store in store_dir, or the one set with
+    IPL_REGISTRATION_STORE, None if neither is given"""
+    if store_dir is None:
+        store_dir = os.environ.get('IPL_REGISTRATION_STORE', None)
+    if not store_dir:
+        return None
+    with _lock:
+        s = _stores.get(store_dir, None)
+        if s is None:
+            s = _stores[store_dir] = RegistrationStore(store_dir)
+    return s
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
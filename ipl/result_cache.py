@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Content-addressed cache of external command results
+
+from __future__ import print_function
+
+import os
+import sys
+import stat
+import shutil
+import hashlib
+import json
+import fcntl
+import subprocess
+import tempfile
+import logging
+import threading
+import collections
+import re
+
+logger = logging.getLogger("MINC")
+
+
+class BoundedMemo(object):
+    """thread-safe memo, keeping max_size most recently used entries"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            v = self._entries.pop(key, None)
+            if v is None:
+                return default
+            self._entries[key] = v
+            return v
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+# memoized content digests, keyed by (path, size, mtime, inode)
+_digest_memo = BoundedMemo()
+# memoized tool identity, keyed by tool name
+_tool_memo = {}
+
+# reference to a grid file inside .xfm
+grid_re = re.compile(r'^\s*Displacement_Volume\s*=\s*(\S+?)\s*;', re.MULTILINE)
+
+
+def stat_key(path):
+    """identity of a file version: (path, size, mtime, inode)"""
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, st.st_mtime, st.st_ino)
+
+
+def file_digest(path, block_size=1 << 20):
+    """calculate sha1 digest of file contents, memoized by (path,size,mtime,inode)"""
+    key = stat_key(path)
+    d = _digest_memo.get(key)
+    if d is not None:
+        return d
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(block_size)
+            if not b:
+                break
+            h.update(b)
+    d = h.hexdigest()
+    _digest_memo.put(key, d)
+    return d
+
+
+def xfm_digest(path):
+    """digest of an .xfm file, including any grid files it refers to"""
+    h = hashlib.sha1()
+    h.update(file_digest(path).encode())
+    try:
+        with open(path, 'r') as f:
+            _xfm = f.read()
+    except (IOError, UnicodeDecodeError):
+        return h.hexdigest()
+    base = os.path.dirname(os.path.abspath(path))
+    for g in grid_re.findall(_xfm):
+        g_path = g if os.path.isabs(g) else os.path.join(base, g)
+        if os.path.isfile(g_path):
+            h.update(file_digest(g_path).encode())
+    return h.hexdigest()
+
+
+def path_digest(path):
+    """digest of an input file, following grid references of xfm files"""
+    if path.endswith('.xfm'):
+        return xfm_digest(path)
+    return file_digest(path)
+
+
+def tool_version(tool):
+    """identify a tool by the location, size and mtime of the executable"""
+    try:
+        return _tool_memo[tool]
+    except KeyError:
+        pass
+    exe = None
+    if os.sep in tool:
+        exe = tool
+    else:
+        for d in os.environ.get('PATH', '').split(os.pathsep):
+            c = os.path.join(d, tool)
+            if os.path.isfile(c) and os.access(c, os.X_OK):
+                exe = c
+                break
+    if exe is not None and os.path.exists(exe):
+        exe = os.path.realpath(exe)
+        st = os.stat(exe)
+        version = '{}:{}:{}'.format(exe, st.st_size, int(st.st_mtime))
+    else:
+        version = 'unknown:' + tool
+    _tool_memo[tool] = version
+    return version
+
+
+def parse_size(size):
+    """parse size specification like 100G, 512M or plain number of bytes"""
+    if size is None:
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    size = size.strip().upper()
+    mult = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if size and size[-1] in mult:
+        return int(float(size[:-1]) * mult[size[-1]])
+    return int(size)
+
+
+class ResultCache(object):
+    """Content-addressed store of command outputs
+
+    Entries are keyed by normalized command line, tool version, compression
+    level and digests of all input files. Stored objects are read-only.
+    Outputs are placed back using reflink (copy-on-write) copies when
+    possible, so that they can be modified in place (i.e header edits)
+    without changing the cache. With link='hard' read-only outputs are
+    stored as hard links.
+    Least recently used entries are evicted when the store grows above
+    max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=None, link='reflink'):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = parse_size(max_size)
+        self.link = link
+        self.objects = os.path.join(self.cache_dir, 'objects')
+        if not os.path.exists(self.objects):
+            try:
+                os.makedirs(self.objects)
+            except OSError:
+                # created by another process
+                pass
+        self._lock_name = os.path.join(self.cache_dir, 'lock')
+        self._usage_name = os.path.join(self.cache_dir, 'usage')
+
+    def key(self, cmds, inputs=None, outputs=None, env=None):
+        """calculate cache key, returns None if command can't be cached
+        env -- environment of the command, if it is not os.environ"""
+        if not isinstance(cmds, list) or not cmds or not outputs:
+            return None
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        inputs = inputs or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        _outputs = [os.path.abspath(o) for o in outputs]
+        _norm = [tool_version(cmds[0])]
+        # files written with different compression are not interchangeable
+        _norm.append('@Z:' + (env if env is not None else os.environ).get('MINC_COMPRESS', ''))
+        try:
+            for c in cmds[1:]:
+                c = str(c)
+                if os.path.abspath(c) in _outputs:
+                    _norm.append('@OUT{}'.format(_outputs.index(os.path.abspath(c))))
+                elif os.path.isfile(c):
+                    _norm.append('@IN:' + path_digest(c))
+                else:
+                    # outputs could be embedded into an argument, i.e [a,b]
+                    for i, o in enumerate(outputs):
+                        c = c.replace(o, '@OUT{}'.format(i))
+                    _norm.append(c)
+            # inputs which do not appear directly on the command line
+            for i in inputs:
+                _norm.append('@DEP:' + path_digest(i))
+        except OSError:
+            return None
+        h = hashlib.sha1()
+        h.update(json.dumps(_norm).encode())
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.objects, key[0:2], key)
+
+    def _place(self, src, dst, hard=False):
+        if os.path.exists(dst):
+            os.unlink(dst)
+        # a hard link shares content, only files which can't be modified
+        # in place are linked
+        if hard and self.link == 'hard' and \
+                not os.stat(src).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        if self.link in ('hard', 'reflink'):
+            try:
+                with open(os.devnull, 'w') as fnull:
+                    if subprocess.call(['cp', '--reflink=auto', src, dst],
+                                       stderr=fnull) == 0:
+                        return
+            except OSError:
+                pass
+        shutil.copyfile(src, dst)
+
+    def fetch(self, key, outputs):
+        """place cached outputs, returns True on cache hit"""
+        if key is None:
+            return False
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        entry = self._entry(key)
+        meta = os.path.join(entry, 'meta.json')
+        if not os.path.exists(meta):
+            return False
+        try:
+            for i, o in enumerate(outputs):
+                self._place(os.path.join(entry, 'out{}'.format(i)), o)
+                # copy of a read-only object
+                os.chmod(o, os.stat(o).st_mode | stat.S_IWUSR)
+            # mark as recently used
+            os.utime(entry, None)
+        except (IOError, OSError) as e:
+            # entry was evicted while we were reading it
+            logger.debug('Result cache miss on {}:{}'.format(key, str(e)))
+            return False
+        logger.debug('Result cache hit:{}'.format(key))
+        return True
+
+    def store(self, key, outputs, cmds=None):
+        """store outputs of a finished command"""
+        if key is None:
+            return
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        if not all(os.path.isfile(o) for o in outputs):
+            return
+        # nonlinear transforms refer to grid files by name, which
+        # can't be relocated safely
+        for o in outputs:
+            if o.endswith('.xfm'):
+                with open(o, 'r') as f:
+                    if grid_re.search(f.read()):
+                        return
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        parent = os.path.dirname(entry)
+        if not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                pass
+        tmp = tempfile.mkdtemp(prefix='.' + key, dir=parent)
+        size = 0
+        try:
+            for i, o in enumerate(outputs):
+                _o = os.path.join(tmp, 'out{}'.format(i))
+                self._place(o, _o, hard=True)
+                os.chmod(_o, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                size += os.path.getsize(_o)
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'cmd': cmds, 'size': size}, f)
+            # atomically publish
+            os.rename(tmp, entry)
+        except OSError:
+            # somebody else stored the same result first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self._update_usage(size)
+
+    def _update_usage(self, delta):
+        with open(self._lock_name, 'a') as lock:
+            fcntl.lockf(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                usage = 0
+                if os.path.exists(self._usage_name):
+                    with open(self._usage_name, 'r') as f:
+                        usage = int(f.read().strip() or 0)
+                usage += delta
+                if self.max_size is not None and usage > self.max_size:
+                    usage = self._evict()
+                with open(self._usage_name, 'w') as f:
+                    f.write(str(usage))
+            finally:
+                fcntl.lockf(lock.fileno(), fcntl.LOCK_UN)
+
+    def _scan(self):
+        entries = []
+        for d in os.listdir(self.objects):
+            _d = os.path.join(self.objects, d)
+            if not os.path.isdir(_d):
+                continue
+            for e in os.listdir(_d):
+                if e.startswith('.'):
+                    continue
+                _e = os.path.join(_d, e)
+                try:
+                    with open(os.path.join(_e, 'meta.json'), 'r') as f:
+                        size = json.load(f)['size']
+                    entries.append((os.path.getmtime(_e), size, _e))
+                except (IOError, OSError, ValueError, KeyError):
+                    pass
+        return entries
+
+    def _evict(self):
+        """remove least recently used entries until below the size budget,
+        has to be called with lock held. Returns new usage."""
+        entries = sorted(self._scan())
+        usage = sum(i[1] for i in entries)
+        for (_, size, e) in entries:
+            if usage <= self.max_size:
+                break
+            shutil.rmtree(e, ignore_errors=True)
+            usage -= size
+            logger.debug('Result cache evicted:{}'.format(os.path.basename(e)))
+        return usage
+
+    def usage(self):
+        """total size of cached results in bytes"""
+        return sum(i[1] for i in self._scan())
+
+    def clear(self):
+        with open(self._lock_name, 'a') as lock:
+            fcntl.lockf(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                shutil.rmtree(self.objects, ignore_errors=True)
+                os.makedirs(self.objects)
+                with open(self._usage_name, 'w') as f:
+                    f.write('0')
+            finally:
+                fcntl.lockf(lock.fileno(), fcntl.LOCK_UN)
+
+
+_result_cache = None
+_result_cache_configured = False
+
+
+def configure(cache_dir=None, max_size=None, link=None):
+    """enable (or disable, if cache_dir is None) result cache for this process"""
+    global _result_cache, _result_cache_configured
+    _result_cache_configured = True
+    if cache_dir is None:
+        _result_cache = None
+    else:
+        _result_cache = ResultCache(cache_dir, max_size=max_size,
+                                    link=link or 'reflink')
+    return _result_cache
+
+
+def get_result_cache():
+    """return process-wide result cache, configured from environment
+    variables IPL_RESULT_CACHE, IPL_RESULT_CACHE_SIZE and IPL_RESULT_CACHE_LINK
+    unless configure() was called"""
+    if not _result_cache_configured:
+        configure(os.environ.get('IPL_RESULT_CACHE', None),
+                  max_size=os.environ.get('IPL_RESULT_CACHE_SIZE', None),
+                  link=os.environ.get('IPL_RESULT_CACHE_LINK', None))
+    return _result_cache
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -30,6 +30,8 @@ from .library          import LibEntry
 from .library          import SegLibrary
 from .train            import generate_library
 from .fuse             import fusion_segment
+from .fuse             import fusion_segment_batch
+from .fuse             import load_subjects_csv
 from .train_ec         import train_ec_loo
 from .cross_validation import loo_cv_fusion_segment
 from .cross_validation import full_cv_fusion_segment
@@ -43,6 +45,8 @@ __all__= ['generate_library',
           'load_library_info', 
           'cv_fusion_segment', 
           'fusion_segment',
+          'fusion_segment_batch',
+          'load_subjects_csv',
           'train_ec_loo',
           'volume_measure',
           'seg_to_volumes',
@@ -172,6 +172,16 @@ def run_segmentation_experiment( input_scan,
         raise
 
 
+def _with_registration_store(segmentation_parameters, output):
+    '''use registration store inside experiment directory, unless set explicitly'''
+    if segmentation_parameters is None or 'registration_store' in segmentation_parameters \
+       or os.environ.get('IPL_REGISTRATION_STORE', None):
+        return segmentation_parameters
+    _parameters=copy.deepcopy(segmentation_parameters)
+    _parameters['registration_store']=output+os.sep+'registrations'
+    return _parameters
+
+
 def loo_cv_fusion_segment(validation_library, 
                           segmentation_library, 
                           output, 
@@ -197,6 +207,9 @@ def loo_cv_fusion_segment(validation_library,
     results=[]
     results_json=[]
     
+    # registrations of the same pair of scans are shared by all folds
+    segmentation_parameters=_with_registration_store(segmentation_parameters, output)
+    
     modalities=segmentation_library.get('modalities',1)-1
     print("cv_iter={}".format(repr(cv_iter)))
     
@@ -303,6 +316,9 @@ def full_cv_fusion_segment(validation_library,
         
     modalities = segmentation_library.modalities-1
     
+    # registrations of the same pair of scans are shared by all folds
+    segmentation_parameters=_with_registration_store(segmentation_parameters, output)
+    
     for i in range( cv_iterations ):
         #TODO: save this list in a file
         rem_list = []
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Storage of error-correction models
+#
+# A model is a pair of classifiers [clf, clf2], it is saved together with
+# a description in <model>.json:
+#   format   -- 'xgb'    : native xgboost boosters in <model> and <model>_2
+#               'joblib' : joblib file, numpy arrays of the classifiers are
+#                          stored uncompressed and memory-mapped on load
+#               'pickle' : pickled list, used when joblib is not available
+#   schema   -- feature extraction parameters used in training,
+#               checked when the model is applied
+#
+# Models without description (pickled lists) are loaded as before.
+# Loaded models are kept in a per-process LRU cache, the number of cached
+# models is set with IPL_EC_MODEL_CACHE environment variable (default 4)
+
+import os
+import json
+import pickle
+import threading
+import collections
+
+try:
+    import joblib
+    have_joblib = True
+except ImportError:
+    try:
+        from sklearn.externals import joblib
+        have_joblib = True
+    except ImportError:
+        have_joblib = False
+
+try:
+    import xgboost as xgb
+    have_xgb = True
+except ImportError:
+    have_xgb = False
+
+from ipl.minc_tools import mincError
+
+# feature extraction parameters, with defaults used by error correction
+schema_defaults = collections.OrderedDict([
+    ('use_coord',        True),
+    ('use_joint',        True),
+    ('patch_size',       1),
+    ('primary_features', 1),
+])
+
+_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def feature_schema(parameters, n_features=None):
+    """feature extraction parameters of error correction"""
+    schema = {k: parameters.get(k, v) for (k, v) in schema_defaults.items()}
+    if n_features is not None:
+        schema['n_features'] = int(n_features)
+    return schema
+
+
+def _info_path(path):
+    return path + '.json'
+
+
+def load_info(path):
+    """description of a model, None for old style models"""
+    if not os.path.exists(_info_path(path)):
+        return None
+    with open(_info_path(path), 'r') as f:
+        return json.load(f)
+
+
+def _is_booster(clf):
+    return have_xgb and isinstance(clf, xgb.Booster)
+
+
+def save_model(path, clf, clf2, parameters, n_features=None):
+    """save pair of classifiers with the feature schema"""
+    if _is_booster(clf) and (clf2 is None or _is_booster(clf2)):
+        fmt = 'xgb'
+        clf.save_model(path)
+        if clf2 is not None:
+            clf2.save_model(path + '_2')
+    elif have_joblib:
+        fmt = 'joblib'
+        joblib.dump([clf, clf2], path)
+    else:
+        fmt = 'pickle'
+        with open(path, 'wb') as f:
+            pickle.dump([clf, clf2], f, -1)
+
+    info = {'format': fmt,
+            'method': parameters.get('method', 'lSVC'),
+            'method2': parameters.get('method2', parameters.get('method', 'lSVC')),
+            'second': clf2 is not None,
+            'schema': feature_schema(parameters, n_features)}
+    tmp = _info_path(path) + '.{}.tmp'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(info, f, indent=1)
+    os.rename(tmp, _info_path(path))
+    # file was replaced
+    clear_cache(path)
+
+
+def check_schema(path, info, parameters, n_features=None):
+    """raise mincError if model was trained with different features"""
+    if info is None:
+        return
+    trained = info.get('schema', {})
+    requested = feature_schema(parameters, n_features)
+    diff = ['{}={} (trained with {})'.format(k, repr(requested[k]), repr(trained[k]))
+            for k in sorted(requested) if k in trained and trained[k] != requested[k]]
+    if diff:
+        raise mincError('Error-correction model {} does not match features: {}'.format(
+            path, ', '.join(diff)))
+
+
+def _load(path, info, multilabel):
+    fmt = info['format'] if info is not None else None
+    if fmt == 'xgb':
+        # need to convert from Unicode
+        clf = xgb.Booster(model_file=str(path))
+        clf2 = None
+        if multilabel > 1 and os.path.exists(path + '_2'):
+            clf2 = xgb.Booster(model_file=str(path) + '_2')
+        return (clf, clf2)
+    elif fmt == 'joblib':
+        c = joblib.load(path, mmap_mode='r')
+    else:
+        with open(path, 'rb') as f:
+            c = pickle.load(f)
+    return (c[0], c[1])
+
+
+def _cache_size():
+    return int(os.environ.get('IPL_EC_MODEL_CACHE', '4'))
+
+
+def _key(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime, st.st_size)
+
+
+def load_model(path, parameters=None, multilabel=1, n_features=None, xgb_model=False):
+    """load pair of classifiers (clf, clf2), models are cached
+
+    parameters -- error correction parameters, used to check feature schema
+    xgb_model  -- old style model without description is a pair of xgboost
+                  boosters
+    """
+    info = load_info(path)
+    if parameters is not None:
+        check_schema(path, info, parameters, n_features)
+    if info is None and xgb_model:
+        info = {'format': 'xgb'}
+
+    key = _key(path) + (multilabel > 1,)
+    with _lock:
+        m = _cache.get(key, None)
+        if m is not None:
+            # most recently used is the last
+            _cache[key] = _cache.pop(key)
+            return m
+
+    m = _load(path, info, multilabel)
+
+    size = _cache_size()
+    if size > 0:
+        with _lock:
+            _cache[key] = m
+            while len(_cache) > size:
+                _cache.popitem(last=False)
+    return m
+
+
+def clear_cache(path=None):
+    """remove models from cache, all of them if path is None"""
+    with _lock:
+        if path is None:
+            _cache.clear()
+        else:
+            p = os.path.abspath(path)
+            for k in [k for k in _cache if k[0] == p]:
+                del _cache[k]
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
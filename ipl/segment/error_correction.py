@@ -19,6 +19,8 @@ except ImportError:
 import sys
 import json
 import csv
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 # minc
 from minc2_simple import minc2_xfm, minc2_file
  
@@ -46,6 +48,9 @@ except ImportError:
 
 # MINC stuff
 from   ipl.minc_tools import mincTools,mincError
+from   ipl.stream     import voxel_map
+from   ipl.result_cache import parse_size
+from   ipl.segment.ec_model import save_model, load_model
 import traceback
 
 
@@ -106,15 +111,119 @@ def prepare_features(images, coords, mask=None, use_coord=True, use_joint=True,
       return [  i for i in features ]
 
 
+def _feature_indices(shape, mask):
+    """coordinates of voxels used for features, in C order"""
+    if mask is not None:
+        return np.nonzero(mask > 0)
+    return tuple(np.ravel(i) for i in np.indices(shape))
+
+
+def feature_number(image_no, use_coord=True, use_joint=True, patch_size=1, primary_features=1):
+    '''
+    number of features produced by prepare_feature_matrix
+    '''
+    if primary_features > image_no or primary_features < 0:
+        primary_features = image_no
+    if patch_size > 0:
+        primary_no = primary_features * (patch_size*2+1)**3
+        rest_no = max(image_no - primary_features - 1, 0)
+    else:
+        primary_no = primary_features
+        rest_no = image_no - primary_features
+    n = primary_no + rest_no
+    if use_coord:
+        n += 3
+        if use_joint:
+            n += 3 * primary_no
+    return n
+
+
+def prepare_feature_matrix(images, coords, mask=None, use_coord=True, use_joint=True,
+                           patch_size=1, primary_features=1, dtype=np.float32, indices=None):
+    '''
+    build design matrix (voxels x features) with the same features as
+    prepare_features, only voxels inside mask are sampled: patch features are
+    gathered with index arithmetic instead of rolling whole volumes and
+    joint features are calculated on the fly
+
+    indices -- coordinates of voxels (tuple of three arrays), used instead of mask
+    '''
+    shape = images[0].shape
+    image_no = len(images)
+    if primary_features > image_no or primary_features < 0:
+        primary_features = image_no
+
+    idx = indices if indices is not None else _feature_indices(shape, mask)
+    n = idx[0].size
+
+    if patch_size > 0:
+        offsets = [(x, y, z) for x in range(-patch_size, patch_size+1)
+                             for y in range(-patch_size, patch_size+1)
+                             for z in range(-patch_size, patch_size+1)]
+        rest = images[primary_features:-1]
+    else:
+        offsets = [(0, 0, 0)]
+        rest = images[primary_features:]
+
+    coord_no = 3 if use_coord else 0
+    primary_no = primary_features * len(offsets)
+    joint_no = 3 * primary_no if (use_joint and use_coord) else 0
+    out = np.empty((n, coord_no + primary_no + len(rest) + joint_no), dtype=dtype)
+
+    # use with center at 0 and 1.0 at the edge, keep in double precision for joint features
+    _coords = []
+    if use_coord:
+        if coords is None:
+            _coords = [(idx[2] - shape[0]/2.0) / (shape[0]/2.0),
+                       (idx[1] - shape[1]/2.0) / (shape[1]/2.0),
+                       (idx[0] - shape[2]/2.0) / (shape[2]/2.0)]
+        else:
+            _coords = [np.asarray(coords[j])[idx] for j in range(3)]
+        for j in range(3):
+            out[:, j] = _coords[j]
+
+    # shifted (wrapped around) indices along each axis, like np.roll
+    shifted = [{} for j in range(3)]
+    for o in offsets:
+        for j in range(3):
+            if o[j] not in shifted[j]:
+                shifted[j][o[j]] = (idx[j] - o[j]) % shape[j] if o[j] != 0 else idx[j]
+
+    col = coord_no
+    joint = coord_no + primary_no + len(rest)
+    for i in range(primary_features):
+        for o in offsets:
+            v = images[i][shifted[0][o[0]], shifted[1][o[1]], shifted[2][o[2]]]
+            out[:, col] = v
+            col += 1
+            if joint_no > 0:
+                # multiply apparance features by coordinate features
+                for j in range(3):
+                    out[:, joint] = v * _coords[j]
+                    joint += 1
+
+    for i in rest:
+        out[:, col] = i[idx]
+        col += 1
+
+    return out
+
+
 def convert_image_list(images):
     '''
     convert array of images into a single matrix
     '''
     s=[]
     for (i,k) in enumerate(images):
-        s.append(np.column_stack( tuple( np.ravel( j ) for j in k ) ) )
+        if isinstance(k, np.ndarray) and k.ndim==2:
+            # already a design matrix, see prepare_feature_matrix
+            s.append(k)
+        else:
+            s.append(np.column_stack( tuple( np.ravel( j ) for j in k ) ) )
         print(s[-1].shape)
 
+    if len(s)==1:
+        return s[0]
     return np.vstack( tuple( i for i in s ) )
 
 
@@ -166,25 +275,25 @@ def pad_data(img, shape, partition, part, border):
 def merge_segmentations(inputs, output, partition, parameters):
     patch_size=parameters.get('patch_size',1)
     border=patch_size*2
-    out=None
-    strip=None
-    for i in range(len(inputs)):
-        d = minc2_file(inputs[i]).data
-        if out is None:
-            out = np.zeros(d.shape,dtype=np.int32)
-            strip = d.shape[2]/partition
-            
-        beg = strip*i
-        end = strip*(i+1)
-        
-        if i==(partition-1):
-            end=d.shape[2]
-            
-        out[:,:,beg:end]=d[:,:,beg:end]
-        
-    out_i = minc2_file()
-    out_i.imitate(inputs[0], path=output)
-    out_i.data = out
+
+    def _merge(z0, z1, slabs):
+        out = np.zeros(slabs[0].shape,dtype=np.int32)
+        strip = slabs[0].shape[2]//partition
+
+        for i in range(len(slabs)):
+            beg = strip*i
+            end = strip*(i+1)
+
+            if i==(partition-1):
+                end=slabs[0].shape[2]
+
+            out[:,:,beg:end]=slabs[i][:,:,beg:end]
+        return out
+
+    # only one slab of every part is kept in memory
+    voxel_map(inputs, output, _merge, datatype='int',
+              bytes_per_voxel=4*(len(inputs)+1),
+              data_type=minc2_file.MINC2_INT)
 
 
 def errorCorrectionTrain(input_images, 
@@ -276,7 +385,7 @@ def errorCorrectionTrain(input_images,
                     training_diff.append( diff ) 
                     training_direct.append( ground[ diff ] ) 
                 
-                training_images.append( prepare_features( 
+                training_images.append( prepare_feature_matrix( 
                                     features, 
                                     coords, 
                                     mask=mask,
@@ -285,7 +394,7 @@ def errorCorrectionTrain(input_images,
                                     patch_size=patch_size, 
                                     primary_features=primary_features ) )
                 
-                training_images_direct.append( prepare_features( 
+                training_images_direct.append( prepare_feature_matrix( 
                                     features, 
                                     coords, 
                                     mask=mask_diff,
@@ -303,7 +412,7 @@ def errorCorrectionTrain(input_images,
 
                 
             
-                training_images.append( prepare_features( 
+                training_images.append( prepare_feature_matrix( 
                                     features, 
                                     coords, 
                                     mask=mask,
@@ -313,11 +422,11 @@ def errorCorrectionTrain(input_images,
                                     primary_features=primary_features ) )
 
             if debug:
-                print("feature size:{}".format(len(training_images[-1])))
+                print("feature size:{}".format(training_images[-1].shape[1]))
             
             if i == 0 and parameters.get('dump',False):
                 print("Dumping feature images...")
-                for (j,k) in enumerate( training_images[-1] ):
+                for (j,k) in enumerate( training_images[-1].T ):
                     test=np.zeros_like( images[0] )
                     test[ mask>0 ]=k
                     out = minc2_file()
@@ -465,13 +574,10 @@ def errorCorrectionTrain(input_images,
             print("Warning : zero total mask size!, using null classifier")
             clf = dummy.DummyClassifier(strategy="constant",constant=0)
         
-        if method == 'xgb' and method2 == 'xgb':
-            #save
-            clf.save_model(output)
-            clf2.save_model(output+'_2')
-        else:
-            with open(output,'wb') as f:
-                pickle.dump( [clf, clf2] , f, -1)
+        save_model(output, clf, clf2, parameters,
+                   n_features=feature_number(len(input_images[0])-3,
+                                             use_coord=use_coord, use_joint=use_joint,
+                                             patch_size=patch_size, primary_features=primary_features))
     
     except mincError as e:
         print("Exception in linear_registration:{}".format(str(e)))
@@ -482,6 +588,82 @@ def errorCorrectionTrain(input_images,
         traceback.print_exc(file=sys.stdout)
         raise
 
+def _predict(clf, method, x):
+    if method!='xgb':
+        return np.asarray( clf.predict( x ), dtype=np.int32 )
+    else:
+        return np.array( clf.predict( xgb.DMatrix(x) ), dtype=np.int32 )
+
+
+def _blocks(shape, block_size):
+    for x in range(0, shape[0], block_size):
+        for y in range(0, shape[1], block_size):
+            for z in range(0, shape[2], block_size):
+                yield ( slice(x, min(x+block_size, shape[0])),
+                        slice(y, min(y+block_size, shape[1])),
+                        slice(z, min(z+block_size, shape[2])) )
+
+
+def apply_blocked(clf, clf2, features, coords, mask, out_corr, out_cls,
+                  method='lSVC', method2=None,
+                  use_coord=True, use_joint=True, patch_size=1, primary_features=1,
+                  block_size=32, threads=1, max_memory=None, out_dbg=None):
+    '''
+    run classifiers block by block, writing predictions into out_corr
+    (1st classifier) and out_cls (2nd classifier, if present)
+
+    The volume is tiled into cubes of block_size voxels, design matrix is
+    built only for masked voxels of one block at a time and blocks are
+    predicted by a pool of threads. Patch features are gathered from the
+    whole volume, so no halo has to be copied and the result is the same
+    as without blocking. Blocks with too many voxels are split further so
+    that design matrices of all threads fit into max_memory
+    '''
+    if method2 is None:
+        method2 = method
+    shape = features[0].shape
+    n_features = feature_number(len(features), use_coord=use_coord, use_joint=use_joint,
+                                patch_size=patch_size, primary_features=primary_features)
+    # design matrix and its subset for the 2nd classifier
+    rows = max(1, parse_size(max_memory if max_memory is not None else '512M') //
+                  (max(threads, 1) * n_features * 4 * 2))
+
+    def _block(sl):
+        origin = [s.start for s in sl]
+        if mask is not None:
+            idx = np.nonzero(mask[sl] > 0)
+        else:
+            idx = tuple(np.ravel(i) for i in np.indices(tuple(s.stop-s.start for s in sl)))
+        idx = tuple(i + o for (i, o) in zip(idx, origin))
+        for c in range(0, idx[0].size, rows):
+            _idx = tuple(i[c:c+rows] for i in idx)
+            x = prepare_feature_matrix(features, coords,
+                                       use_coord=use_coord, use_joint=use_joint,
+                                       patch_size=patch_size, primary_features=primary_features,
+                                       indices=_idx)
+            pred = _predict(clf, method, x)
+            out_corr[_idx] = pred
+            if out_dbg is not None:
+                out_dbg[0][_idx] = pred
+            if clf2 is not None:
+                sel = pred > 0
+                if np.any(sel):
+                    _idx2 = tuple(i[sel] for i in _idx)
+                    pred2 = _predict(clf2, method2, x[sel])
+                    out_cls[_idx2] = pred2
+                    if out_dbg is not None:
+                        out_dbg[1][_idx2] = pred2
+
+    blocks = list(_blocks(shape, block_size))
+    if threads > 1 and len(blocks) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            # blocks write into disjoint voxels
+            list(ex.map(_block, blocks))
+    else:
+        for sl in blocks:
+            _block(sl)
+
+
 def errorCorrectionApply(input_images, 
                          output, 
                          input_mask=None,
@@ -503,6 +685,11 @@ def errorCorrectionApply(input_images,
         method       =parameters.get('method','lSVC')
         method2      =parameters.get('method2',method)
 
+        # in-process blocked inference
+        block_size   =parameters.get('block_size',0)
+        block_threads=parameters.get('block_threads',int(os.environ.get('IPL_LOCAL_SLOTS',multiprocessing.cpu_count())))
+        block_memory =parameters.get('block_memory','512M')
+
         training=parameters['training']
         
         clf=None
@@ -516,17 +703,12 @@ def errorCorrectionApply(input_images,
         if debug: print( "Running error-correction, input_image:{} trining:{} partition:{} part:{} output:{} input_auto:{}".
                         format(repr(input_images), training, partition,part,output,input_auto) )
 
-        if method == 'xgb' and method2 == 'xgb':
-            # need to convert from Unicode
-            _training=str(training)
-            clf = xgb.Booster(model_file=_training)
-            if multilabel>1:
-                clf2 = xgb.Booster(model_file=_training+'_2')
-        else:
-            with open(training, 'rb') as f:
-                c    = pickle.load(f)
-                clf  = c[0]
-                clf2 = c[1]
+        # cached between calls, feature schema is checked
+        (clf, clf2) = load_model(training, parameters=parameters, multilabel=multilabel,
+                                 n_features=feature_number(len(input_images),
+                                                           use_coord=use_coord, use_joint=use_joint,
+                                                           patch_size=patch_size, primary_features=primary_features),
+                                 xgb_model=(method == 'xgb' and method2 == 'xgb'))
 
         if debug:
             print( clf  )
@@ -562,16 +744,6 @@ def errorCorrectionApply(input_images,
         out_cls  = None
         out_corr = None
 
-        test_x=convert_image_list ( [ prepare_features( 
-                                        features, 
-                                        coords,
-                                        mask=mask, 
-                                        use_coord=use_coord, 
-                                        use_joint=use_joint,
-                                        patch_size=patch_size, 
-                                        primary_features=primary_features ) 
-                                  ] )
-
         if input_auto is not None:
             out_corr = np.copy( extract_part( minc2_file( input_auto ).data, partition, part, border) ) # use input data
             out_cls  = np.copy( extract_part( minc2_file( input_auto ).data, partition, part, border) ) # use input data
@@ -579,9 +751,44 @@ def errorCorrectionApply(input_images,
             out_corr = np.zeros( shape, dtype=np.int32 )
             out_cls  = np.zeros( shape, dtype=np.int32 )
 
-        if mask_size>0 and not isinstance(clf, dummy.DummyClassifier):
+        if mask_size>0 and not isinstance(clf, dummy.DummyClassifier) and block_size>0:
+            if debug:
+                print("Running classifiers in blocks of {} voxels, {} threads ...".format(block_size, block_threads))
+
+            out_dbg = None
+            if debug_files is not None:
+                out_dbg = [ np.zeros( out_corr.shape, dtype=np.int32 ), np.zeros( out_corr.shape, dtype=np.int32 ) ]
+
+            if not ( multilabel > 1 and clf2 is not None ):
+                out_cls = out_corr
+
+            apply_blocked(clf, clf2 if multilabel > 1 else None,
+                          features, coords, mask, out_corr, out_cls,
+                          method=method, method2=method2,
+                          use_coord=use_coord, use_joint=use_joint,
+                          patch_size=patch_size, primary_features=primary_features,
+                          block_size=block_size, threads=block_threads,
+                          max_memory=block_memory, out_dbg=out_dbg)
+
+            if debug_files is not None:
+                for (k, d) in enumerate(out_dbg if multilabel > 1 and clf2 is not None else out_dbg[0:1]):
+                    out_dbg_m = minc2_file()
+                    out_dbg_m.imitate(input_images[0], path=debug_files[k])
+                    out_dbg_m.data = pad_data(d, shape, partition, part, border)
+
+        elif mask_size>0 and not isinstance(clf, dummy.DummyClassifier):
             if debug:
                 print("Running classifier 1 ...")
+
+            test_x=convert_image_list ( [ prepare_feature_matrix( 
+                                            features, 
+                                            coords,
+                                            mask=mask, 
+                                            use_coord=use_coord, 
+                                            use_joint=use_joint,
+                                            patch_size=patch_size, 
+                                            primary_features=primary_features ) 
+                                      ] )
             
             if method!='xgb':
                 pred = np.asarray( clf.predict( test_x ), dtype=np.int32 ) 
@@ -614,7 +821,7 @@ def errorCorrectionApply(input_images,
                 if debug:
                     print("Running classifier 2 ...")
 
-                test_x = convert_image_list ( [ prepare_features( 
+                test_x = convert_image_list ( [ prepare_feature_matrix( 
                                                 features, 
                                                 coords,
                                                 mask=mask , 
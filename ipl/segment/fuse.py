@@ -14,8 +14,11 @@ import json
 import traceback
 
 import yaml
+import numpy as np
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl import numpy_backend
+from ipl.workflow import run_forced, rerun_forced
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -26,12 +29,68 @@ from .registration     import *
 from .resample         import *
 from .error_correction import *
 from .preselect        import *
+from .library_index    import load_library_index
 from .qc               import *
 from .fuse_segmentations import *
 from .library          import *
 from .analysis         import *
 
 
+def progressive_warp(warp, atlases, segs, classes_number,
+                     minimum=3, maximum=None, step=2, threshold=0.005):
+    """
+    Warp atlases in increments, until voxel-wise majority vote converges
+    
+    warp           -- function warp(first,last), producing label volumes of
+                      atlases first..last-1
+    atlases        -- number of available atlases, in preselection order
+    segs           -- lists of label volumes, one list per side
+    minimum        -- minimal number of atlases
+    maximum        -- maximal number of atlases, default all
+    step           -- number of atlases added at each increment
+    threshold      -- stop when fraction of labelled voxels changing label
+                      is below threshold
+    
+    returns number of used atlases and convergence curve, list of
+    {'atlases':n, 'changed':fraction}
+    """
+    if not numpy_backend.have_numpy_backend:
+        raise numpy_backend.Unsupported('minc2_simple or numpy is not available')
+    if maximum is None or maximum > atlases:
+        maximum = atlases
+    votes = [None for i in segs]
+    prev = [None for i in segs]
+    curve = []
+    done = 0
+    n = max(1, min(minimum, maximum))
+    while True:
+        warp(done, n)
+        changed = None
+        for (k, lst) in enumerate(segs):
+            for i in range(done, min(n, len(lst))):
+                (lbl, f) = numpy_backend.load(lst[i], data_type=numpy_backend.minc2_file.MINC2_INT)
+                f.close()
+                lbl = lbl.ravel()
+                valid = np.flatnonzero((lbl >= 0) & (lbl < classes_number))
+                if votes[k] is None:
+                    votes[k] = np.zeros((classes_number, lbl.size), dtype=np.int16)
+                # each voxel is counted once per atlas
+                votes[k][lbl[valid], valid] += 1
+            cur = np.argmax(votes[k], axis=0)
+            if prev[k] is not None:
+                fg = (cur > 0) | (prev[k] > 0)
+                _changed = float(np.count_nonzero((cur != prev[k]) & fg)) / max(np.count_nonzero(fg), 1)
+                changed = _changed if changed is None else max(changed, _changed)
+            prev[k] = cur
+        curve.append({'atlases': n, 'changed': changed})
+        print("Progressive fusion: {} atlases, changed {}".format(n, changed))
+        done = n
+        if n >= maximum or (changed is not None and changed < threshold):
+            break
+        n = min(n + step, maximum)
+    return (done, curve)
+
+
 def fusion_segment( input_scan,
                     library_description,
                     output_segment,
@@ -47,8 +106,13 @@ def fusion_segment( input_scan,
                     cleanup = False,
                     cleanup_xfm = False,
                     presegment = None,
-                    preprocess_only = False):
-    """Apply fusion segmentation"""
+                    preprocess_only = False,
+                    register_only = False):
+    """Apply fusion segmentation
+    
+    preprocess_only -- stop after linear registration to the local model
+    register_only   -- stop after nonlinear registration to the local model
+    """
     try:
         if debug: 
             print( "Segmentation parameters:")
@@ -164,6 +228,18 @@ def fusion_segment( input_scan,
         library_preselect=        parameters.get('library_preselect', 10)
         library_preselect_step=   parameters.get('library_preselect_step', None)
         library_preselect_method= parameters.get('library_preselect_method', 'MI')
+        # opt-in: compares images as they are (32 bin NMI or CC), without rigid 
+        # adjustment done by minctracc, so selected atlases could differ
+        library_preselect_in_memory= parameters.get('library_preselect_in_memory', False)
+        # number of candidates selected with library index, before exact preselection
+        # opt-in, approximate: i.e 5*library_preselect, 0 - compare with all entries
+        library_preselect_shortlist= parameters.get('library_preselect_shortlist', 0)
+        # progressive mode: add preselected atlases until majority vote stops changing
+        library_progressive=          parameters.get('library_progressive', False)
+        library_progressive_min=      parameters.get('library_progressive_min', 3)
+        library_progressive_max=      parameters.get('library_progressive_max', None)
+        library_progressive_step=     parameters.get('library_progressive_step', 2)
+        library_progressive_threshold=parameters.get('library_progressive_threshold', 0.005)
         
 
         # if non-linear registraiton should be performed with ANTS
@@ -178,6 +254,9 @@ def fusion_segment( input_scan,
             if do_nonlinear_register_ants: 
                 nonlinear_register_type='ants'
 
+        # directory of registrations shared between experiments (i.e cross-validation folds)
+        registration_store =  parameters.get('registration_store', None)
+
         pairwise_level     =  parameters.get('pairwise_level', 2)
         pairwise_start     =  parameters.get('pairwise_start', 16)
         pairwise_options   =  parameters.get('pairwise_options', None)
@@ -325,7 +404,8 @@ def fusion_segment( input_scan,
                                     linreg=inital_reg_options,
                                     ants=True,
                                     use_mask=inital_reg_use_mask,
-                                    downsample=inital_reg_downsample
+                                    downsample=inital_reg_downsample,
+                                    store=registration_store
                                     )
             else:
                 linear_registration(sample,
@@ -335,7 +415,8 @@ def fusion_segment( input_scan,
                                     linreg=inital_reg_options,
                                     downsample=inital_reg_downsample,
                                     use_mask=inital_reg_use_mask,
-                                    objective=initial_reg_objective
+                                    objective=initial_reg_objective,
+                                    store=registration_store
                                     )
             
             output_info['initial_xfm']=initial_xfm
@@ -376,7 +457,8 @@ def fusion_segment( input_scan,
                     close=True,
                     bbox=local_reg_bbox,
                     use_mask=local_reg_use_mask,
-                    downsample=local_reg_downsample
+                    downsample=local_reg_downsample,
+                    store=registration_store
                     )
             else:
                 linear_registration( sample, 
@@ -391,7 +473,8 @@ def fusion_segment( input_scan,
                     bbox=local_reg_bbox,
                     use_mask=local_reg_use_mask,
                     objective=local_reg_objective,
-                    downsample=local_reg_downsample )
+                    downsample=local_reg_downsample,
+                    store=registration_store )
 
         else: 
             bbox_linear_xfm=initial_xfm
@@ -465,7 +548,8 @@ def fusion_segment( input_scan,
                     start_level=nlreg_start,
                     parameters=nlreg_options,
                     ants=True,
-                    downsample=nlreg_downsample )
+                    downsample=nlreg_downsample,
+                    store=registration_store )
             else:
                 non_linear_registration( bbox_sample, local_model,
                     nonlinear_xfm,
@@ -474,7 +558,8 @@ def fusion_segment( input_scan,
                     start_level=nlreg_start,
                     parameters=nlreg_options,
                     ants=False,
-                    downsample=nlreg_downsample )
+                    downsample=nlreg_downsample,
+                    store=registration_store )
 
             print("\n\n\nWarping the sample!:{}\n\n\n".format(bbox_sample))
             nl_sample.seg=None
@@ -506,6 +591,9 @@ def fusion_segment( input_scan,
             bbox_sample.mask_f = local_model.mask
             
         output_info['nonlinear_xfm'] = nonlinear_xfm
+        
+        if register_only:
+            return (None,output_info)
 
         if generate_library:
             # remove excluded samples TODO: use regular expressions for matching?
@@ -518,21 +606,25 @@ def fusion_segment( input_scan,
             # library pre-selection if needed
             # TODO: skip if sample presegmented
             if library_preselect>0 and library_preselect < len(selected_library):
+                library_index = None
+                if library_preselect_shortlist>0 and library_description.get('prefix',None) is not None:
+                    library_index = load_library_index(library_description.get('prefix'))
                 loaded = False
                 loaded_f = False
                 
+                # entries paths are relative to the library
                 if os.path.exists(work_lib_dir + os.sep + 'sel_library.yaml'):
                     with open(work_lib_dir + os.sep + 'sel_library.yaml', 'r') as f:
                         selected_library = yaml.safe_load(f)
                     for i in selected_library:
-                        i.prefix = work_lib_dir
+                        i.prefix = library[0].prefix
                     loaded = True
 
-                if segment_symmetric and os.path.exists(work_lib_dir_f + os.sep + 'sel_library_f.yaml'):
+                if segment_symmetric and os.path.exists(work_lib_dir + os.sep + 'sel_library_f.yaml'):
                     with open(work_lib_dir + os.sep + 'sel_library_f.yaml', 'r') as f:
                         selected_library_f= yaml.safe_load(f)
                     for i in selected_library_f:
-                        i.prefix = work_lib_dir_f
+                        i.prefix = library[0].prefix
                     loaded_f = True
                 
                 if do_nonlinear_register:
@@ -543,6 +635,9 @@ def fusion_segment( input_scan,
                                             number=library_preselect,
                                             use_nl=library_nl_samples_avail,
                                             step=library_preselect_step,
+                                            in_memory=library_preselect_in_memory,
+                                            index=library_index,
+                                            shortlist=library_preselect_shortlist,
                                             lib_add_n=library_modalities) 
                     if segment_symmetric:
                         if not loaded_f:
@@ -553,6 +648,9 @@ def fusion_segment( input_scan,
                                                     use_nl=library_nl_samples_avail,
                                                     flip=True,
                                                     step=library_preselect_step,
+                                                    in_memory=library_preselect_in_memory,
+                                                    index=library_index,
+                                                    shortlist=library_preselect_shortlist,
                                                     lib_add_n=library_modalities)
                 else:
                     if not loaded:
@@ -562,6 +660,9 @@ def fusion_segment( input_scan,
                                             number=library_preselect,
                                             use_nl=False,
                                             step=library_preselect_step,
+                                            in_memory=library_preselect_in_memory,
+                                            index=library_index,
+                                            shortlist=library_preselect_shortlist,
                                             lib_add_n=library_modalities)
                     if segment_symmetric:
                         if not loaded_f:
@@ -571,6 +672,9 @@ def fusion_segment( input_scan,
                                                     number=library_preselect,
                                                     use_nl=False,flip=True,
                                                     step=library_preselect_step,
+                                                    in_memory=library_preselect_in_memory,
+                                                    index=library_index,
+                                                    shortlist=library_preselect_shortlist,
                                                     lib_add_n=library_modalities)
 
                 if not loaded:
@@ -629,153 +733,186 @@ def fusion_segment( input_scan,
                     output_info['selected_library_xfm_f']=selected_library_xfm_f
 
             # nonlinear registration to template or individual
-       
-            if do_pairwise: # Right now ignore precomputed transformations
-                results=[]
-                if debug:
-                    print("Performing pairwise registration")
+            def _warp_library(first, last):
+                """register (or resample) library entries first..last-1 to the sample"""
+                if do_pairwise: # Right now ignore precomputed transformations
+                    results=[]
+                    if debug:
+                        print("Performing pairwise registration")
                 
-                for (i,j) in enumerate(selected_library):
-                    # TODO: make clever usage of precomputed transform if available
-                    if pairwise_register_type=='elx' or pairwise_register_type=='elastix' :
-                        results.append( futures.submit(
-                            elastix_registration, 
-                            bbox_sample,
-                            selected_library_scan[i],
-                            selected_library_xfm2[i],
-                            level=pairwise_level,
-                            start_level=pairwise_start,
-                            parameters=pairwise_options,  
-                            nl=True,
-                            output_inv_target=selected_library_warped2[i],
-                            warp_seg=True,
-                            resample_order=resample_order,
-                            resample_baa=resample_baa
-                            ) )
-                    elif pairwise_register_type=='ants' or do_pairwise_ants:
-                        results.append( futures.submit(
-                            non_linear_registration, 
-                            bbox_sample,
-                            selected_library_scan[i],
-                            selected_library_xfm2[i],
-                            level=pairwise_level,
-                            start_level=pairwise_start,
-                            parameters=pairwise_options,  
-                            ants=True,
-                            output_inv_target=selected_library_warped2[i],
-                            warp_seg=True,
-                            resample_order=resample_order,
-                            resample_baa=resample_baa
-                            ) )
-                    else:
-                        results.append( futures.submit(
-                            non_linear_registration, 
-                            bbox_sample,
-                            selected_library_scan[i],
-                            selected_library_xfm2[i],
-                            level=pairwise_level,
-                            start_level=pairwise_start,
-                            parameters=pairwise_options,  
-                            ants=False,
-                            output_inv_target=selected_library_warped2[i],
-                            warp_seg=True,
-                            resample_order=resample_order,
-                            resample_baa=resample_baa
-                            ) )
-                        
-                
-                if segment_symmetric:
-                    for (i,j) in enumerate(selected_library_f):
+                    for i in range(first, min(last, len(selected_library))):
                         # TODO: make clever usage of precomputed transform if available
-                        
-                        if pairwise_register_type == 'elx' or pairwise_register_type == 'elastix':
-                            results.append( futures.submit(
+                        if pairwise_register_type=='elx' or pairwise_register_type=='elastix' :
+                            results.append( futures.submit(run_forced, rerun_forced(),
                                 elastix_registration, 
                                 bbox_sample,
-                                selected_library_scan_f[i],
-                                selected_library_xfm2_f[i],
+                                selected_library_scan[i],
+                                selected_library_xfm2[i],
                                 level=pairwise_level,
                                 start_level=pairwise_start,
                                 parameters=pairwise_options,  
                                 nl=True,
-                                output_inv_target=selected_library_warped2_f[i],
+                                output_inv_target=selected_library_warped2[i],
                                 warp_seg=True,
-                                flip=True,
                                 resample_order=resample_order,
                                 resample_baa=resample_baa
                                 ) )
                         elif pairwise_register_type=='ants' or do_pairwise_ants:
-                            results.append( futures.submit(
+                            results.append( futures.submit(run_forced, rerun_forced(),
                                 non_linear_registration, 
                                 bbox_sample,
-                                selected_library_scan_f[i],
-                                selected_library_xfm2_f[i],
+                                selected_library_scan[i],
+                                selected_library_xfm2[i],
                                 level=pairwise_level,
                                 start_level=pairwise_start,
                                 parameters=pairwise_options,  
                                 ants=True,
-                                output_inv_target=selected_library_warped2_f[i],
+                                output_inv_target=selected_library_warped2[i],
                                 warp_seg=True,
-                                flip=True,
                                 resample_order=resample_order,
-                                resample_baa=resample_baa
+                                resample_baa=resample_baa,
+                                store=registration_store
                                 ) )
                         else:
-                            results.append( futures.submit(
+                            results.append( futures.submit(run_forced, rerun_forced(),
                                 non_linear_registration, 
                                 bbox_sample,
-                                selected_library_scan_f[i],
-                                selected_library_xfm2_f[i],
+                                selected_library_scan[i],
+                                selected_library_xfm2[i],
                                 level=pairwise_level,
                                 start_level=pairwise_start,
                                 parameters=pairwise_options,  
                                 ants=False,
-                                output_inv_target=selected_library_warped2_f[i],
+                                output_inv_target=selected_library_warped2[i],
                                 warp_seg=True,
-                                flip=True,
                                 resample_order=resample_order,
-                                resample_baa=resample_baa
+                                resample_baa=resample_baa,
+                                store=registration_store
                                 ) )
-                # TODO: do we really need to wait for result here?
-                futures.wait(results, return_when=futures.ALL_COMPLETED)
-            else: # use precomputer transformations
+                        
                 
-                results=[]
+                    if segment_symmetric:
+                        for i in range(first, min(last, len(selected_library_f))):
+                            # TODO: make clever usage of precomputed transform if available
+                        
+                            if pairwise_register_type == 'elx' or pairwise_register_type == 'elastix':
+                                results.append( futures.submit(run_forced, rerun_forced(),
+                                    elastix_registration, 
+                                    bbox_sample,
+                                    selected_library_scan_f[i],
+                                    selected_library_xfm2_f[i],
+                                    level=pairwise_level,
+                                    start_level=pairwise_start,
+                                    parameters=pairwise_options,  
+                                    nl=True,
+                                    output_inv_target=selected_library_warped2_f[i],
+                                    warp_seg=True,
+                                    flip=True,
+                                    resample_order=resample_order,
+                                    resample_baa=resample_baa
+                                    ) )
+                            elif pairwise_register_type=='ants' or do_pairwise_ants:
+                                results.append( futures.submit(run_forced, rerun_forced(),
+                                    non_linear_registration, 
+                                    bbox_sample,
+                                    selected_library_scan_f[i],
+                                    selected_library_xfm2_f[i],
+                                    level=pairwise_level,
+                                    start_level=pairwise_start,
+                                    parameters=pairwise_options,  
+                                    ants=True,
+                                    output_inv_target=selected_library_warped2_f[i],
+                                    warp_seg=True,
+                                    flip=True,
+                                    resample_order=resample_order,
+                                    resample_baa=resample_baa,
+                                    store=registration_store
+                                    ) )
+                            else:
+                                results.append( futures.submit(run_forced, rerun_forced(),
+                                    non_linear_registration, 
+                                    bbox_sample,
+                                    selected_library_scan_f[i],
+                                    selected_library_xfm2_f[i],
+                                    level=pairwise_level,
+                                    start_level=pairwise_start,
+                                    parameters=pairwise_options,  
+                                    ants=False,
+                                    output_inv_target=selected_library_warped2_f[i],
+                                    warp_seg=True,
+                                    flip=True,
+                                    resample_order=resample_order,
+                                    resample_baa=resample_baa,
+                                    store=registration_store
+                                    ) )
+                    # TODO: do we really need to wait for result here?
+                    futures.wait(results, return_when=futures.ALL_COMPLETED)
+                else: # use precomputer transformations
                 
-                for (i, j) in enumerate(selected_library):
+                    results=[]
+                
+                    for i in range(first, min(last, len(selected_library))):
                     
-                    lib_xfm=None
-                    if library_nl_samples_avail:
-                        lib_xfm=selected_library_xfm[i]
-                        
-                    results.append( futures.submit( 
-                        concat_resample,
-                        selected_library_scan[i],
-                        lib_xfm ,
-                        nonlinear_xfm,
-                        selected_library_warped2[i],
-                        resample_order=resample_order,
-                        resample_baa=resample_baa
-                        ) )
-                        
-                if segment_symmetric:
-                    for (i, j) in enumerate(selected_library_f):
                         lib_xfm=None
                         if library_nl_samples_avail:
-                            lib_xfm=selected_library_xfm_f[i]
-
-                        results.append( futures.submit(
+                            lib_xfm=selected_library_xfm[i]
+                        
+                        results.append( futures.submit(run_forced, rerun_forced(),
                             concat_resample,
-                            selected_library_scan_f[i],
-                            lib_xfm,
+                            selected_library_scan[i],
+                            lib_xfm ,
                             nonlinear_xfm,
-                            selected_library_warped2_f[i],
+                            selected_library_warped2[i],
                             resample_order=resample_order,
-                            resample_baa=resample_baa,
-                            flip=True
+                            resample_baa=resample_baa
                             ) )
-                # TODO: do we really need to wait for result here?
-                futures.wait(results, return_when=futures.ALL_COMPLETED)
+                        
+                    if segment_symmetric:
+                        for i in range(first, min(last, len(selected_library_f))):
+                            lib_xfm=None
+                            if library_nl_samples_avail:
+                                lib_xfm=selected_library_xfm_f[i]
+
+                            results.append( futures.submit(run_forced, rerun_forced(),
+                                concat_resample,
+                                selected_library_scan_f[i],
+                                lib_xfm,
+                                nonlinear_xfm,
+                                selected_library_warped2_f[i],
+                                resample_order=resample_order,
+                                resample_baa=resample_baa,
+                                flip=True
+                                ) )
+                    # TODO: do we really need to wait for result here?
+                    futures.wait(results, return_when=futures.ALL_COMPLETED)
+
+            if library_progressive and len(selected_library)>0:
+                # add atlases in preselection order, until the labels converge
+                segs=[[ i.seg for i in selected_library_warped2 ]]
+                if segment_symmetric:
+                    segs.append([ i.seg for i in selected_library_warped2_f ])
+                try:
+                    (atlas_count, convergence) = progressive_warp(_warp_library,
+                                                    max(len(selected_library), len(selected_library_f)),
+                                                    segs, classes_number,
+                                                    minimum=library_progressive_min,
+                                                    maximum=library_progressive_max,
+                                                    step=library_progressive_step,
+                                                    threshold=library_progressive_threshold)
+                    # keep only used atlases, lists are shared with output_info
+                    for l in (selected_library, selected_library_scan, selected_library_warped2,
+                              selected_library_xfm2, selected_library_xfm,
+                              selected_library_f, selected_library_scan_f, selected_library_warped2_f,
+                              selected_library_xfm2_f, selected_library_xfm_f):
+                        del l[atlas_count:]
+                    output_info['atlas_convergence'] = convergence
+                except numpy_backend.Unsupported as e:
+                    print("Progressive fusion is not available:{}, using all atlases".format(str(e)))
+                    _warp_library(0, max(len(selected_library), len(selected_library_f)))
+            else:
+                _warp_library(0, max(len(selected_library), len(selected_library_f)))
+
+            output_info['atlas_count'] = len(selected_library)
         else: # no library generated
             selected_library=[]
             selected_library_f=[]
@@ -790,7 +927,7 @@ def fusion_segment( input_scan,
 
         print(local_model        )
 
-        results.append(futures.submit(
+        results.append(futures.submit(run_forced, rerun_forced(),
             fuse_segmentations,
             bbox_sample,
             sample_seg,
@@ -808,7 +945,7 @@ def fusion_segment( input_scan,
             ))
 
         if segment_symmetric:
-            results.append( futures.submit(
+            results.append( futures.submit(run_forced, rerun_forced(),
                 fuse_segmentations,
                 bbox_sample,
                 sample_seg,
@@ -915,4 +1052,126 @@ def fusion_segment( input_scan,
         traceback.print_exc(file=sys.stdout)
         raise
 
+
+def load_subjects_csv(input_csv):
+    """read list of subjects: id,scan[,mask[,additional modalities...]]"""
+    subjects=[]
+    with open(input_csv, 'r') as f:
+        for l in csv.reader(f):
+            if not l or l[0].startswith('#'):
+                continue
+            subjects.append({'id':   l[0],
+                             'scan': l[1],
+                             'mask': l[2] if len(l)>2 and l[2] else None,
+                             'add':  l[3:]})
+    return subjects
+
+
+def fusion_segment_batch( subjects,
+                          library_description,
+                          output,
+                          parameters = {},
+                          debug = False,
+                          ec_variant = None,
+                          fuse_variant = None,
+                          regularize_variant = None,
+                          cleanup = False,
+                          cleanup_xfm = False):
+    """Apply fusion segmentation to a cohort of subjects
+    
+    subjects -- list of dicts with 'id', 'scan', 'mask' and 'add' (see load_subjects_csv)
+    output   -- output directory, results of each subject are stored in <output>/<id>/
+    
+    All registrations to the model and local model are performed as one parallel wave,
+    library preselection for all subjects is calculated in one pass, 
+    then segmentations of all subjects are scheduled together.
+    
+    returns list of (output segmentation, output_info)
+    """
+    try:
+        segment_symmetric        = parameters.get('segment_symmetric', False )
+        do_nonlinear_register    = parameters.get('non_linear_register', False )
+        library_preselect        = parameters.get('library_preselect', 10)
+        library_preselect_step   = parameters.get('library_preselect_step', None)
+        library_preselect_method = parameters.get('library_preselect_method', 'MI')
+        library_preselect_in_memory= parameters.get('library_preselect_in_memory', False)
+        
+        library_nl_samples_avail = library_description['nl_samples_avail']
+        library_modalities       = library_description.get('modalities',1)-1
+        library                  = library_description["library"]
+        
+        def _args(s):
+            prefix=output+os.sep+s['id']
+            return ( [s['scan'], library_description, prefix+os.sep+s['id']],
+                     {'input_mask': s.get('mask', None),
+                      'add':        s.get('add', []),
+                      'parameters': parameters,
+                      'work_dir':   prefix+os.sep+'work_segment',
+                      'debug':      debug,
+                      'ec_variant': ec_variant,
+                      'fuse_variant': fuse_variant,
+                      'regularize_variant': regularize_variant } )
+        
+        for s in subjects:
+            if not os.path.exists(output+os.sep+s['id']):
+                os.makedirs(output+os.sep+s['id'])
+        
+        # 1. registration of all subjects to the model and local model
+        results=[]
+        for s in subjects:
+            (args, kwargs)=_args(s)
+            results.append( futures.submit(run_forced, rerun_forced(), fusion_segment, *args, register_only=True, **kwargs ) )
+        futures.wait(results, return_when=futures.ALL_COMPLETED)
+        registered=[ r.result()[1] for r in results ]
+        
+        # 2. library preselection for all subjects at once
+        if library_preselect_in_memory and library_preselect>0 and library_preselect < len(library):
+            column=0
+            if do_nonlinear_register and library_nl_samples_avail:
+                column=4+library_modalities
+            
+            samples=[ i['nl_sample'] if do_nonlinear_register else i['bbox_sample'] for i in registered ]
+            variants=[('sel_library.yaml', [ i.scan for i in samples ])]
+            if segment_symmetric:
+                variants.append(('sel_library_f.yaml', [ i.scan_f for i in samples ]))
+            try:
+                lib_ids=[ i.ent_id for i in library ]
+                for (name, scans) in variants:
+                    cost=similarity_matrix(scans, [ j[column] for j in library ], 
+                                           method=library_preselect_method,
+                                           step=library_preselect_step)
+                    with open(output+os.sep+name.rsplit('.',1)[0]+'_cost.csv', 'w') as f:
+                        w=csv.writer(f)
+                        w.writerow(['id']+lib_ids)
+                        for (i, s) in enumerate(subjects):
+                            w.writerow([s['id']]+list(cost[i,:]))
+                    
+                    for (i, s) in enumerate(subjects):
+                        work_lib_dir=_args(s)[1]['work_dir']+os.sep+'library'
+                        if not os.path.exists(work_lib_dir):
+                            os.makedirs(work_lib_dir)
+                        order=np.argsort(cost[i,:], kind='stable')[0:library_preselect]
+                        with open(work_lib_dir + os.sep + name, 'w') as f:
+                            f.write( yaml.dump( [ library[j] for j in order ] ) )
+            except numpy_backend.Unsupported as e:
+                print("Preselecting library for each subject separately:{}".format(str(e)))
+        
+        # 3. segmentation of all subjects, sharing the same pool
+        results=[]
+        for s in subjects:
+            (args, kwargs)=_args(s)
+            results.append( futures.submit(run_forced, rerun_forced(), fusion_segment, *args, 
+                                            cleanup=cleanup, cleanup_xfm=cleanup_xfm, **kwargs ) )
+        futures.wait(results, return_when=futures.ALL_COMPLETED)
+        return [ r.result() for r in results ]
+    
+    except mincError as e:
+        print("Exception in fusion_segment_batch:{}".format(str(e)))
+        traceback.print_exc(file=sys.stdout )
+        raise
+    except :
+        print("Exception in fusion_segment_batch:{}".format(sys.exc_info()[0]))
+        traceback.print_exc(file=sys.stdout)
+        raise
+
 # kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
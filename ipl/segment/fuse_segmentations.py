@@ -15,6 +15,9 @@ import json
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
 import ipl.minc_hl as hl
+from ipl.stream import label_fusion, correlation
+from ipl.stream import have_minc2_simple as have_stream
+from ipl.workflow import run_forced, rerun_forced
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -97,6 +100,8 @@ def fuse_segmentations( sample, output, library,
                     gco_diagonal=False
                     label_norm=None
                     ext_tool=None
+                    native=False
+                    vote_weights=None
                     
                     if fuse_options is not None:
                         # get parameters
@@ -110,6 +115,12 @@ def fuse_segmentations( sample, output, library,
                         beta         = fuse_options.get('beta',            None)
                         new_prog     = fuse_options.get('new',             True)
                         ext_tool     = fuse_options.get('ext',             None)
+                        # opt-in in-process majority voting, and weighting of votes:
+                        # None or 'cc' - correlation with the sample
+                        # with gco, energy uses raw vote fractions instead of 
+                        # probabilities smoothed by split_labels
+                        native       = fuse_options.get('native',          False)
+                        vote_weights = fuse_options.get('vote_weights',    None)
 
                         # graph-cut based segmentation
                         gco_optimize = fuse_options.get('gco',             False)
@@ -123,10 +134,13 @@ def fuse_segmentations( sample, output, library,
                     if label_norm is not None:
                         print("Using label_norm:{}".format(repr(label_norm)))
                         # need to create rough labeling  and average
-                        segs=['multiple_volume_similarity']
-                        segs.extend([ i.seg for i in library ])
-                        segs.extend(['--majority', m.tmp('maj_seg.mnc'), '--bg'] )
-                        m.execute(segs)
+                        if native and have_stream:
+                            label_fusion([ i.seg for i in library ], m.tmp('maj_seg.mnc'), classes_number)
+                        else:
+                            segs=['multiple_volume_similarity']
+                            segs.extend([ i.seg for i in library ])
+                            segs.extend(['--majority', m.tmp('maj_seg.mnc'), '--bg'] )
+                            m.execute(segs)
                         
                         scans=[ i.scan for i in library ]
                         m.median(scans,m.tmp('median.mnc'))
@@ -155,14 +169,21 @@ def fuse_segmentations( sample, output, library,
                         pass #TODO: finish this
                     elif patch==0 and search==0: # perform simple majority voting
                         # create majority voted model segmentation, for ANIMAL segmentation if needed
-                        segs=['multiple_volume_similarity']
-                        segs.extend([ i.seg for i in library ])
-                        segs.extend(['--majority', out_seg_fuse, '--bg'] )
-                        m.execute(segs)
-                        
-                        #TODO:Output fake probs ?
+                        if native and have_stream:
+                            weights=None
+                            if vote_weights=='cc':
+                                weights=[ max(i,0.0) for i in correlation(scan, [ i.scan for i in library ], mask=sample.mask) ]
+                                output_info['vote_weights']=weights
+                            # probabilities are produced in the same pass
+                            label_fusion([ i.seg for i in library ], out_seg_fuse, classes_number,
+                                         prob_base=out_prob_base, weights=weights)
+                        else:
+                            segs=['multiple_volume_similarity']
+                            segs.extend([ i.seg for i in library ])
+                            segs.extend(['--majority', out_seg_fuse, '--bg'] )
+                            m.execute(segs)
                         
-                        if gco_energy is not None and gco_optimize:
+                        if gco_energy is not None and gco_optimize and not (native and have_stream):
                             # todo place this into parameters
                             split_labels( out_seg_fuse,
                                         classes_number,
@@ -356,7 +377,7 @@ def fuse_segmentations( sample, output, library,
                                 out_seg_ec_errors2  = work_dir+os.sep+dataset_name+'_'+fuse_variant+'_'+regularize_variant+'_'+ec_variant+'_error2_'+str(s)+'.mnc'
                             
                             parts.append(out)
-                            results.append( futures.submit(
+                            results.append( futures.submit(run_forced, rerun_forced(),
                                 errorCorrectionApply, 
                                                      ec_input, out, 
                                                      input_mask=train_mask, 
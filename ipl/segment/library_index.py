@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Embedding index of the segmentation library, for fast atlas preselection
+
+import os
+import sys
+import traceback
+
+try:
+    import numpy as np
+except ImportError:
+    pass
+
+try:
+    from sklearn.neighbors import KDTree
+    have_kdtree = True
+except ImportError:
+    have_kdtree = False
+
+from ipl import numpy_backend
+from .preselect import load_downsampled
+
+# name of index file, next to library.yaml
+index_name = 'library_index.npz'
+
+# memoized indexes, keyed by path
+_indexes = {}
+
+
+def _columns(library):
+    """library columns used for preselection: linear and, if available,
+    nonlinearly registered scans (same as in preselect)"""
+    columns = [0]
+    if library.get('nl_samples_avail', False):
+        columns.append(4 + library.get('modalities', 1) - 1)
+    return columns
+
+
+class LibraryIndex(object):
+    """
+    PCA embedding of library scans inside local_model_mask,
+    with a nearest neighbour index over PCA coefficients
+    """
+
+    def __init__(self, factor=2, components=32):
+        self.factor = factor
+        self.components = components
+        self.keys = []      # lst[0] of each library entry
+        self.shape = None   # shape of downsampled volumes
+        self.mask = None    # voxel selection, flattened
+        self.mean = {}      # per column: mean of masked voxels
+        self.basis = {}     # per column: PCA components (k,V)
+        self.coef = {}      # per column: embedding of each entry (N,k)
+        self._trees = {}
+
+    def _masked(self, scan):
+        vol = load_downsampled(scan, self.factor)
+        if vol.shape != self.shape:
+            raise numpy_backend.Unsupported('{} does not match library index sampling'.format(scan))
+        return vol.ravel()[self.mask]
+
+    def _load_mask(self, mask):
+        if mask is not None:
+            sel = load_downsampled(mask, self.factor) > 0.5
+        else:
+            sel = np.ones(self.shape, dtype=bool)
+        self.shape = sel.shape
+        self.mask = np.flatnonzero(sel)
+
+    def build(self, library, mask=None):
+        """calculate embedding of all library entries"""
+        entries = list(library['library'])
+        self.keys = [e.lst[0] for e in entries]
+        self.shape = load_downsampled(entries[0][0], self.factor).shape
+        self._load_mask(mask)
+        self.mean = {}
+        self.basis = {}
+        self.coef = {}
+        for c in _columns(library):
+            data = np.empty((len(entries), self.mask.size), dtype=np.float32)
+            for (i, e) in enumerate(entries):
+                data[i, :] = self._masked(e[c])
+            mean = data.mean(axis=0)
+            data -= mean
+            # PCA through SVD of the (entries x voxels) matrix
+            (u, s, vt) = np.linalg.svd(data, full_matrices=False)
+            k = min(self.components, vt.shape[0])
+            self.mean[c] = mean
+            self.basis[c] = vt[0:k, :].astype(np.float32)
+            self.coef[c] = (u[:, 0:k] * s[0:k]).astype(np.float32)
+        self._trees = {}
+
+    def update(self, library):
+        """add embedding of new library entries and remove missing ones,
+        PCA basis is not recalculated"""
+        entries = list(library['library'])
+        keys = [e.lst[0] for e in entries]
+        known = {k: i for (i, k) in enumerate(self.keys)}
+        new = [e for (e, k) in zip(entries, keys) if k not in known]
+        keep = [known[k] for k in keys if k in known]
+        for c in list(self.coef.keys()):
+            coef = self.coef[c][keep, :]
+            if new:
+                data = np.stack([self._masked(e[c]) for e in new]) - self.mean[c]
+                coef = np.concatenate([coef, data.dot(self.basis[c].T)])
+            self.coef[c] = coef.astype(np.float32)
+        self.keys = [self.keys[i] for i in keep] + [e.lst[0] for e in new]
+        self._trees = {}
+        return len(new)
+
+    def embed(self, scan, column=0):
+        """embedding of a scan sampled like the library"""
+        return (self._masked(scan) - self.mean[column]).dot(self.basis[column].T)
+
+    def nearest(self, scan, number, column=0):
+        """keys of number library entries closest to scan"""
+        x = self.embed(scan, column=column)
+        number = min(number, len(self.keys))
+        if have_kdtree:
+            tree = self._trees.get(column, None)
+            if tree is None:
+                tree = self._trees[column] = KDTree(self.coef[column])
+            idx = tree.query(x[None, :], k=number, return_distance=False)[0]
+        else:
+            d = np.sum((self.coef[column] - x[None, :]) ** 2, axis=1)
+            idx = np.argsort(d, kind='stable')[0:number]
+        return [self.keys[i] for i in idx]
+
+    def shortlist(self, scan, library, number, column=0):
+        """subset of library entries closest to scan, entries missing in the
+        index are always included"""
+        keys = set(self.nearest(scan, number, column=column))
+        known = set(self.keys)
+        return [e for e in library if e.lst[0] in keys or e.lst[0] not in known]
+
+    def save(self, path):
+        arrays = {'keys': np.array(self.keys),
+                  'shape': np.array(self.shape),
+                  'mask': self.mask,
+                  'factor': np.array(self.factor),
+                  'components': np.array(self.components)}
+        for c in self.coef:
+            arrays['mean_{}'.format(c)] = self.mean[c]
+            arrays['basis_{}'.format(c)] = self.basis[c]
+            arrays['coef_{}'.format(c)] = self.coef[c]
+        tmp = path + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as d:
+            idx = cls(factor=int(d['factor']), components=int(d['components']))
+            idx.keys = [str(i) for i in d['keys']]
+            idx.shape = tuple(int(i) for i in d['shape'])
+            idx.mask = d['mask']
+            for k in d.files:
+                if k.startswith('coef_'):
+                    c = int(k[5:])
+                    idx.coef[c] = d[k]
+                    idx.mean[c] = d['mean_{}'.format(c)]
+                    idx.basis[c] = d['basis_{}'.format(c)]
+        return idx
+
+
+def build_library_index(library, output=None, factor=2, components=32):
+    """build embedding index of the library and save it next to library.yaml"""
+    if output is None:
+        output = library.prefix
+    idx = LibraryIndex(factor=factor, components=components)
+    idx.build(library, mask=library.get('local_model_mask', None))
+    idx.save(output + os.sep + index_name)
+    return idx
+
+
+def update_library_index(library, output=None, factor=None, components=None):
+    """update existing index with new library entries, or build a new one,
+    factor and components default to the ones of the existing index"""
+    if output is None:
+        output = library.prefix
+    path = output + os.sep + index_name
+    if os.path.exists(path):
+        try:
+            idx = LibraryIndex.load(path)
+            if factor in (None, idx.factor) and components in (None, idx.components):
+                idx.update(library)
+                idx.save(path)
+                return idx
+        except (IOError, ValueError, KeyError, numpy_backend.Unsupported):
+            print("Rebuilding library index {}:{}".format(path, sys.exc_info()[1]))
+            traceback.print_exc(file=sys.stdout)
+    return build_library_index(library, output=output,
+                               factor=factor if factor is not None else 2,
+                               components=components if components is not None else 32)
+
+
+def load_library_index(prefix):
+    """load library index on first use, returns None if library doesn't have it"""
+    path = prefix + os.sep + index_name
+    if not os.path.exists(path):
+        return None
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    idx = _indexes.get(key, None)
+    if idx is None:
+        idx = _indexes[key] = LibraryIndex.load(path)
+    return idx
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -11,9 +11,13 @@ import csv
 import copy
 import re
 import json
+import logging
+import collections
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl import numpy_backend
+from ipl.workflow import run_forced, rerun_forced
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -25,6 +29,13 @@ from .resample         import *
 
 import traceback
 
+try:
+    import numpy as np
+except ImportError:
+    pass
+
+logger = logging.getLogger("MINC")
+
 
 def preselect(sample, 
               library,
@@ -34,17 +45,49 @@ def preselect(sample,
               use_nl=False,
               flip=False,
               step=None,
-              lib_add_n=0):
-    '''calculate requested similarity function and return top number of elements from the library'''
+              lib_add_n=0,
+              in_memory=False,
+              index=None,
+              shortlist=0):
+    '''calculate requested similarity function and return top number of elements from the library
+    
+    in_memory -- compare with all library entries at once in-process (see preselect_in_memory),
+                 falls back to minctracc if numpy backend is not available.
+                 Similarity is calculated without rigid adjustment, so selection
+                 could differ from minctracc, default False
+    index     -- library embedding index (see library_index), used to select 
+                 shortlist entries closest to the sample before exact comparison
+    '''
     results=[]
     column=0
     
     # TODO: use multiple modalities for preselection?
     if use_nl:
         column = 4 + lib_add_n
+    
+    if index is not None and number < shortlist < len(library) and column in index.coef:
+        try:
+            library=index.shortlist(sample.scan_f if flip else sample.scan, 
+                                    library, shortlist, column=column)
+        except numpy_backend.Unsupported as e:
+            logger.info("Library index is not used:{}".format(str(e)))
+    
+    if step is None:
+        # figure out step size once, instead of in every job
+        info_sample=mincTools.mincinfo( sample.scan )
+        step= max( abs( info_sample['xspace'].step ) ,
+                   abs( info_sample['yspace'].step ) ,
+                   abs( info_sample['zspace'].step ) )
+    
+    if in_memory:
+        try:
+            return preselect_in_memory(sample, library, method=method, number=number,
+                                       mask=mask, flip=flip, step=step, column=column)
+        except numpy_backend.Unsupported as e:
+            logger.info("Falling back to minctracc for preselection:{}".format(str(e)))
         
     for (i, j) in enumerate(library):
-        results.append(futures.submit(
+        results.append(futures.submit(run_forced, rerun_forced(),
             calculate_similarity, sample, MriDataset(scan=j[column]), method=method, mask=mask, flip=flip, step=step
             ))
     futures.wait(results, return_when=futures.ALL_COMPLETED)
@@ -56,6 +99,180 @@ def preselect(sample,
     return [i[1] for i in val_sorted[ 0:number] ]
 
 
+# library arrays prepared for in-memory preselection, 
+# keyed by (scans, downsampling factor, mask, method), least recently used 
+# are dropped when there are more than _library_arrays_max
+_library_arrays=collections.OrderedDict()
+_library_arrays_max=2
+
+# number of histogram bins for NMI
+_nmi_bins=32
+
+# maximum number of elements in the joint histogram index array 
+_nmi_chunk=1<<25
+
+
+def _downsample(vol, factor):
+    """average blocks of factor^3 voxels"""
+    if factor<2:
+        return vol
+    shape=[ (i//factor)*factor for i in vol.shape ]
+    vol=vol[0:shape[0],0:shape[1],0:shape[2]]
+    return vol.reshape(shape[0]//factor, factor, 
+                       shape[1]//factor, factor,
+                       shape[2]//factor, factor).mean(axis=(1,3,5))
+
+
+def load_downsampled(scan, factor):
+    """load scan as float32 array, averaged in blocks of factor^3 voxels,
+    raises numpy_backend.Unsupported if numpy backend is not available"""
+    if not numpy_backend.have_numpy_backend:
+        raise numpy_backend.Unsupported('minc2_simple or numpy is not available')
+    (vol, f)=numpy_backend.load(scan, data_type=numpy_backend.minc2_file.MINC2_FLOAT)
+    f.close()
+    return _downsample(vol, factor).astype(np.float32)
+
+
+def _bin(data, bins):
+    """discretize every row of data into bins"""
+    vmin=data.min(axis=-1, keepdims=True)
+    vmax=data.max(axis=-1, keepdims=True)
+    scale=(bins-1)/np.maximum(vmax-vmin, 1e-10)
+    return np.clip(np.rint((data-vmin)*scale), 0, bins-1).astype(np.uint8)
+
+
+def _entropy(p, axis):
+    return -np.sum(np.where(p>0, p*np.log(np.where(p>0, p, 1.0)), 0.0), axis=axis)
+
+
+def _library_array(scans, factor, mask, method):
+    """load library scans into one contiguous array of masked voxels, 
+    memoized in _library_arrays"""
+    key=(tuple(scans), factor, mask, method)
+    arr=_library_arrays.pop(key, None)
+    if arr is not None:
+        _library_arrays[key]=arr
+        return arr
+    
+    ref=None
+    select=None
+    if mask is not None:
+        select=load_downsampled(mask, factor)>0.5
+    
+    arr=None
+    for (i, s) in enumerate(scans):
+        vol=load_downsampled(s, factor)
+        if ref is None:
+            ref=vol.shape
+            if select is not None and select.shape!=ref:
+                raise numpy_backend.Unsupported('Mask {} does not match library sampling'.format(mask))
+            arr=np.empty((len(scans), int(select.sum()) if select is not None else vol.size), dtype=np.float32)
+        elif vol.shape!=ref:
+            raise numpy_backend.Unsupported('Library scans have different sampling: {} and {}'.format(scans[0], s))
+        arr[i,:]=vol[select] if select is not None else vol.ravel()
+    
+    if method=='MI':
+        arr=_bin(arr, _nmi_bins)
+    else:
+        # centered and normalized, so that correlation is a dot product
+        arr-=arr.mean(axis=1, keepdims=True)
+        arr/=np.maximum(np.sqrt(np.sum(arr*arr, axis=1, keepdims=True)), 1e-10)
+    
+    _library_arrays[key]=(arr, ref)
+    while len(_library_arrays)>_library_arrays_max:
+        _library_arrays.popitem(last=False)
+    return (arr, ref)
+
+
+def similarity_in_memory(scan, library_scans, method='MI', mask=None, factor=1):
+    """calculate similarity cost between scan and every library scan, 
+    lower is better, like minctracc objective function:
+    -NMI for method 'MI', 1-CC otherwise"""
+    (arr, ref)=_library_array(library_scans, factor, mask, method)
+    vol=load_downsampled(scan, factor)
+    if vol.shape!=ref:
+        raise numpy_backend.Unsupported('Sample {} does not match library sampling'.format(scan))
+    if mask is not None:
+        vol=vol[load_downsampled(mask, factor)>0.5]
+    else:
+        vol=vol.ravel()
+    
+    if method=='MI':
+        bins=_nmi_bins
+        sample_idx=_bin(vol, bins).astype(np.int64)*bins
+        cost=np.empty(arr.shape[0])
+        chunk=max(1, _nmi_chunk//max(arr.shape[1],1))
+        for c0 in range(0, arr.shape[0], chunk):
+            c1=min(c0+chunk, arr.shape[0])
+            # joint histograms of all atlases in the chunk at once
+            idx=(np.arange(c1-c0, dtype=np.int64)[:,None]*(bins*bins) + sample_idx[None,:]) + arr[c0:c1,:]
+            joint=np.bincount(idx.ravel(), minlength=(c1-c0)*bins*bins).reshape(c1-c0, bins, bins)
+            joint=joint/float(arr.shape[1])
+            h_s=_entropy(joint.sum(axis=2), axis=1)
+            h_l=_entropy(joint.sum(axis=1), axis=1)
+            h_j=_entropy(joint.reshape(c1-c0, -1), axis=1)
+            cost[c0:c1]=-(h_s+h_l)/np.maximum(h_j, 1e-10)
+        return cost
+    else:
+        vol=vol.astype(np.float64)
+        vol-=vol.mean()
+        vol/=max(np.sqrt(np.sum(vol*vol)), 1e-10)
+        return 1.0-arr.dot(vol.astype(np.float32))
+
+
+def _step_factor(scan, step):
+    """downsampling factor corresponding to the preselection step"""
+    if step is None:
+        return 1
+    info_sample=mincTools.mincinfo( scan )
+    vstep=max( abs( info_sample['xspace'].step ) ,
+               abs( info_sample['yspace'].step ) ,
+               abs( info_sample['zspace'].step ) )
+    return max(1, int(round(step/vstep)))
+
+
+def similarity_matrix(scans, library_scans, method='MI', mask=None, step=None):
+    """similarity cost between every scan and every library scan (see 
+    similarity_in_memory), returns array of shape (scans, library scans)"""
+    if not numpy_backend.have_numpy_backend:
+        raise numpy_backend.Unsupported('minc2_simple or numpy is not available')
+    if not scans:
+        return np.zeros((0, len(library_scans)))
+    factor=_step_factor(scans[0], step)
+    if method=='MI':
+        return np.stack([ similarity_in_memory(s, library_scans, method=method, mask=mask, factor=factor) 
+                          for s in scans ])
+    # correlation of all scans at once
+    (arr, ref)=_library_array(library_scans, factor, mask, method)
+    select=load_downsampled(mask, factor)>0.5 if mask is not None else None
+    vols=np.empty((len(scans), arr.shape[1]), dtype=np.float32)
+    for (i, s) in enumerate(scans):
+        vol=load_downsampled(s, factor)
+        if vol.shape!=ref:
+            raise numpy_backend.Unsupported('Sample {} does not match library sampling'.format(s))
+        vols[i,:]=vol[select] if select is not None else vol.ravel()
+    vols-=vols.mean(axis=1, keepdims=True)
+    vols/=np.maximum(np.sqrt(np.sum(vols*vols, axis=1, keepdims=True)), 1e-10)
+    return 1.0-vols.dot(arr.T)
+
+
+def preselect_in_memory(sample, library, method='MI', number=10, mask=None,
+                        flip=False, step=None, column=0):
+    '''in-process version of preselect: library scans are loaded once, downsampled
+    to step and compared with the sample in a single vectorized pass.
+    Images are compared as they are, without rigid adjustment done by minctracc.
+    Raises numpy_backend.Unsupported if it is not possible'''
+    if not numpy_backend.have_numpy_backend:
+        raise numpy_backend.Unsupported('minc2_simple or numpy is not available')
+    
+    scan=sample.scan_f if flip else sample.scan
+    cost=similarity_in_memory(scan, [ j[column] for j in library ], 
+                              method=method, mask=mask, factor=_step_factor(scan, step))
+    # stable sort, same order as sorting (cost,entry) pairs with distinct costs
+    order=np.argsort(cost, kind='stable')
+    return [library[i] for i in order[0:number]]
+
+
 def calculate_similarity(sample1, sample2,
                          mask=None, method='MI',
                          flip=False, step=None):
@@ -66,9 +283,6 @@ def calculate_similarity(sample1, sample2,
             if flip:
                 scan=sample1.scan_f
                 
-            # figure out step size, minctracc works extremely slow when step size is smaller then file step size
-            info_sample1=m.mincinfo( sample1.scan )
-            
             cmds=['minctracc', scan, sample2.scan, '-identity']
             
             if method == 'MI':
@@ -77,6 +291,8 @@ def calculate_similarity(sample1, sample2,
                 cmds.append('-xcorr')
 
             if step is None:
+                # figure out step size, minctracc works extremely slow when step size is smaller then file step size
+                info_sample1=m.mincinfo( sample1.scan )
                 step= max( abs( info_sample1['xspace'].step ) ,
                            abs( info_sample1['yspace'].step ) ,
                            abs( info_sample1['zspace'].step ) )
@@ -15,6 +15,7 @@ from ipl.minc_tools import mincTools,mincError
 import ipl.registration
 import ipl.ants_registration
 import ipl.elastix_registration
+from ipl.registration_store import get_registration_store
 
 def linear_registration(
     sample,
@@ -36,9 +37,14 @@ def linear_registration(
     resample_baa=False,
     downsample=None,
     bbox=False,
-    use_mask=True
+    use_mask=True,
+    store=None
     ):
-    """perform linear registration to the model, and calculate inverse"""
+    """perform linear registration to the model, and calculate inverse
+    
+    store -- directory of registration store shared between experiments,
+             default is IPL_REGISTRATION_STORE
+    """
     try:
         _init_xfm=None
         _init_xfm_f=None
@@ -82,7 +88,24 @@ def linear_registration(
             _output_xfm  =output_xfm.xfm
             _output_xfm_f=output_xfm.xfm_f
 
-            if bbox:
+            # reuse registration computed before for the same inputs
+            _store=get_registration_store(store)
+            store_key=None
+            store_outputs=[output_xfm.xfm]
+            if _store is not None:
+                store_inputs=[scan, mask, model.scan, model_mask, _init_xfm]
+                if symmetric:
+                    store_inputs.extend([scan_f, mask_f, model_mask_f, _init_xfm_f])
+                    store_outputs.append(output_xfm.xfm_f)
+                store_key=_store.key('segment.linear_registration', store_inputs,
+                                     {'symmetric':symmetric, 'ants':ants, 'reg_type':reg_type,
+                                      'objective':objective, 'linreg':linreg, 'close':close,
+                                      'downsample':downsample, 'bbox':bbox})
+            stored=_store is not None and _store.fetch(store_key, store_outputs)
+
+            if stored:
+                print("Using stored registration:{}".format(store_key))
+            elif bbox:
                 print("Running in bbox! _init_xfm={} _init_xfm_f={}\n\n\n".format(_init_xfm,_init_xfm_f))
                 scan=m.tmp('scan.mnc')
                 m.resample_smooth(sample.scan, scan, like=model.scan, transform=_init_xfm)
@@ -104,7 +127,9 @@ def linear_registration(
 
                 #os.system('cp -v {} {} {} {} ./'.format(scan,mask,scan_f,mask_f))
 
-            if symmetric:
+            if stored:
+                pass
+            elif symmetric:
                 if ants:
                     ipl.ants_registration.linear_register_ants2(
                         scan,
@@ -184,7 +209,7 @@ def linear_registration(
                         close=close,
                         downsample=downsample,
                         )
-            if bbox :
+            if bbox and not stored:
                 if init_xfm is not None:
                     m.xfmconcat([init_xfm.xfm,_output_xfm],output_xfm.xfm)
                     if symmetric:
@@ -194,6 +219,9 @@ def linear_registration(
                     if symmetric:
                         shutil.copyfile(_output_xfm_f,output_xfm.xfm_f)
 
+            if _store is not None and not stored:
+                _store.store(store_key, store_outputs, method='segment.linear_registration')
+
             if output_invert_xfm is not None:
                 m.xfminvert(output_xfm.xfm, output_invert_xfm.xfm)
                 if symmetric:
@@ -425,8 +453,13 @@ def non_linear_registration(
     output_inv_target=None,
     flip=False,
     downsample=None,
+    store=None
     ):
-    """perform linear registration to the model, and calculate inverse"""
+    """perform non-linear registration to the model, and calculate inverse
+    
+    store -- directory of registration store shared between experiments,
+             default is IPL_REGISTRATION_STORE
+    """
 
     try:
         _init_xfm=None
@@ -443,6 +476,28 @@ def non_linear_registration(
             #TODO: check more files?
             if not m.checkfiles(inputs=[sample.scan], outputs=[output.xfm]):  return 
         
+            # reuse registration computed before for the same inputs,
+            # the registration below is skipped if outputs exist
+            _store=get_registration_store(store)
+            store_key=None
+            store_outputs=[output.xfm]
+            if output_invert:
+                store_outputs.append(output.xfm_inv)
+            if _store is not None:
+                store_inputs=[sample.scan_f if flip and not symmetric else sample.scan,
+                              model.scan, model.mask, _init_xfm]
+                if symmetric:
+                    store_inputs.extend([sample.scan_f, _init_xfm_f])
+                    store_outputs.append(output.xfm_f)
+                    if output_invert:
+                        store_outputs.append(output.xfm_f_inv)
+                store_key=_store.key('segment.non_linear_registration', store_inputs,
+                                     {'symmetric':symmetric, 'ants':ants, 'level':level,
+                                      'start_level':start_level, 'parameters':parameters,
+                                      'downsample':downsample})
+            stored=_store is not None and _store.fetch(store_key, store_outputs)
+            if stored:
+                print("Using stored registration:{}".format(store_key))
             
             if symmetric:
                 # TODO: split up into two jobs?
@@ -572,6 +627,9 @@ def non_linear_registration(
                             m.xfm_normalize(m.tmp('forward')+'_inverse.xfm', model.scan, output.xfm_inv, step=level )
                         else:
                             m.xfm_normalize(m.tmp('forward')+'.xfm', model.scan, output.xfm_inv, step=level, invert=True)
+            
+            if _store is not None and not stored:
+                _store.store(store_key, store_outputs, method='segment.non_linear_registration')
            
             if output_sample is not None: 
                 m.resample_smooth(sample.scan, output_sample.scan, 
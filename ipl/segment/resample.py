@@ -12,6 +12,7 @@ import traceback
 
 # MINC stuff
 from ipl.minc_tools import mincTools,mincError
+from ipl.workflow import run_forced, rerun_forced
 
 from .filter import *
 
@@ -60,7 +61,7 @@ def resample_split_segmentations(input, output,xfm=None, like=None, order=4, inv
         if not output.seg_split.has_key(i):
             output.seg_split[i]='{}_{:03d}.mnc'.format(base,i)
             
-        results.append(futures.submit(
+        results.append(futures.submit(run_forced, rerun_forced(),
             resample_file,j,output.seg_split[i],xfm=xfm,like=like,order=order,invert_transform=invert_transform
         ))
     if symmetric:
@@ -69,7 +70,7 @@ def resample_split_segmentations(input, output,xfm=None, like=None, order=4, inv
             if not output.seg_f_split.has_key(i):
                 output.seg_split[i]='{}_{:03d}.mnc'.format(base,i)
 
-            results.append(futures.submit(
+            results.append(futures.submit(run_forced, rerun_forced(),
                 resample_file,j,output.seg_f_split[i],xfm=xfm,like=like,order=order,invert_transform=invert_transform
             ))
     futures.wait(results, return_when=futures.ALL_COMPLETED)
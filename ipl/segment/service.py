@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Resident segmentation service
+#
+# The library is loaded once, its index, model headers and files are kept
+# hot in the process (and page cache) between jobs. Jobs are submitted over
+# HTTP, either on a Unix socket (default, accessible only by the owner) or on
+# a TCP port, which requires a token sent as "Authorization: Bearer <token>":
+#
+#   POST   /jobs        {"input":..., "output":..., "mask":..., "options":{...},
+#                        "presegment":..., "work":..., "variant_fuse":...,
+#                        "variant_ec":..., "variant_reg":..., "cleanup":false}
+#   GET    /jobs        list of jobs
+#   GET    /jobs/<id>   status of a job: queued, running, done, failed
+#   DELETE /jobs/<id>   cancel queued job
+#   POST   /shutdown    stop after finishing the current job
+#
+# Jobs can override only a few segmentation options (see _job_parameters),
+# external tools and paths are fixed by the service configuration. Outputs
+# and work directories have to be inside one of allowed directories.
+#
+# Jobs are executed one after another in the main thread, since they use
+# scoop for parallel execution.
+
+from __future__ import print_function
+
+import os
+import sys
+import hmac
+import json
+import time
+import socket
+import tempfile
+import threading
+import traceback
+import collections
+import socketserver
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    from urllib.request import urlopen, Request
+except ImportError:
+    from urllib2 import urlopen, Request
+
+from ipl import minc_header
+from .library import SegLibrary, LIBEncoder
+from .library_index import load_library_index
+from .fuse import fusion_segment
+
+_job_options = ('input', 'output', 'mask', 'options', 'presegment', 'work',
+                'variant_fuse', 'variant_ec', 'variant_reg', 'cleanup')
+
+# segmentation options jobs can override, with allowed keys of nested options
+_job_parameters = {
+    'library_preselect':             None,
+    'library_preselect_step':        None,
+    'library_preselect_method':      None,
+    'library_progressive':           None,
+    'library_progressive_min':       None,
+    'library_progressive_max':       None,
+    'library_progressive_step':      None,
+    'library_progressive_threshold': None,
+    'resample_order':                None,
+    'resample_baa':                  None,
+    'segment_symmetric':             None,
+    'mask_output':                   None,
+    'fuse_options': {
+        'patch': None, 'search': None, 'threshold': None, 'iter': None,
+        'nnls': None, 'beta': None, 'new': None, 'native': None,
+        'vote_weights': None, 'gco': None, 'gco_diagonal': None,
+        'gco_wlabel': None, 'gco_wdata': None, 'gco_wintensity': None,
+        'gco_epsilon': None,
+        'label_norm': {'order': None, 'median': None}},
+    }
+
+_scalar = (bool, int, float, str, type(None))
+
+
+def _check_parameters(options, allowed, path='options'):
+    """reject options jobs are not allowed to override"""
+    if not isinstance(options, dict):
+        raise ValueError('{} should be an object'.format(path))
+    for (k, v) in options.items():
+        if k not in allowed:
+            raise ValueError('{}.{} can not be set by a job'.format(path, k))
+        if allowed[k] is not None:
+            if v is not None:
+                _check_parameters(v, allowed[k], path + '.' + k)
+        elif not isinstance(v, _scalar):
+            raise ValueError('{}.{} should be a scalar'.format(path, k))
+
+
+def default_address():
+    """Unix socket in the user's runtime directory"""
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()),
+                        'ipl_segmentation_{}.sock'.format(os.getuid()))
+
+
+def _is_unix(address):
+    return os.sep in address or not address.rsplit(':', 1)[-1].isdigit()
+
+
+class Job(object):
+    def __init__(self, job_id, request):
+        self.id = job_id
+        self.request = request
+        self.status = 'queued'
+        self.error = None
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def info(self):
+        return {'id': self.id, 'status': self.status, 'error': self.error,
+                'request': self.request, 'result': self.result,
+                'submitted': self.submitted, 'started': self.started,
+                'finished': self.finished}
+
+
+def _jsonable(o):
+    try:
+        return json.loads(json.dumps(o, cls=LIBEncoder))
+    except (TypeError, ValueError):
+        return json.loads(json.dumps(o, default=str))
+
+
+def _library_files(library):
+    files = [library.get(i) for i in SegLibrary._rel_paths | SegLibrary._abs_paths
+             if isinstance(library.__dict__.get(i, None), str)]
+    for i in SegLibrary._rel_paths_lst | SegLibrary._abs_paths_lst:
+        files.extend(library.get(i) or [])
+    return [i for i in files if i is not None and os.path.isfile(i)]
+
+
+def _warm(paths, block_size=1 << 20):
+    """read files, so that they stay in the page cache"""
+    for p in paths:
+        with open(p, 'rb') as f:
+            while f.read(block_size):
+                pass
+
+
+class SegmentationService(object):
+    """Queue of segmentation jobs, executed with the same library"""
+
+    def __init__(self, library, parameters=None, warm=True, allowed_dirs=None):
+        """allowed_dirs -- directories for outputs and work directories of jobs,
+                           default is the current directory"""
+        if not isinstance(library, SegLibrary):
+            library = SegLibrary(library)
+        self.library = library
+        self.parameters = parameters or {}
+        self.allowed_dirs = [os.path.realpath(i) for i in (allowed_dirs or [os.getcwd()])]
+        self.jobs = collections.OrderedDict()
+        self.queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stop = False
+        self._next_id = 1
+        if warm:
+            self.warm()
+
+    def warm(self):
+        """load everything that is reused between jobs"""
+        t0 = time.time()
+        models = _library_files(self.library)
+        _warm(models)
+        samples = []
+        for e in self.library['library']:
+            samples.extend(e[0:len(e.lst)])
+        minc_header.prefetch([i for i in models + samples if i.endswith('.mnc')])
+        load_library_index(self.library.prefix)
+        print("Library {} is loaded in {:.1f}s".format(self.library.prefix, time.time() - t0))
+
+    def _check_path(self, path):
+        if not os.path.isabs(path):
+            raise ValueError('Path should be absolute:{}'.format(path))
+        real = os.path.realpath(path)
+        for d in self.allowed_dirs:
+            if real == d or real.startswith(d + os.sep):
+                return
+        raise ValueError('Path is outside of allowed directories:{}'.format(path))
+
+    def submit(self, request):
+        if not isinstance(request, dict):
+            raise ValueError('Request should be an object')
+        request = {k: v for (k, v) in request.items() if k in _job_options}
+        if not request.get('input') or not request.get('output'):
+            raise ValueError('input and output are required')
+        for k in ('input', 'output', 'mask', 'presegment', 'work',
+                  'variant_fuse', 'variant_ec', 'variant_reg'):
+            if request.get(k) is not None and not isinstance(request[k], str):
+                raise ValueError('{} should be a string'.format(k))
+        for k in ('output', 'work'):
+            if request.get(k) is not None:
+                self._check_path(request[k])
+        _check_parameters(request.get('options') or {}, _job_parameters)
+        with self._cond:
+            job = Job(str(self._next_id), request)
+            self._next_id += 1
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self._cond.notify_all()
+        return job
+
+    def cancel(self, job_id):
+        with self._cond:
+            job = self.jobs[job_id]
+            if job.status == 'queued':
+                self.queue.remove(job)
+                job.status = 'cancelled'
+        return job
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+
+    def run(self, job):
+        r = job.request
+        parameters = dict(self.parameters)
+        parameters.update(r.get('options') or {})
+        (seg, output_info) = fusion_segment(r['input'], self.library, r['output'],
+                                            input_mask=r.get('mask'),
+                                            parameters=parameters,
+                                            fuse_variant=r.get('variant_fuse', 'fuse'),
+                                            ec_variant=r.get('variant_ec', 'ec'),
+                                            regularize_variant=r.get('variant_reg', 'ec'),
+                                            work_dir=r.get('work'),
+                                            cleanup=r.get('cleanup', False),
+                                            presegment=r.get('presegment'))
+        return {'output_segment': seg,
+                'output_volumes': output_info.get('output_volumes', None)}
+
+    def serve(self):
+        """execute jobs until stopped, has to be called from the main thread"""
+        while True:
+            with self._cond:
+                while not self.queue and not self._stop:
+                    self._cond.wait(1.0)
+                if self._stop:
+                    return
+                job = self.queue.popleft()
+                job.status = 'running'
+                job.started = time.time()
+            try:
+                job.result = _jsonable(self.run(job))
+                job.status = 'done'
+            except Exception as e:
+                traceback.print_exc(file=sys.stderr)
+                job.error = '{}: {}'.format(type(e).__name__, str(e))
+                job.status = 'failed'
+            job.finished = time.time()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+    token = None
+
+    def address_string(self):
+        # client address of Unix socket is empty
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def _reply(self, code, data):
+        body = json.dumps(data, indent=1).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        if self.token is None:
+            return True
+        auth = self.headers.get('Authorization', '')
+        if hmac.compare_digest(auth.encode(), 'Bearer {}'.format(self.token).encode()):
+            return True
+        self._reply(401, {'error': 'unauthorized'})
+        return False
+
+    def _job_id(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path.rstrip('/') == '/jobs':
+            return self._reply(200, [j.info() for j in list(self.service.jobs.values())])
+        job_id = self._job_id()
+        if job_id is not None and job_id in self.service.jobs:
+            return self._reply(200, self.service.jobs[job_id].info())
+        self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if self.path.rstrip('/') == '/jobs':
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job = self.service.submit(json.loads(self.rfile.read(length).decode()))
+            except ValueError as e:
+                return self._reply(400, {'error': str(e)})
+            return self._reply(202, job.info())
+        if self.path.rstrip('/') == '/shutdown':
+            self.service.stop()
+            return self._reply(200, {'status': 'stopping'})
+        self._reply(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return
+        job_id = self._job_id()
+        if job_id is not None and job_id in self.service.jobs:
+            return self._reply(200, self.service.cancel(job_id).info())
+        self._reply(404, {'error': 'not found'})
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # only the owner can connect
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, 0o600)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class _TCPHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(service, address, token=None):
+    """HTTP server for a service, address is either a path of Unix socket
+    or [host:]port, TCP server requires token"""
+    handler = type('Handler', (_Handler,), {'service': service, 'token': token})
+    if _is_unix(address):
+        if os.path.exists(address):
+            os.unlink(address)
+        return _UnixHTTPServer(address, handler)
+    if not token:
+        raise ValueError('Token is required for TCP address {}'.format(address))
+    (host, port) = (['127.0.0.1'] + address.rsplit(':', 1))[-2:]
+    return _TCPHTTPServer((host, int(port)), handler)
+
+
+def run_service(library, address=None, parameters=None, token=None, allowed_dirs=None):
+    """run service until it receives shutdown request"""
+    if address is None:
+        address = default_address()
+    service = SegmentationService(library, parameters=parameters, allowed_dirs=allowed_dirs)
+    server = make_server(service, address, token=token)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    print("Serving segmentation jobs on {}".format(address))
+    try:
+        service.serve()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if isinstance(server, _UnixHTTPServer) and os.path.exists(address):
+            os.unlink(address)
+
+
+class _UnixConnection(object):
+    """minimal HTTP client over Unix socket"""
+
+    def __init__(self, path, token=None):
+        self.path = path
+        self.token = token
+
+    def request(self, method, url, data=None):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self.path)
+            body = data or b''
+            auth = 'Authorization: Bearer {}\r\n'.format(self.token) if self.token else ''
+            s.sendall('{} {} HTTP/1.0\r\nHost: localhost\r\n{}Content-Length: {}\r\n\r\n'.format(
+                method, url, auth, len(body)).encode() + body)
+            reply = b''
+            while True:
+                b = s.recv(65536)
+                if not b:
+                    break
+                reply += b
+        finally:
+            s.close()
+        (head, body) = reply.split(b'\r\n\r\n', 1)
+        return (int(head.split(b' ', 2)[1]), json.loads(body.decode()))
+
+
+def request(address, method, url, data=None, token=None):
+    """send request to the service, returns (HTTP status, reply)"""
+    body = json.dumps(data).encode() if data is not None else None
+    if _is_unix(address):
+        return _UnixConnection(address, token).request(method, url, body)
+    if ':' not in address:
+        address = '127.0.0.1:' + address
+    req = Request('http://{}{}'.format(address, url), data=body)
+    if token:
+        req.add_header('Authorization', 'Bearer {}'.format(token))
+    req.get_method = lambda: method
+    try:
+        r = urlopen(req)
+        return (r.getcode(), json.loads(r.read().decode()))
+    except Exception as e:
+        if hasattr(e, 'code') and hasattr(e, 'read'):
+            return (e.code, json.loads(e.read().decode()))
+        raise
+
+
+def segment_remote(address=None, wait=True, poll=2.0, token=None, **job):
+    """submit segmentation job to the service, and wait for completion"""
+    if address is None:
+        address = default_address()
+    (code, info) = request(address, 'POST', '/jobs', job, token=token)
+    if code != 202:
+        raise ValueError('Job is rejected: {}'.format(info.get('error')))
+    while wait and info['status'] in ('queued', 'running'):
+        time.sleep(poll)
+        (code, info) = request(address, 'GET', '/jobs/' + info['id'], token=token)
+    return info
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -14,6 +14,7 @@ import copy
 
 # MINC stuff
 from ipl.minc_tools import mincTools, mincError
+from ipl import numpy_backend
 
 # scoop parallel execution
 from scoop import futures, shared
@@ -25,6 +26,7 @@ from .resample         import *
 from .error_correction import *
 from .model            import *
 from .library          import *
+from .library_index    import build_library_index
 
 
 def inv_dict(d):
@@ -90,6 +92,11 @@ def generate_library(parameters, output, debug=False, cleanup=False, work_dir=No
         # extent bounding box to reduce boundary effects
         extend_boundary           = parameters.get( 'extend_boundary',4)
 
+        # build embedding index for fast (approximate) preselection, see library_preselect_shortlist
+        build_index               = parameters.get( 'build_index',False)
+        index_factor              = parameters.get( 'index_factor',2)
+        index_components          = parameters.get( 'index_components',32)
+
         # extend maks 
         #dilate_mask               = parameters.get( 'dilate_mask',3)
         op_mask                    = parameters.get( 'op_mask','E[2] D[4]')
@@ -663,6 +670,13 @@ def generate_library(parameters, output, debug=False, cleanup=False, work_dir=No
                 library_description.library.append( LibEntry(lst=ss, ent_id=i.name, relpath=output, prefix=output))
 
         library_description.save(output)
+        
+        if build_index:
+            try:
+                build_library_index(library_description, output, 
+                                    factor=index_factor, components=index_components)
+            except numpy_backend.Unsupported as e:
+                print("Library index is not created:{}".format(str(e)))
         # cleanup
         if cleanup:
             shutil.rmtree(work_dir)
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Slab-wise processing of MINC volumes with bounded memory
+#
+# Volumes are processed in slabs along the slowest varying dimension (z in
+# the standard order) using hyperslab reads and writes, the number of planes
+# in a slab is chosen so that all buffers fit into the memory ceiling.
+# The ceiling is set with IPL_SLAB_MEMORY environment variable
+# (i.e 512M, default 256M) or max_memory argument.
+
+from __future__ import print_function
+
+import os
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from minc2_simple import minc2_file
+    import numpy as np
+    have_minc2_simple = True
+except ImportError:
+    # minc2_simple not available :(
+    have_minc2_simple = False
+
+from .minc_tools import mincError
+from .result_cache import parse_size
+
+logger = logging.getLogger("MINC")
+
+_default_memory = '256M'
+
+
+def memory_limit(max_memory=None):
+    """memory ceiling in bytes"""
+    if max_memory is None:
+        max_memory = os.environ.get('IPL_SLAB_MEMORY', _default_memory)
+    return parse_size(max_memory)
+
+
+def open_volume(path):
+    """open minc file for slab access, in standard (z,y,x) order"""
+    f = minc2_file(path)
+    f.setup_standard_order()
+    return f
+
+
+def volume_shape(f):
+    """shape of the volume in numpy order"""
+    # minc2_simple lists dimensions starting from the fastest varying
+    return tuple(int(d.length) for d in reversed(f.representation_dims()))
+
+
+def slab_planes(shape, bytes_per_voxel, max_memory=None):
+    """number of planes in a slab, fitting into memory ceiling"""
+    plane = int(np.prod(shape[1:])) * bytes_per_voxel
+    return int(max(1, min(shape[0], memory_limit(max_memory) // max(plane, 1))))
+
+
+def slabs(shape, planes):
+    """iterate over (first,last+1) plane of each slab"""
+    for z0 in range(0, shape[0], planes):
+        yield (z0, min(z0 + planes, shape[0]))
+
+
+def read_slab(f, z0, z1, data_type=None):
+    """read planes z0..z1-1 of an open volume"""
+    if data_type is None:
+        data_type = minc2_file.MINC2_FLOAT
+    shape = volume_shape(f)
+    # start and count are in numpy order, like the shape of loaded volume
+    return f.load_hyperslab(data_type,
+                            [z0] + [0] * (len(shape) - 1),
+                            [z1 - z0] + list(shape[1:]))
+
+
+_types = {
+    'byte':  ('MINC2_BYTE',  np.int8 if have_minc2_simple else None),
+    'short': ('MINC2_SHORT', np.int16 if have_minc2_simple else None),
+    'int':   ('MINC2_INT',   np.int32 if have_minc2_simple else None),
+    'float': ('MINC2_FLOAT', np.float32 if have_minc2_simple else None),
+}
+
+
+class SlabWriter(object):
+    """output volume written slab by slab, with the same sampling as like"""
+
+    def __init__(self, path, like, datatype='float'):
+        ref = open_volume(like) if not isinstance(like, minc2_file) else like
+        (minc_type, self.dtype) = _types[datatype]
+        minc_type = getattr(minc2_file, minc_type)
+        self.shape = volume_shape(ref)
+        self.f = minc2_file()
+        self.f.define(ref.store_dims(), minc_type, minc_type)
+        self.f.create(path)
+        self.f.copy_metadata(ref)
+        self.f.setup_standard_order()
+        if ref is not like:
+            ref.close()
+
+    def write(self, z0, data):
+        self.f.save_hyperslab(np.ascontiguousarray(data, dtype=self.dtype),
+                              [z0] + [0] * (len(self.shape) - 1))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _check_shapes(inputs):
+    shape = None
+    for i in inputs:
+        f = open_volume(i)
+        s = volume_shape(f)
+        f.close()
+        if shape is None:
+            shape = s
+        elif s != shape:
+            raise mincError('Volume {} has shape {}, expected {}'.format(i, repr(s), repr(shape)))
+    return shape
+
+
+def iterate(inputs, bytes_per_voxel=None, max_memory=None, data_type=None):
+    """iterate over slabs of several volumes at once
+
+    yields (z0, z1, [slab of every input])
+    bytes_per_voxel -- memory required per voxel by the caller, including
+                       all inputs, default 8 bytes per input
+    """
+    shape = _check_shapes(inputs)
+    if bytes_per_voxel is None:
+        bytes_per_voxel = 8 * len(inputs)
+    files = [open_volume(i) for i in inputs]
+    try:
+        for (z0, z1) in slabs(shape, slab_planes(shape, bytes_per_voxel, max_memory)):
+            yield (z0, z1, [read_slab(f, z0, z1, data_type=data_type) for f in files])
+    finally:
+        for f in files:
+            f.close()
+
+
+def voxel_map(inputs, output, func, datatype='float', bytes_per_voxel=None,
+              max_memory=None, data_type=None):
+    """calculate voxel-wise map: output slab = func(z0, z1, [input slabs])"""
+    if bytes_per_voxel is None:
+        bytes_per_voxel = 8 * (len(inputs) + 1)
+    with SlabWriter(output, inputs[0], datatype=datatype) as out:
+        for (z0, z1, s) in iterate(inputs, bytes_per_voxel=bytes_per_voxel,
+                                   max_memory=max_memory, data_type=data_type):
+            out.write(z0, func(z0, z1, s))
+
+
+def mean_sd(inputs, output, output_sd=None, binary=False, threshold=0.5,
+            max_memory=None, threads=None):
+    """voxel-wise mean and (population) standard deviation of many volumes"""
+    reduce_samples(inputs, output, output_sd=output_sd, binary=binary,
+                   threshold=threshold, max_memory=max_memory, threads=threads)
+
+
+def x_symmetric(f):
+    """check if sampling along x is symmetric around 0, so that flipping
+    voxels is the same as resampling with x scale -1"""
+    ref = open_volume(f) if not isinstance(f, minc2_file) else f
+    try:
+        # fastest varying dimension is x in the standard order
+        d = ref.representation_dims()[0]
+        if getattr(d, 'have_dir_cos', False):
+            cos = [float(d.dir_cos[i]) for i in range(3)]
+            if abs(abs(cos[0]) - 1.0) > 1e-6:
+                return False
+        return abs(2.0 * float(d.start) + (int(d.length) - 1) * float(d.step)) < 1e-3 * abs(float(d.step))
+    finally:
+        if ref is not f:
+            ref.close()
+
+
+def _threads(threads):
+    if threads is None:
+        threads = int(os.environ.get('IPL_LOCAL_SLOTS', multiprocessing.cpu_count()))
+    return max(1, threads)
+
+
+def reduce_samples(inputs, output, output_sd=None, median=False, masks=None,
+                   flip=None, symmetrize=False, ddof=0, binary=False,
+                   threshold=0.5, threads=None, max_memory=None):
+    """voxel-wise mean and standard deviation (or median and median absolute
+    deviation) of many volumes, in one pass
+    
+    Slabs of all inputs are read in parallel threads, reading of the next
+    slab overlaps with processing of the current one. Mean and standard
+    deviation are accumulated with Welford updates, median is exact.
+    
+    output_sd      -- standard deviation, or MAD if median is True
+    masks          -- list of masks, one per input, voxels outside of mask
+                      are ignored (None in the list means no mask)
+    flip           -- list of flags, one per input: flip input along x
+    symmetrize     -- average output with its flipped version (output_sd
+                      is not symmetrized)
+    ddof           -- delta degrees of freedom for standard deviation,
+                      default 0: population standard deviation
+    binary         -- write output > threshold as a byte volume
+    
+    Flipping requires x sampling symmetric around 0, see x_symmetric
+    """
+    n = len(inputs)
+    if masks is None:
+        masks = [None] * n
+    if flip is None:
+        flip = [False] * n
+    if len(masks) != n or len(flip) != n:
+        raise mincError('masks and flip should be given for every input')
+    _masks = [i for i in masks if i is not None]
+    shape = _check_shapes(list(inputs) + _masks)
+    if (symmetrize or any(flip)) and not x_symmetric(inputs[0]):
+        raise mincError('Sampling of {} is not symmetric along x, can\'t flip'.format(inputs[0]))
+    threads = _threads(threads)
+
+    # two slabs of every input and mask are kept in memory, plus accumulators
+    per_input = 4 if not median else 4 + 8
+    planes = slab_planes(shape, 2 * (4 * n + len(_masks)) + per_input * n + 8 * 4, max_memory)
+
+    out = SlabWriter(output, inputs[0], datatype='byte' if binary else 'float')
+    out_sd = SlabWriter(output_sd, inputs[0]) if output_sd is not None else None
+    files = [open_volume(i) for i in inputs]
+    mask_files = [open_volume(i) if i is not None else None for i in masks]
+
+    def _read(k, z0, z1):
+        v = read_slab(files[k], z0, z1)
+        w = None
+        if mask_files[k] is not None:
+            w = read_slab(mask_files[k], z0, z1) > 0.5
+        if flip[k]:
+            v = v[..., ::-1]
+            w = w[..., ::-1] if w is not None else None
+        return (v, w)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            _slabs = list(slabs(shape, planes))
+            pending = [ex.submit(_read, k, _slabs[0][0], _slabs[0][1]) for k in range(n)]
+            for (s, (z0, z1)) in enumerate(_slabs):
+                data = [p.result() for p in pending]
+                if s + 1 < len(_slabs):
+                    pending = [ex.submit(_read, k, _slabs[s + 1][0], _slabs[s + 1][1]) for k in range(n)]
+                if median:
+                    stack = np.stack([v for (v, w) in data]).astype(np.float64)
+                    if _masks:
+                        for (k, (v, w)) in enumerate(data):
+                            if w is not None:
+                                stack[k][~w] = np.nan
+                    del data
+                    with np.errstate(all='ignore'):
+                        avg = np.nanmedian(stack, axis=0) if _masks else np.median(stack, axis=0)
+                        if out_sd is not None:
+                            sd = np.abs(stack - avg)
+                            sd = np.nanmedian(sd, axis=0) if _masks else np.median(sd, axis=0)
+                    del stack
+                    avg = np.nan_to_num(avg)
+                else:
+                    count = np.zeros(data[0][0].shape) if _masks else 0.0
+                    avg = np.zeros(data[0][0].shape)
+                    m2 = np.zeros(data[0][0].shape) if out_sd is not None else None
+                    for (v, w) in data:
+                        delta = v - avg
+                        if w is None:
+                            count += 1.0
+                            avg += delta / count
+                            if m2 is not None:
+                                m2 += delta * (v - avg)
+                        else:
+                            count += w
+                            avg += np.where(w, delta, 0.0) / np.maximum(count, 1.0)
+                            if m2 is not None:
+                                m2 += np.where(w, delta * (v - avg), 0.0)
+                    del data
+                    if m2 is not None:
+                        with np.errstate(all='ignore'):
+                            sd = np.where(count > ddof, np.sqrt(np.maximum(m2, 0.0) / np.maximum(count - ddof, 1e-10)), 0.0)
+                if out_sd is not None:
+                    out_sd.write(z0, sd)
+                if symmetrize:
+                    avg = 0.5 * (avg + avg[..., ::-1])
+                if binary:
+                    out.write(z0, np.greater(avg, threshold))
+                else:
+                    out.write(z0, avg)
+    finally:
+        for f in files:
+            f.close()
+        for f in mask_files:
+            if f is not None:
+                f.close()
+        out.close()
+        if out_sd is not None:
+            out_sd.close()
+
+
+def median(inputs, output, max_memory=None):
+    """voxel-wise median of many volumes"""
+    voxel_map(inputs, output,
+              lambda z0, z1, s: np.median(np.stack(s), axis=0),
+              bytes_per_voxel=4 * len(inputs) + 16,
+              max_memory=max_memory)
+
+
+def _vote(z0, z1, s):
+    stack = np.stack(s)
+    labels = np.unique(stack)
+    counts = np.stack([np.sum(stack == l, axis=0) for l in labels])
+    return labels[np.argmax(counts, axis=0)]
+
+
+def vote(inputs, output, max_memory=None):
+    """voxel-wise majority vote of label volumes,
+    ties are resolved in favour of the smallest label"""
+    voxel_map(inputs, output, _vote, datatype='int',
+              bytes_per_voxel=4 * len(inputs) + 16,
+              max_memory=max_memory, data_type=minc2_file.MINC2_INT)
+
+
+def label_fusion(inputs, output, classes_number, prob_base=None, weights=None,
+                 datatype=None, max_memory=None):
+    """voxel-wise (weighted) majority vote of label volumes
+
+    inputs         -- label volumes, labels outside of 0..classes_number-1
+                      are ignored
+    output         -- fused labels, ties are resolved in favour of
+                      the smallest label
+    prob_base      -- if given, probability of each class is written into
+                      <prob_base>_XX.mnc
+    weights        -- weight of each input, default 1.0
+    """
+    shape = _check_shapes(inputs)
+    if weights is None:
+        weights = np.ones(len(inputs))
+    weights = np.asarray(weights, dtype=np.float64)
+    if datatype is None:
+        datatype = 'byte' if classes_number < 128 else 'short'
+    # label slabs, flattened index and per-class accumulator
+    planes = slab_planes(shape, 4 * len(inputs) + 16 * len(inputs) + 8 * classes_number + 16,
+                         max_memory)
+    out = SlabWriter(output, inputs[0], datatype=datatype)
+    probs = []
+    if prob_base is not None:
+        probs = [SlabWriter('{}_{:02d}.mnc'.format(prob_base, i), inputs[0])
+                 for i in range(classes_number)]
+    files = [open_volume(i) for i in inputs]
+    try:
+        for (z0, z1) in slabs(shape, planes):
+            lbl = np.stack([read_slab(f, z0, z1, data_type=minc2_file.MINC2_INT).ravel()
+                            for f in files])
+            n = lbl.shape[1]
+            valid = (lbl >= 0) & (lbl < classes_number)
+            idx = lbl.astype(np.int64) * n + np.arange(n, dtype=np.int64)[None, :]
+            # all inputs are accumulated with one call
+            votes = np.bincount(idx[valid],
+                                weights=np.broadcast_to(weights[:, None], lbl.shape)[valid],
+                                minlength=classes_number * n).reshape(classes_number, n)
+            slab_shape = (z1 - z0,) + tuple(shape[1:])
+            out.write(z0, np.argmax(votes, axis=0).reshape(slab_shape))
+            if probs:
+                total = np.maximum(votes.sum(axis=0), 1e-10)
+                for (i, p) in enumerate(probs):
+                    p.write(z0, (votes[i] / total).reshape(slab_shape))
+    finally:
+        for f in files:
+            f.close()
+        out.close()
+        for p in probs:
+            p.close()
+
+
+def correlation(reference, inputs, mask=None, max_memory=None):
+    """correlation coefficient between reference and each input,
+    calculated inside mask, returns list"""
+    vols = [reference] + list(inputs) + ([mask] if mask is not None else [])
+    n = len(inputs)
+    s_r = s_rr = 0.0
+    s_i = np.zeros(n)
+    s_ii = np.zeros(n)
+    s_ri = np.zeros(n)
+    count = 0
+    for (z0, z1, s) in iterate(vols, bytes_per_voxel=8 * len(vols) + 8, max_memory=max_memory):
+        r = s[0].astype(np.float64).ravel()
+        v = np.stack([i.ravel() for i in s[1:n + 1]]).astype(np.float64)
+        if mask is not None:
+            sel = s[-1].ravel() > 0.5
+            r = r[sel]
+            v = v[:, sel]
+        count += r.size
+        s_r += r.sum()
+        s_rr += r.dot(r)
+        s_i += v.sum(axis=1)
+        s_ii += np.sum(v * v, axis=1)
+        s_ri += v.dot(r)
+    if count == 0:
+        return [0.0] * n
+    cov = s_ri - s_r * s_i / count
+    var_r = s_rr - s_r * s_r / count
+    var_i = s_ii - s_i * s_i / count
+    return list(cov / np.maximum(np.sqrt(np.maximum(var_r * var_i, 0.0)), 1e-10))
+
+
+def orthogonal_slices(f, axial, coronal, sagittal, max_memory=None):
+    """extract slices along each of the three axes, reading volume slab by slab
+
+    returns ([axial slices],[coronal slices],[sagittal slices]) and (min,max)
+    of the whole volume
+    """
+    shape = volume_shape(f)
+    _axial = {}
+    _coronal = [[] for i in coronal]
+    _sagittal = [[] for i in sagittal]
+    vmin = vmax = None
+    for (z0, z1) in slabs(shape, slab_planes(shape, 4, max_memory)):
+        s = read_slab(f, z0, z1)
+        _min = np.nanmin(s)
+        _max = np.nanmax(s)
+        vmin = _min if vmin is None else min(vmin, _min)
+        vmax = _max if vmax is None else max(vmax, _max)
+        for i in axial:
+            if z0 <= i < z1:
+                _axial[i] = s[i - z0, :, :].copy()
+        for (k, i) in enumerate(coronal):
+            _coronal[k].append(s[:, i, :].copy())
+        for (k, i) in enumerate(sagittal):
+            _sagittal[k].append(s[:, :, i].copy())
+    return ([_axial[i] for i in axial],
+            [np.concatenate(i, axis=0) for i in _coronal],
+            [np.concatenate(i, axis=0) for i in _sagittal],
+            (vmin, vmax))
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
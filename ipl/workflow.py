@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# Pipeline stages with hash-based invalidation
+#
+# Each stage declares input files, output files and parameters. After
+# a successful run the digest of inputs, parameters and upstream results is
+# recorded in a state file together with digests of the outputs. On the next
+# run a stage is skipped if the digest did not change and outputs are intact,
+# otherwise it is recomputed: declared outputs are removed and
+# mincTools.checkfiles is forced to ignore other existing outputs. Jobs
+# submitted by a stage have to receive the state explicitly, see run_forced.
+# File modification times are never compared, so clock skew
+# on network filesystems does not matter.
+
+from __future__ import print_function
+
+import os
+import time
+import json
+import hashlib
+import threading
+import contextlib
+import collections
+import logging
+
+from .result_cache import path_digest
+from . import profile
+
+logger = logging.getLogger("MINC")
+
+_local = threading.local()
+
+
+def rerun_forced():
+    """True if outputs of the current stage are out of date and have to be
+    recomputed, even if they exist"""
+    return getattr(_local, 'force', False)
+
+
+@contextlib.contextmanager
+def forced(force=True):
+    """execute code in the context of an out of date stage"""
+    prev = getattr(_local, 'force', False)
+    _local.force = force
+    try:
+        yield
+    finally:
+        _local.force = prev
+
+
+def run_forced(force, func, *args, **kwargs):
+    """execute func in the context of a stage, force is the value of
+    rerun_forced() in the caller. Use it to pass the state explicitly to
+    jobs executed in other threads or processes, i.e
+    futures.submit(run_forced, rerun_forced(), func, ...)"""
+    with forced(force):
+        return func(*args, **kwargs)
+
+
+def _run_stage(name, func, args, kwargs, force):
+    """execute stage function, possibly in another process
+    returns (return value, wall time)"""
+    t0 = time.time()
+    with forced(force):
+        with profile.stage(name):
+            value = func(*args, **kwargs)
+    return (value, time.time() - t0)
+
+
+def _func_name(func):
+    return '{}.{}'.format(getattr(func, '__module__', None),
+                          getattr(func, '__name__', repr(func)))
+
+
+def _jsonable(o):
+    # objects like MriScan are described by their attributes, to avoid
+    # memory addresses in the digest
+    if callable(o):
+        return _func_name(o)
+    return getattr(o, '__dict__', None) or repr(o)
+
+
+def _paths(files):
+    if files is None:
+        return []
+    if isinstance(files, str):
+        return [files]
+    return [str(i) for i in files if i is not None]
+
+
+class Stage(object):
+    """One step of the pipeline"""
+
+    def __init__(self, name, func, args=(), kwargs=None,
+                 inputs=None, outputs=None, params=None, deps=None):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.inputs = _paths(inputs)
+        self.outputs = _paths(outputs)
+        self.params = params
+        self.deps = list(deps or [])
+
+        self.status = None    # 'run', 'new', 'check' or 'skip'
+        self.reason = None    # why stage has to be executed
+        self.digest = None    # digest of inputs, parameters and upstream
+        self.result = None    # digest of outputs, known after execution
+        self.duration = None
+        self.value = None     # return value of func
+
+    def __repr__(self):
+        return 'Stage(name="{}",status={},reason={})'.format(
+            self.name, repr(self.status), repr(self.reason))
+
+
+class Workflow(object):
+    """Graph of pipeline stages
+
+    Stages are declared in execution order with stage(), which executes them
+    right away (unless dry_run is set). Stages declared inside parallel()
+    context are independent from each other and are executed together
+    with submit (i.e scoop futures.submit) when the context is closed.
+    Dependencies between stages are either explicit (deps) or implicit,
+    when a stage uses an output of a previously declared stage.
+
+    Parameters of a stage are all arguments of the stage function, unless
+    params is given explicitly, i.e when arguments contain objects which
+    change between runs.
+
+    Stages without record in the state file (i.e produced by an older
+    version of the pipeline) are executed without forcing, letting
+    checkfiles decide as before. So are stages which don't declare outputs:
+    their products can't be verified, so they are never skipped, but forced
+    only when inputs, parameters or upstream changed.
+    """
+
+    def __init__(self, state_file, dry_run=False, submit=None):
+        self.state_file = os.path.abspath(state_file)
+        self.dry_run = dry_run
+        self.submit = submit
+        self.stages = collections.OrderedDict()
+        self.state = self._load()
+        self._producer = {}
+        self._batch = None
+
+    def _load(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            logger.warn('Ignoring damaged workflow state {}:{}'.format(self.state_file, str(e)))
+            return {}
+
+    def _save(self):
+        _dir = os.path.dirname(self.state_file)
+        if not os.path.exists(_dir):
+            os.makedirs(_dir)
+        tmp = self.state_file + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.state_file)
+
+    def stage(self, name, func, args=(), kwargs=None,
+              inputs=None, outputs=None, params=None, deps=None):
+        """declare a stage, returns Stage object"""
+        if name in self.stages:
+            raise ValueError('Duplicate stage:{}'.format(name))
+        s = Stage(name, func, args=args, kwargs=kwargs, inputs=inputs,
+                  outputs=outputs, params=params, deps=deps)
+        for d in s.deps:
+            if d not in self.stages:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(name, d))
+        for i in s.inputs:
+            p = self._producer.get(os.path.abspath(i), None)
+            if p is not None and p not in s.deps:
+                s.deps.append(p)
+        for o in s.outputs:
+            self._producer[os.path.abspath(o)] = name
+        self.stages[name] = s
+
+        if self._batch is not None:
+            self._batch.append(s)
+        else:
+            self._execute([s])
+        return s
+
+    @contextlib.contextmanager
+    def parallel(self):
+        """stages declared inside the context are executed together"""
+        if self._batch is not None:
+            # already inside parallel context
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+            batch = self._batch
+        finally:
+            self._batch = None
+        self._execute(batch)
+
+    def _digest(self, s):
+        h = hashlib.sha1()
+        h.update(_func_name(s.func).encode())
+        # by default all arguments of the stage function are parameters
+        params = s.params if s.params is not None else [s.args, s.kwargs]
+        h.update(json.dumps(params, sort_keys=True, default=_jsonable).encode())
+        for i in s.inputs:
+            h.update((path_digest(i) if os.path.isfile(i) else 'missing').encode())
+        for d in s.deps:
+            h.update('{}:{}'.format(d, self.stages[d].result).encode())
+        return h.hexdigest()
+
+    def _check(self, s):
+        """decide if stage have to be executed, returns (status, reason)"""
+        for d in s.deps:
+            if self.stages[d].result is None:
+                return ('run', 'upstream {} out of date'.format(d))
+        s.digest = self._digest(s)
+        rec = self.state.get(s.name, None)
+        if rec is None:
+            return ('new', 'no record')
+        if rec['digest'] != s.digest:
+            return ('run', 'inputs or parameters changed')
+        if not s.outputs:
+            return ('check', 'outputs not declared')
+        for o in s.outputs:
+            if o not in rec['outputs']:
+                return ('run', 'new output {}'.format(o))
+        for (o, (size, mtime, digest)) in rec['outputs'].items():
+            if not os.path.isfile(o):
+                return ('run', 'missing output {}'.format(o))
+            st = os.stat(o)
+            if (st.st_size != size or st.st_mtime != mtime) and path_digest(o) != digest:
+                return ('run', 'modified output {}'.format(o))
+        return ('skip', None)
+
+    def _remove_outputs(self, s):
+        """remove declared outputs of an out of date stage, so that code
+        checking for existence of files recomputes them"""
+        for o in s.outputs:
+            if os.path.lexists(o):
+                logger.debug('Removing stale output {}'.format(o))
+                os.unlink(o)
+
+    def _finish(self, s):
+        outputs = {}
+        h = hashlib.sha1()
+        for o in s.outputs:
+            if not os.path.isfile(o):
+                raise IOError('Stage {} did not produce {}'.format(s.name, o))
+            st = os.stat(o)
+            d = path_digest(o)
+            outputs[o] = [st.st_size, st.st_mtime, d]
+            h.update(d.encode())
+        if s.outputs:
+            s.result = h.hexdigest()
+        else:
+            s.result = s.digest
+        self.state[s.name] = {'digest':   s.digest,
+                              'result':   s.result,
+                              'outputs':  outputs,
+                              'duration': s.duration,
+                              'finished': time.time()}
+        # save after every stage, to resume precisely after a failure
+        self._save()
+
+    def _execute(self, batch):
+        for s in batch:
+            (s.status, s.reason) = self._check(s)
+            if s.status == 'skip':
+                s.result = self.state[s.name]['result']
+                s.duration = 0.0
+                logger.info(' -- Skipping stage {}: up to date'.format(s.name))
+            else:
+                logger.info(' -- Stage {}: {}'.format(s.name, s.reason))
+
+        if self.dry_run:
+            return
+        todo = [s for s in batch if s.status != 'skip']
+        for s in todo:
+            if s.status == 'run':
+                self._remove_outputs(s)
+
+        if self.submit is not None and len(todo) > 1:
+            jobs = [(s, self.submit(_run_stage, s.name, s.func, s.args, s.kwargs, s.status == 'run'))
+                    for s in todo]
+            error = None
+            for (s, j) in jobs:
+                try:
+                    (s.value, s.duration) = j.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    continue
+                self._finish(s)
+            if error is not None:
+                raise error
+        else:
+            for s in todo:
+                (s.value, s.duration) = _run_stage(s.name, s.func, s.args, s.kwargs, s.status == 'run')
+                self._finish(s)
+
+    def _estimate(self, s):
+        if s.status == 'skip':
+            return 0.0
+        if s.duration is not None:
+            return s.duration
+        rec = self.state.get(s.name, None)
+        if rec is not None and rec.get('duration', None) is not None:
+            return rec['duration']
+        return 0.0
+
+    def critical_path(self):
+        """estimate of the longest chain of dependent stages, based on
+        durations of previous runs. Returns (seconds, [stage names])"""
+        finish = {}
+        prev = {}
+        for s in self.stages.values():
+            start = 0.0
+            p = None
+            for d in s.deps:
+                if p is None or finish[d] > start:
+                    start = finish[d]
+                    p = d
+            finish[s.name] = start + self._estimate(s)
+            prev[s.name] = p
+        if not finish:
+            return (0.0, [])
+        n = max(finish, key=lambda k: finish[k])
+        total = finish[n]
+        path = []
+        while n is not None:
+            path.append(n)
+            n = prev[n]
+        return (total, list(reversed(path)))
+
+    def plan(self):
+        """list of (stage name, status, reason, estimated duration)"""
+        return [(s.name, s.status, s.reason, self._estimate(s))
+                for s in self.stages.values()]
+
+    def format_plan(self):
+        out = ["{:<50} {:>6} {:>10}  {}".format('stage', 'status', 'est,s', 'reason')]
+        for (name, status, reason, est) in self.plan():
+            out.append("{:<50} {:>6} {:>10.1f}  {}".format(
+                name[-50:], str(status), est, reason or ''))
+        (total, path) = self.critical_path()
+        out.append("")
+        out.append("Critical path {:.1f}s: {}".format(total, ' -> '.join(path)))
+        return "\n".join(out)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
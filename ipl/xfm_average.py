@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+#
+# In-process averaging of transformations, equivalent of xfmavg
+#
+# Linear transformations are averaged in the log domain, matrix logarithms
+# and exponentials are calculated for a stack of (N,4,4) matrices at once:
+# logarithms by inverse scaling and squaring (repeated square roots, then
+# Pade approximant evaluated by Gauss-Legendre quadrature), exponentials by
+# scaling and squaring of Taylor series. This covers rigid transformations,
+# which are often not diagonalizable (i.e pure translations). Only matrices
+# with eigenvalues on the negative real axis (i.e rotations by 180 degrees)
+# are passed one at a time to scipy. Displacement grids are averaged slab by slab.
+# Grids with the inversion flag set are inverted by fixed point iterations.
+# Both support weights and trimmed (robust) averages.
+#
+# Functions raise numpy_backend.Unsupported if transformations can't be
+# averaged in-process (i.e mixed linear and nonlinear transformations).
+
+from __future__ import print_function
+
+import os
+import logging
+
+try:
+    from minc2_simple import minc2_xfm, minc2_file
+    import numpy as np
+    have_minc2_simple = True
+except ImportError:
+    # minc2_simple not available :(
+    have_minc2_simple = False
+
+try:
+    import scipy.linalg
+    have_scipy = True
+except ImportError:
+    have_scipy = False
+
+from . import numpy_backend
+from . import stream
+
+logger = logging.getLogger("MINC")
+
+_eps = 1e-6
+
+# square roots are taken until matrices are this close to identity
+_log_radius = 0.25
+_log_nodes = 8
+_max_sqrt = 40
+_sqrt_iter = 50
+# exponential: norm after scaling, and number of Taylor terms
+_exp_radius = 0.5
+_exp_terms = 18
+
+
+def _norm1(mats):
+    """1-norm of every matrix in (N,M,M) stack"""
+    return np.max(np.sum(np.abs(mats), axis=-2), axis=-1)
+
+
+def _eye(mats):
+    return np.broadcast_to(np.identity(mats.shape[-1], dtype=mats.dtype), mats.shape)
+
+
+def _sqrtm(mats):
+    """principal square roots of (N,M,M) stack, by Denman-Beavers
+    iteration. Returns (roots, converged)"""
+    y = mats
+    z = _eye(mats)
+    for k in range(_sqrt_iter):
+        _y = 0.5 * (y + np.linalg.inv(z))
+        z = 0.5 * (z + np.linalg.inv(y))
+        delta = _norm1(_y - y)
+        y = _y
+        if np.all(delta <= 1e-14 * _norm1(y)):
+            break
+    return (y, np.isfinite(delta) & (delta <= 1e-10 * _norm1(y)))
+
+
+def _logm_iss(mats):
+    """matrix logarithm of (N,M,M) stack by inverse scaling and squaring
+    returns (logarithms, converged)"""
+    a = mats.copy()
+    s = np.zeros(a.shape[0])
+    good = np.isfinite(_norm1(a))
+    for k in range(_max_sqrt):
+        todo = np.nonzero(good & (_norm1(a - _eye(a)) > _log_radius))[0]
+        if todo.size == 0:
+            break
+        (r, ok) = _sqrtm(a[todo])
+        a[todo] = r
+        s[todo] += 1
+        good[todo[~ok]] = False
+    good &= _norm1(a - _eye(a)) <= _log_radius
+    out = np.zeros(a.shape, dtype=a.dtype)
+    x = a[good] - _eye(a[good])
+    # log(I+X) is the integral of X(I+tX)^-1 over [0,1]
+    (t, w) = np.polynomial.legendre.leggauss(_log_nodes)
+    for (tj, wj) in zip((t + 1.0) / 2.0, w / 2.0):
+        out[good] += wj * np.linalg.solve(_eye(x) + tj * x, x)
+    out *= (2.0 ** s)[:, np.newaxis, np.newaxis]
+    return (out, good)
+
+
+def logm(mats):
+    """matrix logarithm of (N,M,M) stack, complex"""
+    mats = np.asarray(mats, dtype=np.complex128)
+    try:
+        (out, good) = _logm_iss(mats)
+    except np.linalg.LinAlgError:
+        # singular matrix in the stack
+        (out, good) = (np.zeros(mats.shape, dtype=mats.dtype), np.zeros(mats.shape[0], dtype=bool))
+    for i in np.nonzero(~good)[0]:
+        if not have_scipy:
+            raise numpy_backend.Unsupported('Matrix logarithm did not converge, scipy is needed')
+        out[i] = scipy.linalg.logm(mats[i])
+    return out
+
+
+def expm(mats):
+    """matrix exponential of (N,M,M) stack, complex"""
+    mats = np.asarray(mats, dtype=np.complex128)
+    nrm = _norm1(mats)
+    if not np.all(np.isfinite(nrm)):
+        raise numpy_backend.Unsupported('Matrix exponential of non-finite matrix')
+    s = np.ceil(np.log2(np.maximum(nrm, _exp_radius) / _exp_radius)).astype(int)
+    x = mats / (2.0 ** s)[:, np.newaxis, np.newaxis]
+    term = _eye(x)
+    out = term.copy()
+    for k in range(1, _exp_terms + 1):
+        term = np.matmul(term, x) / k
+        out = out + term
+    for k in range(s.max() if s.size else 0):
+        sq = s > k
+        out[sq] = np.matmul(out[sq], out[sq])
+    return out
+
+
+def _weights(n, weights):
+    if weights is None:
+        return np.ones(n)
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.shape != (n,):
+        raise ValueError('Expected {} weights, got {}'.format(n, weights.shape))
+    return weights
+
+
+def weighted_mean(values, weights=None, trim=0.0):
+    """weighted mean along the first axis, trim is the fraction of the
+    lowest and the highest values excluded at every element"""
+    values = np.asarray(values)
+    n = values.shape[0]
+    w = _weights(n, weights).reshape((n,) + (1,) * (values.ndim - 1))
+    k = int(trim * n)
+    if k > 0 and n - 2 * k > 0:
+        order = np.argsort(values, axis=0)[k:n - k]
+        values = np.take_along_axis(values, order, axis=0)
+        w = np.take_along_axis(np.broadcast_to(w, (n,) + values.shape[1:]), order, axis=0)
+    return np.sum(values * w, axis=0) / np.sum(w, axis=0)
+
+
+def average_linear(mats, weights=None, trim=0.0, scale=1.0):
+    """average of (N,4,4) linear transformations in the log domain
+    scale -- fraction of the average transformation, i.e -1 for inverse"""
+    logs = logm(mats)
+    avg = weighted_mean(logs.real, weights, trim) + 1j * weighted_mean(logs.imag, weights, trim)
+    return expm((avg * scale)[np.newaxis])[0].real
+
+
+def _spatial_axes(ref):
+    """index of vector axis, (component,step) of every spatial axis"""
+    vec = None
+    axes = []
+    for (a, d) in enumerate(numpy_backend.axis_dims(ref)):
+        if d.id == minc2_file.MINC2_DIM_VEC:
+            vec = a
+            continue
+        if d.id not in (minc2_file.MINC2_DIM_X, minc2_file.MINC2_DIM_Y, minc2_file.MINC2_DIM_Z):
+            raise numpy_backend.Unsupported('Unexpected dimension in grid')
+        c = [minc2_file.MINC2_DIM_X, minc2_file.MINC2_DIM_Y, minc2_file.MINC2_DIM_Z].index(d.id)
+        if d.have_dir_cos and abs(abs(float(d.dir_cos[c])) - 1.0) > _eps:
+            raise numpy_backend.Unsupported('Oblique grids are not supported')
+        axes.append((c, float(d.step)))
+    if vec is None:
+        raise numpy_backend.Unsupported('Grid without vector dimension')
+    return (vec, axes)
+
+
+def _trilinear(vol, coords):
+    """interpolate vol at voxel coordinates, clamped at the edges"""
+    shape = vol.shape
+    lo = []
+    frac = []
+    for (a, c) in enumerate(coords):
+        c = np.clip(c, 0.0, shape[a] - 1.0)
+        i = np.minimum(np.floor(c).astype(np.intp), max(shape[a] - 2, 0))
+        lo.append(i)
+        frac.append(c - i)
+    out = np.zeros(coords[0].shape)
+    for corner in range(1 << len(shape)):
+        idx = []
+        w = 1.0
+        for a in range(len(shape)):
+            if corner >> a & 1:
+                idx.append(np.minimum(lo[a] + 1, shape[a] - 1))
+                w = w * frac[a]
+            else:
+                idx.append(lo[a])
+                w = w * (1.0 - frac[a])
+        out += w * vol[tuple(idx)]
+    return out
+
+
+def invert_grid(grid, output, iterations=10):
+    """invert displacement grid: v(x)=-u(x+v(x)), solved by fixed point
+    iterations"""
+    numpy_backend._check_backend()
+    (vol, ref) = numpy_backend.load(grid)
+    try:
+        (vec, axes) = _spatial_axes(ref)
+        u = np.moveaxis(vol, vec, -1)
+        # displacement along every array axis, in voxels
+        u_ax = [u[..., c] / step for (c, step) in axes]
+        idx = np.indices(u.shape[:-1], dtype=np.float64)
+        v_ax = [-i for i in u_ax]
+        for _ in range(iterations):
+            coords = [idx[a] + v_ax[a] for a in range(len(axes))]
+            v_ax = [-_trilinear(u_ax[a], coords) for a in range(len(axes))]
+        out = np.empty_like(u)
+        for (a, (c, step)) in enumerate(axes):
+            out[..., c] = v_ax[a] * step
+        numpy_backend.save(ref, output, np.moveaxis(out, -1, vec), datatype='float')
+    finally:
+        ref.close()
+
+
+def average_grids(grids, output, weights=None, trim=0.0, scale=1.0,
+                  max_memory=None):
+    """weighted (trimmed) average of displacement grids, slab by slab"""
+    n = len(grids)
+    w = _weights(n, weights)
+    with stream.SlabWriter(output, grids[0], datatype='float') as out:
+        for (z0, z1, s) in stream.iterate(grids, bytes_per_voxel=8 * (n + 2),
+                                          max_memory=max_memory):
+            out.write(z0, weighted_mean(s, w, trim) * scale)
+
+
+def read_transform(path):
+    """describe transformation: ('linear', matrix) or ('grid', grid, invert)
+    identity linear part of a nonlinear transformation is ignored"""
+    x = minc2_xfm(path)
+    n = x.get_n_concat()
+    if n == 1 and x.get_n_type(0) == minc2_xfm.MINC2_XFM_LINEAR:
+        return ('linear', np.asarray(x.get_linear_transform(0), dtype=np.float64))
+    parts = []
+    for i in range(n):
+        t = x.get_n_type(i)
+        if t == minc2_xfm.MINC2_XFM_LINEAR:
+            if np.max(np.abs(np.identity(4) - np.asarray(x.get_linear_transform(i)))) > _eps:
+                raise numpy_backend.Unsupported('Linear and nonlinear transformation in {}'.format(path))
+        elif t == minc2_xfm.MINC2_XFM_GRID_TRANSFORM:
+            (grid_file, grid_invert) = x.get_grid_transform(i)
+            if not os.path.isabs(grid_file):
+                grid_file = os.path.join(os.path.dirname(os.path.abspath(path)), grid_file)
+            parts.append(('grid', grid_file, bool(grid_invert)))
+        else:
+            raise numpy_backend.Unsupported('Unsupported transformation type in {}'.format(path))
+    if len(parts) != 1:
+        raise numpy_backend.Unsupported('Expected single grid in {}'.format(path))
+    return parts[0]
+
+
+def xfmavg(inputs, output, weights=None, trim=0.0, scale=1.0,
+           max_memory=None):
+    """average transformations, all linear or all nonlinear
+
+    weights -- weight of every transformation
+    trim    -- fraction of the lowest and the highest values excluded
+               from the average (of matrix logarithms or of displacements)
+    scale   -- fraction of the average to apply, -1 for inverse
+    """
+    if not have_minc2_simple:
+        raise numpy_backend.Unsupported('minc2_simple is not available')
+    xfms = [read_transform(i) for i in inputs]
+    kinds = set(i[0] for i in xfms)
+    if len(kinds) != 1:
+        raise numpy_backend.Unsupported('Mixed XFM files provided as input')
+
+    x = minc2_xfm()
+    if 'linear' in kinds:
+        x.append_linear_transform(np.ascontiguousarray(
+            average_linear(np.stack([i[1] for i in xfms]), weights, trim, scale)))
+    else:
+        output_grid = output.rsplit('.xfm', 1)[0] + '_grid_0.mnc'
+        grids = []
+        tmp = []
+        try:
+            for (k, (_, g, invert)) in enumerate(xfms):
+                if invert:
+                    _g = output_grid + '.inv{}.mnc'.format(k)
+                    invert_grid(g, _g)
+                    tmp.append(_g)
+                    g = _g
+                grids.append(g)
+            average_grids(grids, output_grid, weights, trim, scale, max_memory)
+        finally:
+            for i in tmp:
+                if os.path.exists(i):
+                    os.unlink(i)
+        x.append_grid_transform(output_grid, False)
+    x.save(output)
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80;show-tabs on
@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# @date 18/10/2026
+from ipl.cli.segmentation_service import main
+
+if __name__ == '__main__':
+    main()